@@ -1,8 +1,180 @@
+import os
+import sys
+import json
+import time
 import logging
-from scripts.data_preparation import create_index
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+from scripts.data_preparation import create_index, get_index_status, INDEX_PIPELINED, INDEX_STAGES, INDEX_WORKERS
+from utils import AzureSearchHelper, azure_storage_helper, embedding_scheduler
+from utils.instrumentation import Instrumentation
+
+INDEX_RUN_REPORT_FILE = os.getenv("INDEX_RUN_REPORT_FILE", "index_run_report.json")
+INDEX_PROFILE_FOLDER = "index_profiles"
+
+
+def _stages(value: str) -> tuple:
+    stages = tuple(stage.strip() for stage in value.split(",") if stage.strip())
+    unknown = [stage for stage in stages if stage not in INDEX_STAGES]
+    if unknown or not stages:
+        raise argparse.ArgumentTypeError(f"unknown stages {unknown}, choose among {','.join(INDEX_STAGES)}")
+    return stages
+
+
+def parse_arguments() -> argparse.Namespace:
+    """
+    Parse the command line arguments of the indexation app.
+
+    :return: The parsed arguments.
+    """
+    parser = argparse.ArgumentParser(description="Index the taxonomies in Azure AI Search.")
+    parser.add_argument(
+        "--stages",
+        type=_stages,
+        default=INDEX_STAGES,
+        help=f"Comma-separated stages to run, among {','.join(INDEX_STAGES)} (default: all). "
+        "The stages left out use the files a previous run left in the stage folders.",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Republish every concept instead of only the ones added or changed since the last publish.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Download and parse, then report per taxonomy what would be embedded, uploaded and deleted, without calling Azure OpenAI or Azure AI Search.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=INDEX_WORKERS,
+        help="Number of worker processes used to parse the taxonomies (default: INDEX_WORKERS or 1).",
+    )
+    parser.add_argument(
+        "--embedding-concurrency",
+        type=int,
+        default=None,
+        help="Maximum number of embedding requests in flight (default: EMBEDDING_MAX_CONCURRENCY).",
+    )
+    parser.add_argument(
+        "--upload-workers",
+        type=int,
+        default=None,
+        help="Number of parallel indexing requests (default: UPLOAD_MAX_WORKERS).",
+    )
+    parser.add_argument(
+        "--blob-workers",
+        type=int,
+        default=None,
+        help="Number of blobs downloaded in parallel (default: BLOB_SYNC_MAX_WORKERS).",
+    )
+    parser.add_argument(
+        "--pipelined",
+        action=argparse.BooleanOptionalAction,
+        default=INDEX_PIPELINED,
+        help="Parse, embed and upload the taxonomies side by side instead of step by step (default: INDEX_PIPELINED).",
+    )
+    parser.add_argument(
+        "--report",
+        default=INDEX_RUN_REPORT_FILE,
+        help="JSON file where the time, throughput, API calls and peak memory of each stage are written "
+        "(default: INDEX_RUN_REPORT_FILE or index_run_report.json).",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=INDEX_PROFILE_FOLDER,
+        default=None,
+        metavar="FOLDER",
+        help=f"Run each stage under cProfile and write <FOLDER>/<stage>.prof (default folder: {INDEX_PROFILE_FOLDER}).",
+    )
+    parser.add_argument(
+        "--status",
+        action="store_true",
+        help="Show the progress of the taxonomies not published yet (from the checkpoint journal) instead of indexing.",
+    )
+    return parser.parse_args()
+
+
+def apply_concurrency_arguments(arguments: argparse.Namespace):
+    """
+    Override the concurrency settings read from the environment with the ones given on the command line.
+
+    :param arguments: The parsed arguments.
+    """
+    if arguments.embedding_concurrency:
+        embedding_scheduler.EMBEDDING_MAX_CONCURRENCY = arguments.embedding_concurrency
+    if arguments.upload_workers:
+        AzureSearchHelper.UPLOAD_MAX_WORKERS = arguments.upload_workers
+    if arguments.blob_workers:
+        azure_storage_helper.BLOB_SYNC_MAX_WORKERS = arguments.blob_workers
+
+
+def print_index_status():
+    """
+    Print the progress of each taxonomy not published yet.
+    """
+    status = get_index_status()
+    if not status:
+        print("Every taxonomy is published, no run to resume.")
+        return
+    print(f"{'taxonomy':<40} {'parsed':>8} {'to publish':>11} {'embedded':>9} {'uploaded':>9}  last update")
+    for entry in status:
+        parsed = entry["concepts"] if entry["concepts"] is not None else ("yes" if entry["parsed"] else "no")
+        last_update = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["last_update"])) if entry["last_update"] else "-"
+        print(
+            f"{entry['taxonomy']:<40} {parsed:>8} {entry['to_publish']:>11} {entry['embedded']:>9} {entry['uploaded']:>9}  {last_update}"
+        )
+
+
+def print_stage_summary(report: dict):
+    """
+    Print one line per measured stage of the run report.
+    """
+    for stage in report["stages"]:
+        print(
+            f"{stage['stage']:<10} {stage['wall_seconds']:>9.1f}s {stage['items']:>9} items "
+            f"{stage['items_per_second'] or 0:>9.1f}/s {stage['api_calls']:>7} API calls {stage['retries']:>5} retries "
+            f"{stage['peak_rss_mb']:>8.0f} MB peak" + (f"  FAILED {stage['error']}" if stage["error"] else "")
+        )
+
 
 if __name__ == "__main__":
-    # TODO: handle command line arguments
+    arguments = parse_arguments()
+    if arguments.status:
+        print_index_status()
+        sys.exit(0)
     logging.getLogger().setLevel(logging.INFO)
+    apply_concurrency_arguments(arguments)
+
+    instrumentation = Instrumentation(
+        arguments.profile,
+        run_details={
+            "stages_requested": list(arguments.stages),
+            "incremental": not arguments.full,
+            "dry_run": arguments.dry_run,
+            "pipelined": arguments.pipelined,
+            "workers": arguments.workers,
+            "embedding_concurrency": embedding_scheduler.EMBEDDING_MAX_CONCURRENCY,
+            "upload_workers": AzureSearchHelper.UPLOAD_MAX_WORKERS,
+            "blob_workers": azure_storage_helper.BLOB_SYNC_MAX_WORKERS,
+        },
+    )
     logging.info("MAIN: create_index")
-    create_index()
+    try:
+        create_index(
+            incremental=not arguments.full,
+            workers=arguments.workers,
+            pipelined=arguments.pipelined,
+            stages=arguments.stages,
+            dry_run=arguments.dry_run,
+            instrumentation=instrumentation,
+        )
+    finally:
+        # Also written when a stage fails, with the error of the stage
+        report = instrumentation.write(arguments.report) if arguments.report else instrumentation.report()
+        print_stage_summary(report)
+        if "dry_run_summary" in report:
+            print(json.dumps(report["dry_run_summary"], indent=2))
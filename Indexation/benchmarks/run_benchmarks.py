@@ -0,0 +1,377 @@
+# Import relevant libraries
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import argparse
+import subprocess
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'scripts')))
+
+# Read by the indexation modules when they are imported, the services themselves are stubbed
+os.environ.setdefault("INDEX_VECTOR_COLUMNS", "Libelle_Definition|Parents")
+os.environ.setdefault("AZURE_SEARCH_ADMIN_KEY", "benchmark")
+
+# Import custom functions from other folders
+from synthetic_skos import DEFAULT_LANGUAGES, generate_taxonomy
+from stub_services import StubServices
+from utils.instrumentation import Instrumentation
+
+DEFAULT_SIZES = [1000, 10000, 100000]
+BENCHMARK_STAGES = ("parse", "render", "scrape", "delta", "stage_write", "stage_read", "embed", "upload")
+BENCHMARK_TAXONOMY = "Benchmark"
+DEFAULT_EMBED_LIMIT = 100000
+
+
+def _use_stub_services(url: str, stages: tuple):
+    """
+    Points the embedding and search clients of the indexation at the stub services, with the caches and the rate
+    limits disabled so that only the code paths are measured. The clients are only imported for the embed and
+    upload stages, so the other stages run without the Azure SDK versions they need.
+    """
+    from utils import embedding_cache, graph_cache
+
+    graph_cache.GRAPH_CACHE_DIR = ""
+    embedding_cache.EMBEDDING_CACHE_PATH = ""
+    if not {"embed", "upload"} & set(stages):
+        return
+    from azure.core.credentials import AzureKeyCredential
+    from utils import AzureOpenaiHelper, embedding_scheduler
+
+    embedding_scheduler.AZURE_OPENAI_ENDPOINT = url
+    embedding_scheduler.AZURE_OPENAI_API_KEY = "benchmark"
+    embedding_scheduler.AZURE_OPENAI_EMBEDDING_API_VERSION = embedding_scheduler.AZURE_OPENAI_EMBEDDING_API_VERSION or "2024-02-01"
+    embedding_scheduler.AZURE_OPENAI_EMBEDDING_DEPLOYMENT = "benchmark-embedding"
+    embedding_scheduler.EMBEDDING_REQUESTS_PER_MINUTE = 10 ** 9
+    embedding_scheduler.EMBEDDING_TOKENS_PER_MINUTE = 10 ** 12
+    AzureOpenaiHelper.AZURE_OPENAI_EMBEDDING_DEPLOYMENT = "benchmark-embedding"
+    if "upload" not in stages:
+        return
+    from utils import AzureSearchHelper
+
+    AzureSearchHelper.AZURE_SEARCH_SERVICE_ENDPOINT = url
+    AzureSearchHelper.AZURE_SEARCH_INDEX_NAME = "benchmark"
+    AzureSearchHelper.credential = AzureKeyCredential("benchmark")
+
+
+def _taxonomy_path(folder: Path, concepts: int, seed: int, languages: tuple) -> Path:
+    return folder / f"skos_{concepts}_seed{seed}_{'-'.join(languages)}.ttl"
+
+
+def benchmark_size(
+    concepts: int,
+    work_folder: str,
+    stub_url: str,
+    seed: int = 0,
+    languages: tuple = DEFAULT_LANGUAGES,
+    stages: tuple = BENCHMARK_STAGES,
+    embed_limit: int = DEFAULT_EMBED_LIMIT,
+    workers: int = 1,
+    profile_folder: str = None,
+) -> dict:
+    """
+    Benchmarks the indexation of one synthetic taxonomy. Meant to run in a fresh process, so the memory measured
+    for one size does not include what the previous sizes left behind.
+
+    The stages are: parse (Turtle to concept table), render (concept documents from the table), scrape
+    (ScrapingRDF.ScrapeRDF, both at once, or the streaming parser for files of at least TTL_STREAMING_MIN_BYTES),
+    delta (comparison with an empty manifest and manifest JSON written and read), stage_write and stage_read
+    (Parquet stage file), embed and upload (against the stub services, on the first embed_limit concepts).
+
+    :param concepts: The number of concepts of the taxonomy.
+    :param work_folder: The folder of the generated taxonomies and of the stage files.
+    :param stub_url: The URL of the StubServices.
+    :param seed: The seed of the generator.
+    :param languages: The languages of the labels.
+    :param stages: The stages to run, among BENCHMARK_STAGES.
+    :param embed_limit: The maximum number of concepts embedded and uploaded.
+    :param workers: The number of worker processes rendering the concepts in ScrapeRDF.
+    :param profile_folder: The folder of the cProfile dumps, if any.
+    :return: The statistics of the taxonomy and the metrics of each stage (see Instrumentation.report).
+    """
+    from utils.RDF import ScrapingRDF
+    from utils.graph_cache import load_taxonomy
+    from utils.rdf_stream import stream_concept_documents, use_streaming
+    from utils.index_manifest import compute_delta, load_manifest, save_manifest
+    from utils.stage_files import iter_stage_documents, stage_path, write_stage_documents
+
+    logging.getLogger().setLevel(logging.WARNING)
+    _use_stub_services(stub_url, stages)
+    work_folder = Path(work_folder)
+    instrumentation = Instrumentation(
+        str(Path(profile_folder) / str(concepts)) if profile_folder else None, run_details={"concepts": concepts}
+    )
+
+    ttl_path = _taxonomy_path(work_folder / "taxonomies", concepts, seed, languages)
+    statistics_path = ttl_path.with_suffix(".json")
+    if not statistics_path.exists():
+        with instrumentation.stage("generate") as metrics:
+            statistics = generate_taxonomy(str(ttl_path), concepts, seed, languages)
+            metrics.add(concepts, statistics["bytes"])
+        with open(statistics_path, "w") as file:
+            json.dump(statistics, file, indent=2)
+    with open(statistics_path) as file:
+        statistics = json.load(file)
+
+    folder = work_folder / "runs" / str(concepts)
+    shutil.rmtree(folder, ignore_errors=True)
+    for name in ("chunked", "delta", "embedded", "manifest"):
+        (folder / name).mkdir(parents=True)
+
+    streaming = use_streaming(statistics["bytes"])
+    documents = None
+    if not streaming and {"parse", "render"} & set(stages):
+        with instrumentation.stage("parse") as metrics:
+            taxonomy = load_taxonomy(str(ttl_path))
+            metrics.add(len(taxonomy.concept_store), statistics["bytes"])
+            metrics.details["store_mb"] = round(taxonomy.concept_store.nbytes() / 2 ** 20, 1)
+        if "render" in stages:
+            with instrumentation.stage("render") as metrics:
+                scraper = ScrapingRDF()
+                documents = []
+                concept_store = taxonomy.concept_store
+                for position in range(len(concept_store)):
+                    concept_info = concept_store.concept_info(position)
+                    document, _ = scraper.concatenate_info(
+                        concept_info, concept_store.concept_uri(position), BENCHMARK_TAXONOMY, position + 1, lang='en'
+                    )
+                    documents.append(document)
+                metrics.add(len(documents))
+        del taxonomy
+
+    if "scrape" in stages or documents is None:
+        documents = None
+        with instrumentation.stage("scrape") as metrics:
+            if streaming:
+                documents = list(stream_concept_documents(str(ttl_path), BENCHMARK_TAXONOMY))
+            else:
+                documents = ScrapingRDF().ScrapeRDF({str(ttl_path): BENCHMARK_TAXONOMY}, [], workers=workers)
+            metrics.add(len(documents), statistics["bytes"])
+            metrics.details["mode"] = "streaming" if streaming else "in_memory"
+
+    if "delta" in stages:
+        with instrumentation.stage("delta") as metrics:
+            manifest_path = folder / "manifest" / f"{BENCHMARK_TAXONOMY}.json"
+            documents, _, manifest = compute_delta(documents, load_manifest(manifest_path))
+            save_manifest(manifest, manifest_path)
+            manifest = load_manifest(manifest_path)
+            metrics.add(len(manifest["concepts"]), manifest_path.stat().st_size)
+
+    chunked_path = stage_path(folder / "chunked", BENCHMARK_TAXONOMY)
+    if {"stage_write", "stage_read"} & set(stages):
+        with instrumentation.stage("stage_write") as metrics:
+            metrics.add(write_stage_documents(documents, chunked_path), 0)
+            metrics.bytes = chunked_path.stat().st_size
+    if "stage_read" in stages:
+        with instrumentation.stage("stage_read") as metrics:
+            for batch in iter_stage_documents(chunked_path):
+                metrics.add(len(batch))
+            metrics.bytes = chunked_path.stat().st_size
+
+    documents = documents[:embed_limit]
+    if {"embed", "upload"} & set(stages):
+        write_stage_documents(documents, stage_path(folder / "delta", BENCHMARK_TAXONOMY))
+        del documents
+        from index_embedder import create_embedded_index
+
+        with instrumentation.stage("embed") as metrics:
+            # Each run starts from an empty index, so the vector settings are fitted again
+            create_embedded_index(folder / "delta", folder / "embedded", folder / "manifest", refit=True)
+            embedded_path = stage_path(folder / "embedded", BENCHMARK_TAXONOMY)
+            metrics.add(sum(len(batch) for batch in iter_stage_documents(embedded_path)), embedded_path.stat().st_size)
+    if "upload" in stages:
+        from utils.AzureSearchHelper import UploadIndexToAzure
+
+        with instrumentation.stage("upload") as metrics:
+            summary = UploadIndexToAzure(folder / "embedded", dead_letter_path=str(folder / "failed_uploads.jsonl"))
+            metrics.add(summary["uploaded"], embedded_path.stat().st_size)
+            metrics.details["failed_documents"] = len(summary["failed_ids"])
+
+    shutil.rmtree(folder, ignore_errors=True)
+    report = instrumentation.report()
+    return {"concepts": concepts, "taxonomy": statistics, "mode": "streaming" if streaming else "in_memory", "stages": report["stages"]}
+
+
+def scaling_exponents(results: list[dict]) -> dict:
+    """
+    Fits, for each stage measured on at least two sizes, time and peak memory as a power of the number of concepts
+    (1 is linear, 2 quadratic), to extrapolate to larger taxonomies.
+
+    :param results: The results of benchmark_size, one per size.
+    :return: {stage: {"time_exponent", "memory_exponent", "seconds_per_1k_concepts"}}.
+    """
+    measures = {}
+    for result in results:
+        for stage in result["stages"]:
+            if stage["error"] is None and stage["wall_seconds"] > 0:
+                measures.setdefault(stage["stage"], []).append((result["concepts"], stage["wall_seconds"], stage["peak_rss_mb"]))
+
+    scaling = {}
+    for stage, points in measures.items():
+        if len({concepts for concepts, _, _ in points}) < 2:
+            continue
+        concepts, seconds, memory = (np.log(np.array(values, dtype=float)) for values in zip(*points))
+        largest = max(points)
+        scaling[stage] = {
+            "time_exponent": round(float(np.polyfit(concepts, seconds, 1)[0]), 3),
+            "memory_exponent": round(float(np.polyfit(concepts, memory, 1)[0]), 3),
+            "seconds_per_1k_concepts": round(1000 * largest[1] / largest[0], 4),
+        }
+    return scaling
+
+
+def compare_results(previous: dict, current: dict) -> list[dict]:
+    """
+    Compares two benchmark files stage by stage, for the sizes measured in both.
+
+    :param previous: The results of the reference run (e.g. the main branch).
+    :param current: The results of the new run.
+    :return: One dictionary per size and stage with the time and memory ratios (current / previous).
+    """
+    previous_stages = {
+        (result["concepts"], stage["stage"]): stage for result in previous["results"] for stage in result["stages"]
+    }
+    comparison = []
+    for result in current["results"]:
+        for stage in result["stages"]:
+            before = previous_stages.get((result["concepts"], stage["stage"]))
+            if before is None or not before["wall_seconds"]:
+                continue
+            comparison.append({
+                "concepts": result["concepts"],
+                "stage": stage["stage"],
+                "previous_seconds": before["wall_seconds"],
+                "seconds": stage["wall_seconds"],
+                "time_ratio": round(stage["wall_seconds"] / before["wall_seconds"], 3),
+                "memory_ratio": round(stage["peak_rss_mb"] / before["peak_rss_mb"], 3) if before["peak_rss_mb"] else None,
+            })
+    return comparison
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True, cwd=os.path.dirname(__file__)
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(
+    sizes: list[int] = DEFAULT_SIZES,
+    work_folder: str = "benchmark_work",
+    seed: int = 0,
+    languages: tuple = DEFAULT_LANGUAGES,
+    stages: tuple = BENCHMARK_STAGES,
+    embed_limit: int = DEFAULT_EMBED_LIMIT,
+    workers: int = 1,
+    latency_ms: float = 0,
+    dimensions: int = 1536,
+    profile_folder: str = None,
+) -> dict:
+    """
+    Benchmarks the indexation of synthetic taxonomies of each size, each one in a fresh process, against local
+    stub services.
+
+    :param sizes: The numbers of concepts.
+    :param work_folder: The folder of the generated taxonomies (kept, so the next runs reuse them) and of the stage files.
+    :param seed: The seed of the generator.
+    :param languages: The languages of the labels.
+    :param stages: The stages to run, among BENCHMARK_STAGES.
+    :param embed_limit: The maximum number of concepts embedded and uploaded per size.
+    :param workers: The number of worker processes rendering the concepts in ScrapeRDF.
+    :param latency_ms: The latency added by the stub services to every request.
+    :param dimensions: The dimensions of the fake embeddings.
+    :param profile_folder: The folder of the cProfile dumps (one subfolder per size), if any.
+    :return: The benchmark results: the environment, the settings, the metrics per size and the scaling exponents.
+    """
+    results = []
+    started_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+    with StubServices(latency_ms, dimensions) as stub:
+        for concepts in sizes:
+            logging.info(f"BENCHMARK: {concepts} concepts")
+            before = stub.stats()
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                result = executor.submit(
+                    benchmark_size, concepts, work_folder, stub.url, seed, languages, stages, embed_limit, workers, profile_folder
+                ).result()
+            after = stub.stats()
+            result["stub_requests"] = {name: after[name] - before[name] for name in after}
+            results.append(result)
+            for stage in result["stages"]:
+                logging.info(
+                    f"BENCHMARK: {concepts:>8} {stage['stage']:<12} {stage['wall_seconds']:>9.2f}s "
+                    f"{stage['items_per_second'] or 0:>10.0f}/s {stage['peak_rss_mb']:>8.0f} MB"
+                )
+
+    return {
+        "benchmark": "indexation",
+        "started_at": started_at,
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "settings": {
+            "sizes": sizes,
+            "seed": seed,
+            "languages": list(languages),
+            "stages": list(stages),
+            "embed_limit": embed_limit,
+            "workers": workers,
+            "latency_ms": latency_ms,
+            "dimensions": dimensions,
+        },
+        "results": results,
+        "scaling": scaling_exponents(results),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the indexation pipeline on synthetic SKOS taxonomies.")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="Comma-separated numbers of concepts (e.g. 1000,10000,100000,1000000).")
+    parser.add_argument("--stages", default=",".join(BENCHMARK_STAGES), help="Comma-separated stages to run.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--languages", default=",".join(DEFAULT_LANGUAGES), help="Comma-separated language tags of the labels.")
+    parser.add_argument("--embed-limit", type=int, default=DEFAULT_EMBED_LIMIT, help="Concepts embedded and uploaded per size.")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes rendering the concepts.")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Latency added to every stub request.")
+    parser.add_argument("--dimensions", type=int, default=1536, help="Dimensions of the fake embeddings.")
+    parser.add_argument("--work-folder", default="benchmark_work")
+    parser.add_argument("--profile", default=None, metavar="FOLDER", help="Write a cProfile dump per size and stage.")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON file where the results are written.")
+    parser.add_argument("--compare", default=None, metavar="FILE", help="Results of a previous run to compare with.")
+    arguments = parser.parse_args()
+
+    stages = tuple(arguments.stages.split(","))
+    unknown = [stage for stage in stages if stage not in BENCHMARK_STAGES]
+    if unknown:
+        parser.error(f"unknown stages {unknown}, choose among {','.join(BENCHMARK_STAGES)}")
+    logging.getLogger().setLevel(logging.INFO)
+
+    results = run_benchmarks(
+        [int(size) for size in arguments.sizes.split(",")],
+        arguments.work_folder,
+        arguments.seed,
+        tuple(arguments.languages.split(",")),
+        stages,
+        arguments.embed_limit,
+        arguments.workers,
+        arguments.latency_ms,
+        arguments.dimensions,
+        arguments.profile,
+    )
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            results["comparison"] = compare_results(json.load(file), results)
+    with open(arguments.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(json.dumps(results["scaling"], indent=2))
+    for line in results.get("comparison", []):
+        print(f"{line['concepts']:>8} {line['stage']:<12} {line['previous_seconds']:>9.2f}s -> {line['seconds']:>9.2f}s  x{line['time_ratio']}")
@@ -0,0 +1,143 @@
+# Import relevant libraries
+import json
+import time
+import base64
+import hashlib
+import threading
+import multiprocessing
+import urllib.request
+from urllib.parse import urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+
+
+def fake_embedding(text: str, dimensions: int = 1536) -> np.ndarray:
+    """
+    Returns a deterministic unit vector for a text: the same text always gets the same vector, on any machine.
+
+    :param text: The text to embed.
+    :param dimensions: The dimensions of the vector.
+    :return: The float32 vector.
+    """
+    seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+    vector = np.random.default_rng(seed).standard_normal(dimensions, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers the two REST calls of the indexation: the embeddings of Azure OpenAI
+    (POST /openai/deployments/<deployment>/embeddings) and the indexing of Azure AI Search
+    (POST /indexes('<index>')/docs/search.index), plus GET /stats with the counters of the server.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, content: dict):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _count(self, **counts):
+        with self.server.lock:
+            for name, value in counts.items():
+                self.server.stats[name] += value
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/stats":
+            with self.server.lock:
+                return self._reply(200, dict(self.server.stats))
+        self._reply(404, {"error": {"message": f"unknown path {self.path}"}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        request = json.loads(body or b"{}")
+        path = urlparse(self.path).path
+        if self.server.latency_seconds:
+            time.sleep(self.server.latency_seconds)
+
+        if path.endswith("/embeddings"):
+            texts = request["input"] if isinstance(request["input"], list) else [request["input"]]
+            dimensions = request.get("dimensions") or self.server.dimensions
+            base64_encoded = request.get("encoding_format") == "base64"
+            data = []
+            for index, text in enumerate(texts):
+                vector = fake_embedding(text, dimensions)
+                embedding = base64.b64encode(vector.astype("<f4").tobytes()).decode("ascii") if base64_encoded else vector.tolist()
+                data.append({"object": "embedding", "index": index, "embedding": embedding})
+            tokens = sum(len(text) // 4 + 1 for text in texts)
+            self._count(embedding_requests=1, embedding_texts=len(texts), bytes_received=len(body))
+            return self._reply(200, {
+                "object": "list",
+                "data": data,
+                "model": path.split("/")[-2],
+                "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+            })
+
+        if path.endswith("/docs/search.index"):
+            actions = request.get("value", [])
+            self._count(search_requests=1, search_documents=len(actions), bytes_received=len(body))
+            return self._reply(200, {
+                "value": [
+                    {"key": action.get("id"), "status": True, "errorMessage": None, "statusCode": 200}
+                    for action in actions
+                ]
+            })
+
+        self._reply(404, {"error": {"message": f"unknown path {self.path}"}})
+
+
+def _serve(ready, latency_ms: float, dimensions: int):
+    """
+    Runs the stub server in its own process and sends its port through the ready queue.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+    server.daemon_threads = True
+    server.latency_seconds = latency_ms / 1000
+    server.dimensions = dimensions
+    server.lock = threading.Lock()
+    server.stats = {
+        "embedding_requests": 0, "embedding_texts": 0, "search_requests": 0, "search_documents": 0, "bytes_received": 0
+    }
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+class StubServices():
+    """
+    A local stand-in for the Azure OpenAI embeddings and Azure AI Search indexing REST APIs, served from a separate
+    process so its work is not measured with the benchmarked code. The embeddings are deterministic (see
+    fake_embedding) and every document is accepted.
+
+    Methods:
+    - stats: Returns the counters of the server.
+    - stop: Stops the server.
+    """
+    def __init__(self, latency_ms: float = 0, dimensions: int = 1536) -> None:
+        context = multiprocessing.get_context("spawn")
+        ready = context.Queue()
+        self._process = context.Process(target=_serve, args=(ready, latency_ms, dimensions), daemon=True)
+        self._process.start()
+        self.url = f"http://127.0.0.1:{ready.get(timeout=30)}"
+
+    def stats(self) -> dict:
+        """
+        Returns the requests, texts, documents and bytes received so far.
+        """
+        with urllib.request.urlopen(f"{self.url}/stats") as response:
+            return json.load(response)
+
+    def stop(self):
+        self._process.terminate()
+        self._process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,216 @@
+# Import relevant libraries
+import json
+import random
+import argparse
+from pathlib import Path
+import numpy as np
+
+DEFAULT_LANGUAGES = ("en", "fr")
+BENCHMARK_NAMESPACE = "http://example.org/benchmark/"
+
+# Syllables of the pseudo-words of each language, so the labels look like text of that language
+_SYLLABLES = {
+    "en": ["ac", "ag", "bor", "cal", "con", "dis", "el", "en", "fac", "gen", "in", "ist", "lo", "man", "ment", "mer",
+           "ner", "or", "port", "pro", "ra", "re", "ser", "sion", "tal", "ter", "tion", "tra", "ure", "ving"],
+    "fr": ["a", "ble", "ca", "ce", "ché", "do", "é", "eau", "ement", "en", "er", "ète", "gé", "il", "ion", "lé",
+           "mai", "ne", "on", "pré", "que", "ré", "ri", "sé", "té", "teur", "tion", "ç", "ville", "vè"],
+    "de": ["an", "be", "chen", "der", "ei", "er", "ge", "haft", "heit", "ich", "ke", "keit", "lich", "mann", "nung",
+           "ö", "sch", "stel", "tung", "ung", "ver", "wal", "werk", "ü", "zeit", "zu", "ß", "en", "ig", "st"],
+    "nl": ["aa", "ber", "ding", "ee", "en", "ge", "heid", "ij", "ing", "je", "kel", "lijk", "oo", "pen", "raad",
+           "schap", "ste", "te", "uit", "ver", "vo", "waar", "werk", "zaak", "ze", "ui", "ond", "ers", "ijk", "cht"],
+}
+_CONNECTORS = {"en": ["of", "and", "for"], "fr": ["de", "et", "pour"], "de": ["und", "für", "der"], "nl": ["van", "en", "voor"]}
+
+
+def _lexicon(rng: random.Random, language: str, size: int) -> list[str]:
+    """
+    Builds the pseudo-words of a language. The word of rank i has the same meaning in every language, so the labels
+    of a concept are translations of each other.
+    """
+    syllables = _SYLLABLES.get(language, _SYLLABLES["en"])
+    return ["".join(rng.choice(syllables) for _ in range(rng.randint(2, 4))) for _ in range(size)]
+
+
+def _words(rng: random.Random, count: int, lexicon_size: int) -> list[int]:
+    """
+    Draws words with a Zipf-like distribution (log-uniform ranks: a few words are frequent, most are rare), as in
+    real labels.
+    """
+    return [(int(lexicon_size ** rng.random()) - 1) * 7919 % lexicon_size for _ in range(count)]
+
+
+def _render_words(words: list[int], lexicon: list[str], connectors: list[str], capitalize: bool = True) -> str:
+    text = " ".join(
+        connectors[word % len(connectors)] if 0 < position < len(words) - 1 and word % 13 == 0 else lexicon[word]
+        for position, word in enumerate(words)
+    )
+    return text[:1].upper() + text[1:] if capitalize else text
+
+
+def _build_tree(rng: random.Random, concepts: int, max_depth: int, top_concepts: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Builds a random recursive tree: each concept gets as broader concept a random earlier concept that is not at
+    the maximum depth. Early concepts collect many narrower concepts and later ones few, which gives the skewed
+    fan-out of real taxonomies (broad top concepts, many leaves).
+
+    :return: The parent of each concept (-1 for the top concepts) and its depth (1 for the top concepts).
+    """
+    parents = np.full(concepts, -1, dtype=np.int64)
+    depths = np.ones(concepts, dtype=np.int16)
+    for concept in range(min(top_concepts, concepts), concepts):
+        parent = rng.randrange(concept)
+        while depths[parent] >= max_depth:
+            parent = rng.randrange(concept)
+        parents[concept] = parent
+        depths[concept] = depths[parent] + 1
+    return parents, depths
+
+
+def _adjacency(sources: np.ndarray, targets: np.ndarray, concepts: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Groups the targets by source, in compressed rows: the targets of concept i are targets[offsets[i]:offsets[i + 1]].
+    """
+    order = np.argsort(sources, kind="stable")
+    offsets = np.zeros(concepts + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=concepts), out=offsets[1:])
+    return offsets, targets[order]
+
+
+def generate_taxonomy(
+    path: str,
+    concepts: int,
+    seed: int = 0,
+    languages: tuple = DEFAULT_LANGUAGES,
+    max_depth: int = 6,
+    top_concepts: int = None,
+    alt_label_rate: float = 0.4,
+    definition_rate: float = 0.3,
+    related_rate: float = 0.15,
+    missing_translation_rate: float = 0.05,
+) -> dict:
+    """
+    Writes a synthetic SKOS taxonomy in Turtle. The same seed and parameters always give the same file.
+
+    Every concept has a prefLabel per language (a few translations are missing), and some have altLabels,
+    definitions and related concepts. The broader/narrower hierarchy is a random tree of at most max_depth levels,
+    with notations following the hierarchy. The file is written concept by concept, so 1M concepts fit in memory.
+
+    :param path: The path of the Turtle file to write.
+    :param concepts: The number of concepts.
+    :param seed: The seed of the generator.
+    :param languages: The language tags of the labels and definitions, the first one always translated.
+    :param max_depth: The maximum depth of the hierarchy.
+    :param top_concepts: The number of top concepts (default: about the cube root of the number of concepts).
+    :param alt_label_rate: The probability of a concept to have altLabels in a language.
+    :param definition_rate: The probability of a concept to have a definition in a language.
+    :param related_rate: The probability of a concept to be related to other concepts.
+    :param missing_translation_rate: The probability of a label or definition to be missing in a language other than the first.
+    :return: The statistics of the generated taxonomy.
+    """
+    rng = random.Random(seed)
+    top_concepts = top_concepts or max(5, round(concepts ** (1 / 3)))
+    lexicon_size = max(2000, min(50000, concepts // 4))
+    lexicons = {language: _lexicon(rng, language, lexicon_size) for language in languages}
+
+    parents, depths = _build_tree(rng, concepts, max_depth, top_concepts)
+    children = np.flatnonzero(parents >= 0)
+    narrower_offsets, narrower = _adjacency(parents[children], children, concepts)
+
+    # Related concepts are stated on both sides
+    related_sources = [concept for concept in range(concepts) if rng.random() < related_rate]
+    related_targets = [rng.randrange(concepts) for _ in related_sources]
+    pairs = np.array(
+        sorted({(min(a, b), max(a, b)) for a, b in zip(related_sources, related_targets) if a != b}), dtype=np.int64
+    ).reshape(-1, 2)
+    related_offsets, related = _adjacency(
+        np.concatenate([pairs[:, 0], pairs[:, 1]]), np.concatenate([pairs[:, 1], pairs[:, 0]]), concepts
+    )
+
+    notations = [None] * concepts
+    ranks = np.zeros(concepts, dtype=np.int64)
+    triples = 0
+    uri_width = len(str(concepts))
+    uri = lambda concept: f"bench:c{concept:0{uri_width}d}"
+
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(
+            "@prefix skos: <http://www.w3.org/2004/02/skos/core#> .\n"
+            "@prefix dct: <http://purl.org/dc/terms/> .\n"
+            "@prefix xsd: <http://www.w3.org/2001/XMLSchema#> .\n"
+            f"@prefix bench: <{BENCHMARK_NAMESPACE}> .\n\n"
+            f'bench:scheme a skos:ConceptScheme ;\n    dct:title "Synthetic taxonomy of {concepts} concepts (seed {seed})" .\n\n'
+        )
+        triples += 2
+        for concept in range(concepts):
+            parent = parents[concept]
+            if parent < 0:
+                notations[concept] = f"{concept + 1:02d}"
+            else:
+                ranks[parent] += 1
+                notations[concept] = f"{notations[parent]}.{ranks[parent]}"
+
+            label_words = _words(rng, rng.randint(1, 5), lexicon_size)
+            statements = [
+                "a skos:Concept",
+                "skos:inScheme bench:scheme",
+                f'skos:notation "{notations[concept]}"',
+                f'dct:modified "2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"^^xsd:date',
+            ]
+            for position, language in enumerate(languages):
+                connectors = _CONNECTORS.get(language, _CONNECTORS["en"])
+                if position and rng.random() < missing_translation_rate:
+                    continue
+                statements.append(f'skos:prefLabel "{_render_words(label_words, lexicons[language], connectors)}"@{language}')
+                if rng.random() < alt_label_rate:
+                    alt_labels = [
+                        _render_words(_words(rng, rng.randint(1, 4), lexicon_size), lexicons[language], connectors)
+                        for _ in range(rng.choice((1, 1, 1, 2, 2, 3)))
+                    ]
+                    statements.append("skos:altLabel " + ", ".join(f'"{label}"@{language}' for label in alt_labels))
+                if rng.random() < definition_rate:
+                    definition = _render_words(_words(rng, rng.randint(8, 40), lexicon_size), lexicons[language], connectors)
+                    statements.append(f'skos:definition "{definition}."@{language}')
+            if parent < 0:
+                statements.append("skos:topConceptOf bench:scheme")
+            else:
+                statements.append(f"skos:broader {uri(parent)}")
+            concept_narrower = narrower[narrower_offsets[concept]:narrower_offsets[concept + 1]]
+            if len(concept_narrower):
+                statements.append("skos:narrower " + ", ".join(uri(child) for child in concept_narrower))
+            concept_related = related[related_offsets[concept]:related_offsets[concept + 1]]
+            if len(concept_related):
+                statements.append("skos:related " + ", ".join(uri(other) for other in concept_related))
+
+            triples += sum(statement.count(",") + 1 for statement in statements)
+            file.write(f"{uri(concept)} " + " ;\n    ".join(statements) + " .\n\n")
+
+    fan_out = np.diff(narrower_offsets)
+    return {
+        "concepts": concepts,
+        "seed": seed,
+        "languages": list(languages),
+        "triples": triples,
+        "bytes": Path(path).stat().st_size,
+        "top_concepts": int(min(top_concepts, concepts)),
+        "max_depth": int(depths.max()) if concepts else 0,
+        "mean_depth": round(float(depths.mean()), 2) if concepts else 0,
+        "mean_fan_out": round(float(fan_out[fan_out > 0].mean()), 2) if fan_out.any() else 0,
+        "max_fan_out": int(fan_out.max()) if concepts else 0,
+        "related_pairs": len(pairs),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a seeded synthetic SKOS taxonomy in Turtle.")
+    parser.add_argument("path", help="Turtle file to write.")
+    parser.add_argument("--concepts", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--languages", default=",".join(DEFAULT_LANGUAGES), help="Comma-separated language tags.")
+    parser.add_argument("--max-depth", type=int, default=6)
+    arguments = parser.parse_args()
+
+    statistics = generate_taxonomy(
+        arguments.path, arguments.concepts, arguments.seed, tuple(arguments.languages.split(",")), arguments.max_depth
+    )
+    print(json.dumps(statistics, indent=2))
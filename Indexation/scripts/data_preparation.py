@@ -1,6 +1,8 @@
 # Import relevant libraries
 import os
+import json
 import logging
+from pathlib import Path
 from dotenv import load_dotenv
 import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))) 
@@ -8,55 +10,225 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')
 # Import custom functions from other folders
 from index_with_chunked_content import create_index_with_chunked_content
 from index_without_content import create_index_without_content
-from index_embedder import create_embedded_index
-from utils.AzureSearchHelper import (
-    CreateOrUpdateIndexOnAzure,
-    UploadIndexToAzure,
-)
+from index_embedder import INDEX_VECTOR_COLUMNS, create_embedded_index, load_vector_settings
+from index_delta import create_delta_index, publish_manifests
+from index_pipeline import INDEX_PIPELINE_STAGE_FILES, create_index_pipelined
 from utils.azure_storage_helper import download_documents_from_blob_to_path
+from utils.rate_limits import estimate_tokens
+from utils.index_checkpoint import INDEX_CHECKPOINT_FILE_NAME, IndexCheckpoint, open_index_checkpoint
+from utils.instrumentation import Instrumentation
+from utils.stage_files import STAGE_FILE_SUFFIX, count_stage_documents, iter_stage_batches, stage_path
+from utils.vector_compression import VECTOR_SETTINGS_FILE_NAME, VectorSettings
 from file_structure import setup_local_folders
 from utils.AzureSearchHelper import (
     CreateOrUpdateIndexOnAzure,
     UploadIndexToAzure,
+    DeleteDocumentsFromAzure,
 )
 
 load_dotenv()
 
 AZURE_BLOB_CONTAINER_NAME = os.getenv("AZURE_BLOB_ENDPOINT")
+INDEX_WORKERS = int(os.getenv("INDEX_WORKERS", "1"))
+INDEX_PIPELINED = os.getenv("INDEX_PIPELINED", "false").lower() in ("1", "true", "yes")
+INDEX_STAGES = ("download", "parse", "embed", "upload")
 
-def create_index():
+
+def _stage_files_summary(folder: str) -> tuple[int, int]:
+    """
+    Returns the number of documents and the size in bytes of the stage files of a folder.
+    """
+    paths = list(Path(folder).glob("*" + STAGE_FILE_SUFFIX))
+    return sum(count_stage_documents(path) for path in paths), sum(path.stat().st_size for path in paths)
+
+
+def _dry_run_summary(local_index_delta_folder: Path, manifest_folder: Path) -> dict:
+    """
+    Summarizes, from the delta folder and the pending manifests, what a run would publish.
+
+    :param local_index_delta_folder: The folder with the added or changed concepts.
+    :param manifest_folder: The folder with the pending manifests.
+    :return: For each taxonomy, its concepts, the concepts to embed and upload, the estimated embedding tokens
+        and the concepts to delete from the index.
+    """
+    summary = {}
+    for pending_path in sorted(Path(manifest_folder).glob("*.pending.json")):
+        entry_id = pending_path.name[: -len(".pending.json")]
+        with open(pending_path) as file:
+            pending = json.load(file)
+        to_upload = 0
+        tokens = 0
+        delta_path = stage_path(local_index_delta_folder, entry_id)
+        if delta_path.exists():
+            for documents, _ in iter_stage_batches(delta_path, columns=INDEX_VECTOR_COLUMNS):
+                to_upload += len(documents)
+                tokens += sum(
+                    estimate_tokens(f"{document[INDEX_VECTOR_COLUMNS[0]]}. {document[INDEX_VECTOR_COLUMNS[1]]}")
+                    for document in documents
+                )
+        summary[entry_id] = {
+            "concepts": len(pending["manifest"]["concepts"]),
+            "to_upload": to_upload,
+            "estimated_embedding_tokens": tokens,
+            "to_delete": len(pending["removed_ids"]),
+        }
+    return summary
+
+
+def create_index(
+    incremental: bool = True,
+    workers: int = INDEX_WORKERS,
+    pipelined: bool = INDEX_PIPELINED,
+    stages: tuple = INDEX_STAGES,
+    dry_run: bool = False,
+    instrumentation: Instrumentation = None,
+) -> dict:
     """
     create_index creates and uploads documents from a blob storage (or local folder) to an Azure AI index based on the environment variables defined 
+    Only the concepts added or changed since the last successful publish are embedded and uploaded, and removed concepts are deleted from the index.
+    Each step is journaled in the checkpoint file of the manifest folder (INDEX_CHECKPOINT), so a run that was interrupted resumes where it stopped.
+    The run is split into the stages download, parse (with the comparison to the manifests), embed and upload (with the publication of the
+    manifests), each one measured by the instrumentation. A stage left out works on the files a previous run left in the stage folders.
+
+    :param incremental: Whether to skip the unchanged concepts (False republishes every concept).
+    :param workers: The number of worker processes used to parse the taxonomies.
+    :param pipelined: Whether to run the parsing, embedding and upload side by side (see create_index_pipelined)
+        instead of one step after the other, through the stage folders. Only used when the three stages are run.
+    :param stages: The stages to run, among INDEX_STAGES.
+    :param dry_run: Whether to stop after the parse stage and report what would be embedded, uploaded and deleted,
+        without calling Azure OpenAI or Azure AI Search and without touching the checkpoint journal.
+    :param instrumentation: The Instrumentation measuring the stages (a new one when not provided).
+    :return: The report of the run (see Instrumentation.report).
     """
+    instrumentation = instrumentation or Instrumentation()
     logging.info("DATA PREPARATION: setup_local_folders")
     (
         input_documents_folder,
         local_index_without_content_folder,
         local_index_with_chunked_content_folder,
+        local_index_delta_folder,
         local_index_embedded_folder,
+        manifest_folder,
         master_file_path,
     ) = setup_local_folders()
+    checkpoint = None if dry_run else open_index_checkpoint(manifest_folder)
 
-    logging.info("DATA PREPARATION: download_documents_from_blob_to_path")
-    download_documents_from_blob_to_path(AZURE_BLOB_CONTAINER_NAME, input_documents_folder)
-    create_index_without_content(
-        input_documents_folder, local_index_without_content_folder, master_file_path
-    )
-    create_index_with_chunked_content(
-        input_documents_folder,
-        local_index_without_content_folder,
-        local_index_with_chunked_content_folder,
-    )
+    if "download" in stages:
+        with instrumentation.stage("download") as metrics:
+            logging.info("DATA PREPARATION: download_documents_from_blob_to_path")
+            download_documents_from_blob_to_path(AZURE_BLOB_CONTAINER_NAME, input_documents_folder)
+            documents = [path for path in Path(input_documents_folder).iterdir() if path.is_file()]
+            metrics.add(len(documents), sum(path.stat().st_size for path in documents))
+
+    if pipelined and not dry_run and {"parse", "embed", "upload"}.issubset(stages):
+        with instrumentation.stage("pipeline") as metrics:
+            create_index_without_content(
+                input_documents_folder, local_index_without_content_folder, master_file_path
+            )
+            logging.info("DATA PREPARATION: create_index_pipelined")
+            stage_folders = None
+            if INDEX_PIPELINE_STAGE_FILES:
+                stage_folders = (
+                    local_index_with_chunked_content_folder,
+                    local_index_delta_folder,
+                    local_index_embedded_folder,
+                )
+            report = create_index_pipelined(
+                input_documents_folder,
+                local_index_without_content_folder,
+                manifest_folder,
+                incremental,
+                workers,
+                stage_folders,
+                checkpoint=checkpoint,
+            )
+            if report is not None:
+                metrics.add(report["documents_uploaded"])
+                metrics.details["pipeline"] = report
+        if report is not None:
+            return instrumentation.report()
+
+    if "parse" in stages:
+        with instrumentation.stage("parse") as metrics:
+            create_index_without_content(
+                input_documents_folder, local_index_without_content_folder, master_file_path
+            )
+            create_index_with_chunked_content(
+                input_documents_folder,
+                local_index_without_content_folder,
+                local_index_with_chunked_content_folder,
+                workers,
+                checkpoint,
+            )
+
+            logging.info("DATA PREPARATION: create_delta_index")
+            create_delta_index(
+                local_index_with_chunked_content_folder,
+                local_index_delta_folder,
+                local_index_embedded_folder,
+                manifest_folder,
+                incremental,
+                checkpoint,
+            )
+            metrics.add(*_stage_files_summary(local_index_with_chunked_content_folder))
+            metrics.details["changed_documents"] = _stage_files_summary(local_index_delta_folder)[0]
+
+    if dry_run:
+        summary = _dry_run_summary(local_index_delta_folder, manifest_folder)
+        instrumentation.run_details["dry_run_summary"] = summary
+        for entry_id, entry in summary.items():
+            logging.info(f"DATA PREPARATION: dry run: {entry_id}: {entry}")
+        return instrumentation.report()
 
-    logging.info("DATA PREPARATION: create_embedded_index")
-    create_embedded_index(
-        local_index_with_chunked_content_folder, local_index_embedded_folder
-    )
+    vector_settings = None
+    if "embed" in stages:
+        with instrumentation.stage("embed") as metrics:
+            logging.info("DATA PREPARATION: create_embedded_index")
+            vector_settings = create_embedded_index(
+                local_index_delta_folder,
+                local_index_embedded_folder,
+                manifest_folder,
+                refit=not incremental,
+                checkpoint=checkpoint,
+            )
+            metrics.add(_stage_files_summary(local_index_delta_folder)[0], _stage_files_summary(local_index_embedded_folder)[1])
 
-    logging.info("DATA PREPARATION: create_or_update_index_on_azure")
-    CreateOrUpdateIndexOnAzure()
-    logging.info("DATA PREPARATION: upload_index_to_azure")
-    UploadIndexToAzure(local_index_embedded_folder)
+    if "upload" in stages:
+        with instrumentation.stage("upload") as metrics:
+            if vector_settings is None:
+                vector_settings = VectorSettings.load(Path(local_index_embedded_folder) / VECTOR_SETTINGS_FILE_NAME)
+                vector_settings = vector_settings or load_vector_settings(manifest_folder)
+            logging.info("DATA PREPARATION: create_or_update_index_on_azure")
+            CreateOrUpdateIndexOnAzure(vector_settings)
+            logging.info("DATA PREPARATION: upload_index_to_azure")
+            upload_summary = UploadIndexToAzure(
+                local_index_embedded_folder, checkpoint=checkpoint, delta_folder=local_index_delta_folder
+            )
+
+            logging.info("DATA PREPARATION: publish_manifests")
+            publish_manifests(manifest_folder, upload_summary, DeleteDocumentsFromAzure, checkpoint)
+            metrics.add(upload_summary["uploaded"], _stage_files_summary(local_index_embedded_folder)[1])
+            metrics.details["failed_documents"] = len(upload_summary["failed_ids"])
+            metrics.details["failed_files"] = [str(path) for path in upload_summary["failed_files"]]
+
+    return instrumentation.report()
+
+
+def get_index_status() -> list[dict]:
+    """
+    Returns the progress of the taxonomies that the last run did not publish, from the checkpoint journal.
+
+    :return: One dictionary per taxonomy (see IndexCheckpoint.status), empty when every taxonomy was published.
+    """
+    manifest_folder = setup_local_folders()[5]
+    path = manifest_folder / INDEX_CHECKPOINT_FILE_NAME
+    if not path.exists():
+        return []
+    checkpoint = IndexCheckpoint(str(path))
+    try:
+        return checkpoint.status()
+    finally:
+        checkpoint.close()
 
 if __name__=="__main__":
 
@@ -24,7 +24,8 @@ def _temporary_directory() -> str:
 def setup_local_folders() -> tuple[str]:
     """
     Create and return the local folders created in the temporary directory. 
-    4 folders are created, one for each step of the indexation. 
+    5 folders are created, one for each step of the indexation, plus the folder
+    keeping the manifests of the last successful publish.
 
     :return: tuple containing the path to each folder as strings.
     """
@@ -38,7 +39,9 @@ def setup_local_folders() -> tuple[str]:
     local_index_with_chunked_content_folder = (
         temporary_directory_path / "index_with_chunked_content"
     )
+    local_index_delta_folder = temporary_directory_path / "index_delta"
     local_index_embedded_folder = temporary_directory_path / "index_embedded"
+    manifest_folder = temporary_directory_path / "index_manifest"
 
     master_file_path = input_documents_folder / INDEX_MASTER_FILE_NAME
 
@@ -47,7 +50,9 @@ def setup_local_folders() -> tuple[str]:
         input_documents_folder,
         local_index_without_content_folder,
         local_index_with_chunked_content_folder,
+        local_index_delta_folder,
         local_index_embedded_folder,
+        manifest_folder,
     ]:
         folder.mkdir(parents=True, exist_ok=True)
 
@@ -55,5 +60,7 @@ def setup_local_folders() -> tuple[str]:
         input_documents_folder,
         local_index_without_content_folder,
         local_index_with_chunked_content_folder,
+        local_index_delta_folder,
         local_index_embedded_folder,
+        manifest_folder,
         master_file_path,    )
@@ -0,0 +1,160 @@
+# Import relevant libraries
+import os
+import sys
+import json
+import logging
+from pathlib import Path
+
+# Import custom functions from other folders
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.data_utils import (
+    check_paths_exists,
+    get_file_name_from_index_element,
+    push_entry_to_path,
+)
+from utils.stage_files import (
+    STAGE_FILE_SUFFIX,
+    merge_stage_file,
+    read_stage_documents,
+    stage_path,
+    write_stage_documents,
+)
+from utils.index_manifest import (
+    CONCEPT_ID_COLUMN,
+    compute_delta,
+    load_manifest,
+    save_index_version,
+    save_manifest,
+)
+
+
+def _create_delta_of_entry(
+    entry_with_chunked_content_path: Path,
+    local_index_delta_folder: Path,
+    local_index_embedded_folder: Path,
+    manifest_folder: Path,
+    incremental: bool,
+    checkpoint=None,
+):
+    """
+    Compares the concepts of one taxonomy with its manifest, writes the added or changed concepts to the
+    delta folder and the new manifest with the removed concept ids to a pending file. The removed concepts are
+    taken out of the embedded file of the taxonomy, which keeps all of its concepts (see merge_stage_file).
+
+    :param entry_with_chunked_content_path: The path of the index element with chunked content of the taxonomy.
+    :param local_index_delta_folder: The folder where the added or changed concepts will be stored.
+    :param local_index_embedded_folder: The folder where the embedded concepts are stored.
+    :param manifest_folder: The folder containing the manifests of the last successful publish.
+    :param incremental: Whether to skip the unchanged concepts (False republishes every concept).
+    :param checkpoint: The IndexCheckpoint of the run, if any.
+    """
+    documents = read_stage_documents(entry_with_chunked_content_path)
+    if not documents:
+        return
+    entry_id = get_file_name_from_index_element(documents[0])
+
+    manifest_path = manifest_folder / str(entry_id + ".json")
+    manifest = load_manifest(manifest_path)
+    changed_documents, removed_ids, new_manifest = compute_delta(
+        documents, manifest, force=not incremental
+    )
+    logging.info(
+        f"INDEX_DELTA: {entry_id}: {len(documents)} concepts, {len(changed_documents)} added or changed, {len(removed_ids)} removed"
+    )
+
+    if checkpoint is not None:
+        checkpoint.register_delta(entry_id, changed_documents, entry_with_chunked_content_path.stem)
+
+    if removed_ids and stage_path(local_index_embedded_folder, entry_id).exists():
+        merge_stage_file(stage_path(local_index_embedded_folder, entry_id), removed_ids, CONCEPT_ID_COLUMN)
+    # An empty delta leaves no file
+    write_stage_documents(changed_documents, stage_path(local_index_delta_folder, entry_id))
+
+    push_entry_to_path(
+        {"manifest": new_manifest, "removed_ids": removed_ids},
+        manifest_folder / str(entry_id + ".pending.json"),
+    )
+
+
+def create_delta_index(
+    local_index_with_chunked_content_folder: str,
+    local_index_delta_folder: str,
+    local_index_embedded_folder: str,
+    manifest_folder: str,
+    incremental: bool = True,
+    checkpoint=None,
+):
+    """
+    Validates the existence of the provided folder paths and computes, for every taxonomy, which concepts were
+    added, changed or removed since the last successful publish. Only the added or changed concepts go
+    to the delta folder, so the following stages scale with the size of the changes.
+
+    :param local_index_with_chunked_content_folder: The path to the folder containing the index elements with chunked content.
+    :param local_index_delta_folder: The path to the folder where the added or changed concepts will be stored.
+    :param local_index_embedded_folder: The path to the folder where the embedded concepts are stored.
+    :param manifest_folder: The path to the folder containing the manifests of the last successful publish.
+    :param incremental: Whether to skip the unchanged concepts (False republishes every concept).
+    :param checkpoint: The IndexCheckpoint of the run, if any.
+    """
+    check_paths_exists(
+        [
+            local_index_with_chunked_content_folder,
+            local_index_delta_folder,
+            local_index_embedded_folder,
+            manifest_folder,
+        ]
+    )
+
+    for entry_with_chunked_content_path in Path(local_index_with_chunked_content_folder).glob("*" + STAGE_FILE_SUFFIX):
+        _create_delta_of_entry(
+            entry_with_chunked_content_path,
+            Path(local_index_delta_folder),
+            Path(local_index_embedded_folder),
+            Path(manifest_folder),
+            incremental,
+            checkpoint,
+        )
+
+
+def publish_manifests(manifest_folder: str, upload_summary: dict, delete_documents, checkpoint=None):
+    """
+    Deletes the removed concepts from the index and promotes the pending manifests once the upload is done.
+    Taxonomies whose file failed to upload keep their previous manifest, and documents that ended in the
+    dead-letter file are kept in the manifest without hash so the next run uploads them again.
+    Published taxonomies are removed from the checkpoint journal. When documents were uploaded or deleted, a new
+    version stamp of the index is written (see save_index_version).
+
+    :param manifest_folder: The path to the folder containing the manifests.
+    :param upload_summary: The summary returned by UploadIndexToAzure.
+    :param delete_documents: The function deleting a list of document ids from the index.
+    :param checkpoint: The IndexCheckpoint of the run, if any.
+    """
+    failed_files = {Path(path).stem for path in upload_summary["failed_files"]}
+    failed_ids = set(upload_summary["failed_ids"])
+    changed = upload_summary["uploaded"] > 0
+
+    for pending_path in Path(manifest_folder).glob("*.pending.json"):
+        entry_id = pending_path.name[: -len(".pending.json")]
+        if entry_id in failed_files:
+            logging.info(f"INDEX_DELTA: {entry_id} failed to upload, keeping its previous manifest")
+            continue
+
+        with open(pending_path) as file:
+            pending = json.load(file)
+        manifest = pending["manifest"]
+        for concept in manifest["concepts"].values():
+            if concept[CONCEPT_ID_COLUMN] in failed_ids:
+                concept["hash"] = None
+
+        if pending["removed_ids"]:
+            logging.info(f"INDEX_DELTA: {entry_id}: deleting {len(pending['removed_ids'])} removed concepts")
+            delete_documents(pending["removed_ids"])
+            changed = True
+
+        save_manifest(manifest, Path(manifest_folder) / str(entry_id + ".json"))
+        pending_path.unlink()
+        if checkpoint is not None:
+            checkpoint.clear(entry_id)
+
+    if changed:
+        logging.info(f"INDEX_DELTA: new index version {save_index_version(manifest_folder)}")
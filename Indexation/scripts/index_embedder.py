@@ -1,81 +1,234 @@
 # Import relevant libraries
 from pathlib import Path
-import gc
 import os
 import logging
+import numpy as np
 from dotenv import load_dotenv
 
 # Import custom functions from other folders
-from utils.data_utils import (
-    check_paths_exists,
-    get_file_name_from_index_element,
-    read_index_element_from_path,
-    push_entry_to_path,
+from utils.data_utils import check_paths_exists
+from utils.stage_files import (
+    STAGE_FILE_SUFFIX,
+    StageWriter,
+    changes_path,
+    count_stage_documents,
+    iter_stage_batches,
+    merge_stage_file,
+    stage_path,
 )
-from utils.AzureOpenaiHelper import text_to_embedding
+from utils.vector_compression import (
+    INDEX_VECTOR_SAMPLE_ROWS,
+    VECTOR_SETTINGS_FILE_NAME,
+    VectorSettings,
+    vector_settings_from_env,
+)
+from utils.AzureOpenaiHelper import texts_to_embeddings
+from utils.index_manifest import CONCEPT_ID_COLUMN
+from utils.embedding_cache import get_embedding_cache
 
 
 load_dotenv(override=True)
 
 INDEX_VECTOR_COLUMNS = os.getenv("INDEX_VECTOR_COLUMNS").split("|")
 
-def embed_index_elements(index_elements: list[dict]) -> list[dict]:
+def embed_index_elements(index_elements: list[dict]) -> np.ndarray:
     """
     Embed the content columns of each item (chunked documents) from an index (represented as a list of dictionaries)
 
     :param index_elements: list of dict where each dictionary is one document from the index
-    :return: updated version of index_elements (extra column containing the vector embedding for each document) 
+    :return: float32 matrix with the vector embedding of each document, one row per document
+    """
+    texts = [
+        f"{index_element[INDEX_VECTOR_COLUMNS[0]]}. {index_element[INDEX_VECTOR_COLUMNS[1]]}"
+        for index_element in index_elements
+    ]
+    logging.info(f"INDEX_EMBEDDER: embed_index_elements: {len(texts)} elements")
+
+    return np.asarray(texts_to_embeddings(texts), dtype=np.float32)
+
+
+def embed_with_checkpoint(index_elements: list[dict], taxonomy: str, checkpoint=None) -> tuple[list[dict], np.ndarray]:
+    """
+    Embeds a batch of documents, resuming from the checkpoint journal: documents already uploaded by an interrupted
+    run are left out, the ones already embedded get their journaled vector, and the new vectors are journaled.
+
+    :param index_elements: The documents of the batch.
+    :param taxonomy: The id of the taxonomy of the documents.
+    :param checkpoint: The IndexCheckpoint of the run, if any.
+    :return: The documents still to upload and their float32 vectors as embedded, one row per document.
+    """
+    if checkpoint is None:
+        return index_elements, embed_index_elements(index_elements)
+
+    ids = [index_element[CONCEPT_ID_COLUMN] for index_element in index_elements]
+    uploaded = checkpoint.uploaded_ids(taxonomy, ids)
+    index_elements = [index_element for index_element in index_elements if index_element[CONCEPT_ID_COLUMN] not in uploaded]
+    vectors = checkpoint.embedded_vectors(taxonomy, ids)
+    missing = [index_element for index_element in index_elements if index_element[CONCEPT_ID_COLUMN] not in vectors]
+    if missing:
+        missing_ids = [index_element[CONCEPT_ID_COLUMN] for index_element in missing]
+        missing_vectors = embed_index_elements(missing)
+        checkpoint.mark_embedded(taxonomy, missing_ids, missing_vectors)
+        vectors.update(zip(missing_ids, missing_vectors))
+    if not index_elements:
+        return [], np.empty((0, 0), dtype=np.float32)
+    return index_elements, np.stack([vectors[index_element[CONCEPT_ID_COLUMN]] for index_element in index_elements])
+
+
+def load_vector_settings(settings_folder: str = None, refit: bool = False) -> VectorSettings:
+    """
+    Returns the vector settings of the index: the ones saved by the last run (with their fitted PCA and
+    calibration) when they store the same vectors as the INDEX_VECTOR_* environment variables, else new ones.
+    Reduced or compressed vectors cannot be fitted on the changed concepts of an incremental run, so a ValueError
+    is raised when a previous run published concepts without saving fitted settings.
+
+    :param settings_folder: The folder where the settings of the last run are saved (e.g. the manifest folder).
+    :param refit: Whether to ignore the saved settings (full runs fit them again).
+    :return: The VectorSettings.
+    """
+    settings = vector_settings_from_env()
+    if settings_folder is None or refit:
+        return settings
+    saved = VectorSettings.load(Path(settings_folder) / VECTOR_SETTINGS_FILE_NAME)
+    if saved is None:
+        if (settings.dimensions or settings.compression != "none") and _has_published_manifests(settings_folder):
+            # Fitted on the changed concepts only, the settings would not describe the vectors already in the index
+            raise ValueError(
+                "INDEX_VECTOR_DIMENSIONS or INDEX_VECTOR_COMPRESSION is set but no fitted vector settings were saved "
+                f"in {settings_folder} by the run that built the index: "
+                "run a full indexation (create_index(incremental=False)) into a new index"
+            )
+        return settings
+    if not saved.same_reduction(settings):
+        raise ValueError(
+            "INDEX_VECTOR_DIMENSIONS or INDEX_VECTOR_REDUCTION changed since the index was built: "
+            "run a full indexation (create_index(incremental=False)) into a new index"
+        )
+    # The compression does not change the stored vectors
+    saved.compression = settings.compression
+    saved.oversampling = settings.oversampling
+    return saved
+
+
+def _has_published_manifests(manifest_folder: str) -> bool:
+    """
+    Tells whether a previous run published concepts, i.e. whether the manifest folder holds a manifest.
+    """
+    return any(
+        not path.name.endswith(".pending.json") for path in Path(manifest_folder).glob("*.json")
+    )
+
+
+def _sample_vectors(paths: list[Path], column_vector: str, rows: int = INDEX_VECTOR_SAMPLE_ROWS) -> np.ndarray:
+    """
+    Reads about rows vectors evenly spread over stage files.
+    """
+    total = sum(count_stage_documents(path) for path in paths)
+    step = max(1, -(-total // rows))
+    sample = []
+    for path in paths:
+        for _, vectors in iter_stage_batches(path, columns=[column_vector]):
+            sample.append(vectors[column_vector][::step])
+    return np.concatenate(sample)
+
+
+def _reduce_stage_file(path: Path, column_vector: str, settings: VectorSettings):
+    """
+    Rewrites the vectors of an embedded stage file with the dimensions of the vector settings.
     """
-    for index_element in index_elements:
-        logging.info(index_element)
-        column_vector = f"{INDEX_VECTOR_COLUMNS[0]}_vector"
-        index_element[column_vector] = text_to_embedding(f"{index_element[INDEX_VECTOR_COLUMNS[0]]}. {index_element[INDEX_VECTOR_COLUMNS[1]]}")
-        
-    return index_elements
+    with StageWriter(path) as writer:
+        for index_elements, vectors in iter_stage_batches(path):
+            writer.write(index_elements, {column_vector: settings.reduce(vectors[column_vector])})
 
 
 def create_embedded_index(
-    local_index_with_chunked_content_folder: str, local_index_embedded_folder: str
-):
+    local_index_with_chunked_content_folder: str,
+    local_index_embedded_folder: str,
+    settings_folder: str = None,
+    refit: bool = False,
+    checkpoint=None,
+) -> VectorSettings:
     """
-    Create a local index containing an extra field: vector embeddings
+    Create a local index containing an extra field: vector embeddings.
+    The documents are read, embedded and written in row batches of STAGE_BATCH_ROWS, so the memory used
+    does not depend on the size of a taxonomy. With a checkpoint journal, every batch is journaled once embedded,
+    so a run interrupted in the middle of a taxonomy does not embed its first batches again.
+    The vectors are stored with the dimensions of the vector settings (INDEX_VECTOR_*). When no fitted settings
+    were saved by a previous run, they are fitted on the vectors of this run, which are then reduced.
+    The embedded file of a taxonomy keeps all of its concepts: the embedded documents replace the ones with the same
+    id (see merge_stage_file), except on full runs, which write it again.
 
     :param local_index_with_chunked_content_folder: string of the folder where the index with chunked content is stored
     :param local_index_embedded_folder: string of the folder where the index with embedded content should be stored
+    :param settings_folder: string of the folder where the vector settings are kept between runs
+    :param refit: whether to fit the vector settings again (full runs)
+    :param checkpoint: the IndexCheckpoint of the run, if any
+    :return: The vector settings of the embedded vectors, also saved in the embedded folder.
     """
     check_paths_exists(
         [local_index_with_chunked_content_folder, local_index_embedded_folder]
     )
+    column_vector = f"{INDEX_VECTOR_COLUMNS[0]}_vector"
+    settings = load_vector_settings(settings_folder, refit)
+    embedded_paths = []
 
     # Get all chunked index elements
     entries_with_chunked_content_paths = Path(
         local_index_with_chunked_content_folder
-    ).glob("*.json")
+    ).glob("*" + STAGE_FILE_SUFFIX)
+
+    # The rows already stored are kept unless they could have other dimensions than the rows written now
+    keep_stored = not refit and (settings.fitted or not settings.reduces)
 
     # Iterate over all chunked index elements
     for entry_with_chunked_content_path in entries_with_chunked_content_paths:
-        # Read index element
-        entry = read_index_element_from_path(entry_with_chunked_content_path)
-        entry_id = get_file_name_from_index_element(entry[0])
-
-        entry_embedded_path = Path(local_index_embedded_folder) / str(
-            entry_id + ".json"
+        entry_embedded_path = stage_path(
+            local_index_embedded_folder, entry_with_chunked_content_path.stem
         )
 
-        if entry_embedded_path.exists() or not INDEX_VECTOR_COLUMNS:
+        if not INDEX_VECTOR_COLUMNS:
+            continue
+        if entry_embedded_path.exists() and (
+            entry_embedded_path.stat().st_mtime_ns >= entry_with_chunked_content_path.stat().st_mtime_ns
+        ):
+            # Merged by an interrupted run
             continue
 
         logging.info(
             f"INDEX_EMBEDDER: create_embedded_index: {entry_with_chunked_content_path}"
         )
 
-        index_elements = embed_index_elements(entry)
-        push_entry_to_path(index_elements, entry_embedded_path)
-
-        # Trying to free up memory
-        del entry
-        del entry_id
-        del entry_embedded_path
-        del index_elements
-
-        gc.collect()
+        with StageWriter(changes_path(entry_embedded_path)) as writer:
+            for index_elements, _ in iter_stage_batches(entry_with_chunked_content_path):
+                index_elements, vectors = embed_with_checkpoint(
+                    index_elements, entry_with_chunked_content_path.stem, checkpoint
+                )
+                if not index_elements:
+                    continue
+                # Until the settings are fitted, the vectors are written as embedded and reduced afterwards
+                writer.write(index_elements, {column_vector: settings.reduce(vectors) if settings.fitted else vectors})
+        if not keep_stored:
+            entry_embedded_path.unlink(missing_ok=True)
+        merge_stage_file(entry_embedded_path, id_column=CONCEPT_ID_COLUMN)
+        if entry_embedded_path.exists():
+            embedded_paths.append(entry_embedded_path)
+
+    if embedded_paths and not settings.fitted:
+        settings.fit(_sample_vectors(embedded_paths, column_vector))
+        logging.info(
+            f"INDEX_EMBEDDER: vector settings fitted: {settings.output_dimensions(settings.source_dimensions)} dimensions, "
+            f"{settings.compression} compression"
+        )
+        if settings.reduces:
+            for entry_embedded_path in embedded_paths:
+                _reduce_stage_file(entry_embedded_path, column_vector, settings)
+
+    if settings.fitted:
+        settings.save(Path(local_index_embedded_folder) / VECTOR_SETTINGS_FILE_NAME)
+        if settings_folder is not None:
+            settings.save(Path(settings_folder) / VECTOR_SETTINGS_FILE_NAME)
+
+    cache = get_embedding_cache()
+    if cache is not None:
+        logging.info(f"INDEX_EMBEDDER: embedding cache stats: {cache.stats()}")
+    return settings
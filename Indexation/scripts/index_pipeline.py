@@ -0,0 +1,482 @@
+# Import relevant libraries
+import os
+import sys
+import json
+import time
+import queue
+import logging
+import threading
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from dotenv import load_dotenv
+
+# Import custom functions from other folders
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.data_utils import (
+    check_paths_exists,
+    get_file_name_from_index_element,
+    push_entry_to_path,
+    read_index_element_from_path,
+)
+from utils.stage_files import STAGE_BATCH_ROWS, StageWriter, changes_path, merge_stage_file, stage_path, write_stage_documents
+from utils.index_manifest import CONCEPT_ID_COLUMN, compute_delta, load_manifest
+from utils.vector_compression import INDEX_VECTOR_SAMPLE_ROWS, VECTOR_SETTINGS_FILE_NAME
+from utils.RDF import ScrapingRDF
+from utils.rdf_stream import stream_concept_documents, use_streaming
+from utils.embedding_cache import get_embedding_cache
+from utils.AzureSearchHelper import (
+    UPLOAD_DEAD_LETTER_FILE,
+    CreateOrUpdateIndexOnAzure,
+    DeleteDocumentsFromAzure,
+    GetSearchClient,
+    UploadCheckpointedDocumentsToAzure,
+    _write_dead_letters,
+)
+from index_with_chunked_content import INDEX_TAXO_NAME_COLUMN, INDEX_TTL_FILENAME_COLUMN
+from index_embedder import INDEX_VECTOR_COLUMNS, embed_with_checkpoint, load_vector_settings
+from index_delta import publish_manifests
+
+load_dotenv(override=True)
+
+# Row batches (of STAGE_BATCH_ROWS documents) a stage may get ahead of the next one
+INDEX_PIPELINE_QUEUE_BATCHES = int(os.getenv("INDEX_PIPELINE_QUEUE_BATCHES", "4"))
+# Also write the chunked, delta and embedded stage files, for debugging or for the local search backend
+INDEX_PIPELINE_STAGE_FILES = os.getenv("INDEX_PIPELINE_STAGE_FILES", "false").lower() in ("1", "true", "yes")
+INDEX_PIPELINE_REPORT_FILE = os.getenv("INDEX_PIPELINE_REPORT_FILE", "index_pipeline_report.json")
+
+_POLL_SECONDS = 0.2
+_END_OF_STREAM = object()
+
+
+def _parse_entry(ttl_path: Path, ttl: str) -> list[dict]:
+    """
+    Parses the concepts of one taxonomy (streamed from at least TTL_STREAMING_MIN_BYTES).
+
+    :param ttl_path: The path to the ttl file.
+    :param ttl: The name of the taxonomy.
+    :return: The chunked documents of the taxonomy.
+    """
+    if use_streaming(Path(ttl_path).stat().st_size):
+        logging.info(f"INDEX_PIPELINE: streaming {ttl_path}")
+        return list(stream_concept_documents(ttl_path, ttl))
+    return ScrapingRDF().ScrapeRDF({ttl_path: ttl}, [])
+
+
+class _StageMetrics():
+    """
+    Time spent by a stage of the pipeline working, waiting for input (the stage is starved) and waiting to hand its
+    output over (the next stage is the bottleneck, backpressure).
+    """
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.batches = 0
+        self.documents = 0
+        self.busy_seconds = 0.0
+        self.waiting_input_seconds = 0.0
+        self.waiting_output_seconds = 0.0
+
+    def as_dict(self, total_seconds: float) -> dict:
+        return {
+            "batches": self.batches,
+            "documents": self.documents,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "waiting_input_seconds": round(self.waiting_input_seconds, 3),
+            "waiting_output_seconds": round(self.waiting_output_seconds, 3),
+            "utilization": round(self.busy_seconds / total_seconds, 3) if total_seconds else 0.0,
+            "documents_per_busy_second": round(self.documents / self.busy_seconds, 1) if self.busy_seconds else None,
+        }
+
+
+class IndexPipeline():
+    """
+    Indexes the taxonomies with the parsing, delta, embedding and upload stages running side by side instead of one
+    after the other. Three threads are connected by bounded queues of row batches:
+    - parse: the taxonomies are parsed (by a process pool with several workers, smallest file first) and compared
+      with their manifest; the added or changed concepts are cut into batches of STAGE_BATCH_ROWS.
+    - embed: each batch is embedded and reduced to the vector settings.
+    - upload: each batch is uploaded to the index.
+    When a queue is full the stage feeding it waits, so at most queue_batches batches are held between two stages
+    whatever the size of the taxonomies. The first error stops every stage and is raised again by run.
+    With a checkpoint journal, the embedded and uploaded concepts are journaled batch by batch, and the work an
+    interrupted run already did is skipped.
+
+    Methods:
+    - run: Runs the pipeline and returns its throughput report.
+    """
+    def __init__(
+        self,
+        jobs: list[tuple],
+        manifest_folder: str,
+        vector_settings,
+        incremental: bool = True,
+        workers: int = 1,
+        index_client=None,
+        stage_folders: tuple = None,
+        checkpoint=None,
+        queue_batches: int = INDEX_PIPELINE_QUEUE_BATCHES,
+        dead_letter_path: str = UPLOAD_DEAD_LETTER_FILE,
+    ) -> None:
+        """
+        :param jobs: The (entry_id, ttl_path, ttl) of each taxonomy.
+        :param manifest_folder: The folder containing the manifests of the last successful publish.
+        :param vector_settings: The vector settings of the index (a PCA must already be fitted).
+        :param incremental: Whether to skip the unchanged concepts (False republishes every concept).
+        :param workers: The number of worker processes used to parse the taxonomies.
+        :param index_client: The SearchClient of the index (created when not provided).
+        :param stage_folders: Optional (chunked, delta, embedded) folders where the stage files are also written.
+        :param checkpoint: The IndexCheckpoint of the run, if any.
+        :param queue_batches: The number of row batches each queue holds.
+        :param dead_letter_path: The path of the file where the documents that could not be uploaded are written.
+        """
+        self.jobs = jobs
+        self._source_paths = {entry_id: ttl_path for entry_id, ttl_path, _ in jobs}
+        self.manifest_folder = Path(manifest_folder)
+        self.settings = vector_settings
+        self.incremental = incremental
+        self.workers = workers
+        self.index_client = index_client
+        self.stage_folders = stage_folders
+        self.checkpoint = checkpoint
+        self.dead_letter_path = dead_letter_path
+        self.column_vector = f"{INDEX_VECTOR_COLUMNS[0]}_vector"
+
+        self._embed_queue = queue.Queue(maxsize=max(1, queue_batches))
+        self._upload_queue = queue.Queue(maxsize=max(1, queue_batches))
+        self._abort = threading.Event()
+        self._errors = []
+        self._metrics = {name: _StageMetrics(name) for name in ("parse", "embed", "upload")}
+        self._sample = []
+        self._sample_rows = 0
+        self._documents_parsed = 0
+        self._failed_ids = []
+        self._failed_entries = set()
+        self._first_upload_seconds = None
+        self._start = None
+
+    def _put(self, target: queue.Queue, item, metrics: _StageMetrics):
+        """
+        Hands an item to the next stage, waiting while its queue is full.
+        """
+        start = time.perf_counter()
+        while not self._abort.is_set():
+            try:
+                target.put(item, timeout=_POLL_SECONDS)
+                break
+            except queue.Full:
+                continue
+        metrics.waiting_output_seconds += time.perf_counter() - start
+
+    def _get(self, source: queue.Queue, metrics: _StageMetrics):
+        """
+        Takes the next item of a stage, waiting while its queue is empty.
+
+        :return: The item, or _END_OF_STREAM when the pipeline is stopped.
+        """
+        start = time.perf_counter()
+        item = _END_OF_STREAM
+        while not self._abort.is_set():
+            try:
+                item = source.get(timeout=_POLL_SECONDS)
+                break
+            except queue.Empty:
+                continue
+        metrics.waiting_input_seconds += time.perf_counter() - start
+        return item
+
+    def _run_stage(self, stage, *args):
+        """
+        Runs a stage, recording its error and stopping the other stages when it fails.
+        """
+        try:
+            stage(*args)
+        except BaseException as e:
+            logging.exception(f"INDEX_PIPELINE: stage {stage.__name__} failed")
+            self._errors.append(e)
+            self._abort.set()
+
+    def _parsed_entries(self, futures: dict):
+        """
+        Yields the (entry_id, documents) of each taxonomy, as the process pool completes them or parsed here
+        when there is no pool.
+        """
+        if not futures:
+            for entry_id, ttl_path, ttl in self.jobs:
+                yield entry_id, _parse_entry(ttl_path, ttl)
+            return
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+    def _parse_stage(self, futures: dict):
+        metrics = self._metrics["parse"]
+        parsed = self._parsed_entries(futures)
+        while not self._abort.is_set():
+            start = time.perf_counter()
+            try:
+                source_id, documents = next(parsed)
+            except StopIteration:
+                break
+            if not documents:
+                metrics.busy_seconds += time.perf_counter() - start
+                continue
+            if self.stage_folders:
+                write_stage_documents(documents, stage_path(self.stage_folders[0], source_id))
+            # Named like the staged indexation names the delta, embedded and manifest files
+            entry_id = get_file_name_from_index_element(documents[0])
+
+            manifest = load_manifest(self.manifest_folder / str(entry_id + ".json"))
+            changed_documents, removed_ids, new_manifest = compute_delta(
+                documents, manifest, force=not self.incremental
+            )
+            logging.info(
+                f"INDEX_PIPELINE: {entry_id}: {len(documents)} concepts, {len(changed_documents)} added or changed, {len(removed_ids)} removed"
+            )
+            if self.stage_folders:
+                write_stage_documents(changed_documents, stage_path(self.stage_folders[1], entry_id))
+                embedded_path = stage_path(self.stage_folders[2], entry_id)
+                if not self.incremental:
+                    embedded_path.unlink(missing_ok=True)
+                elif removed_ids and embedded_path.exists():
+                    merge_stage_file(embedded_path, removed_ids, CONCEPT_ID_COLUMN)
+            if self.checkpoint is not None:
+                self.checkpoint.mark_parsed(source_id, self._source_paths[source_id], len(documents))
+                self.checkpoint.register_delta(entry_id, changed_documents, source_id)
+            push_entry_to_path(
+                {"manifest": new_manifest, "removed_ids": removed_ids},
+                self.manifest_folder / str(entry_id + ".pending.json"),
+            )
+            self._documents_parsed += len(documents)
+            metrics.documents += len(documents)
+            metrics.busy_seconds += time.perf_counter() - start
+
+            for batch_start in range(0, len(changed_documents), STAGE_BATCH_ROWS):
+                metrics.batches += 1
+                self._put(self._embed_queue, (entry_id, changed_documents[batch_start:batch_start + STAGE_BATCH_ROWS]), metrics)
+            # None marks the end of the taxonomy
+            self._put(self._embed_queue, (entry_id, None), metrics)
+        self._put(self._embed_queue, _END_OF_STREAM, metrics)
+
+    def _embed_stage(self):
+        metrics = self._metrics["embed"]
+        writers = {}
+        try:
+            while True:
+                item = self._get(self._embed_queue, metrics)
+                if item is _END_OF_STREAM:
+                    break
+                entry_id, documents = item
+                start = time.perf_counter()
+                if self.stage_folders and entry_id not in writers:
+                    writers[entry_id] = StageWriter(changes_path(stage_path(self.stage_folders[2], entry_id)))
+                if documents is None:
+                    # The embedded file of the taxonomy keeps all of its concepts: the changed ones are merged into it
+                    if entry_id in writers:
+                        writers.pop(entry_id).__exit__(None, None, None)
+                        merge_stage_file(stage_path(self.stage_folders[2], entry_id), id_column=CONCEPT_ID_COLUMN)
+                    metrics.busy_seconds += time.perf_counter() - start
+                    self._put(self._upload_queue, item, metrics)
+                    continue
+
+                documents, vectors = embed_with_checkpoint(documents, entry_id, self.checkpoint)
+                if not documents:
+                    metrics.busy_seconds += time.perf_counter() - start
+                    continue
+                if not self.settings.fitted and self._sample_rows < INDEX_VECTOR_SAMPLE_ROWS:
+                    self._sample.append(vectors[:INDEX_VECTOR_SAMPLE_ROWS - self._sample_rows])
+                    self._sample_rows += len(self._sample[-1])
+                vectors = self.settings.reduce(vectors)
+                if entry_id in writers:
+                    writers[entry_id].write(documents, {self.column_vector: vectors})
+                for document, vector in zip(documents, vectors.tolist()):
+                    document[self.column_vector] = vector
+                metrics.batches += 1
+                metrics.documents += len(documents)
+                metrics.busy_seconds += time.perf_counter() - start
+                self._put(self._upload_queue, (entry_id, documents), metrics)
+        finally:
+            failed = self._abort.is_set()
+            for writer in writers.values():
+                writer.__exit__(RuntimeError if failed else None, None, None)
+        self._put(self._upload_queue, _END_OF_STREAM, metrics)
+
+    def _upload_stage(self):
+        metrics = self._metrics["upload"]
+        index_client = self.index_client or GetSearchClient()
+        while True:
+            item = self._get(self._upload_queue, metrics)
+            if item is _END_OF_STREAM:
+                break
+            entry_id, documents = item
+            if documents is None or entry_id in self._failed_entries:
+                continue
+            start = time.perf_counter()
+            try:
+                summary = UploadCheckpointedDocumentsToAzure(documents, entry_id, index_client, self.checkpoint)
+            except Exception as e:
+                # The taxonomy keeps its previous manifest, so the next run uploads it again
+                logging.info(f"INDEX_PIPELINE: {entry_id} failed to upload: {e}")
+                self._failed_entries.add(entry_id)
+                metrics.busy_seconds += time.perf_counter() - start
+                continue
+            if summary["failed"]:
+                self._failed_ids.extend(document["id"] for document, _ in summary["failed"])
+                _write_dead_letters(summary["failed"], stage_path("", entry_id), self.dead_letter_path)
+            if self._first_upload_seconds is None and summary["uploaded"]:
+                self._first_upload_seconds = time.perf_counter() - self._start
+            metrics.batches += 1
+            metrics.documents += summary["uploaded"]
+            metrics.busy_seconds += time.perf_counter() - start
+
+    def _fit_vector_settings(self):
+        """
+        Fits the vector settings on the first embedded vectors of the run, when no fitted settings were saved.
+        """
+        if self.settings.fitted or not self._sample:
+            return
+        self.settings.fit(np.concatenate(self._sample))
+        logging.info(
+            f"INDEX_PIPELINE: vector settings fitted: {self.settings.output_dimensions(self.settings.source_dimensions)} dimensions, "
+            f"{self.settings.compression} compression"
+        )
+
+    def report(self) -> dict:
+        """
+        Returns the throughput of the run: documents per stage, time of each stage spent working and waiting,
+        time until the first documents were searchable and documents uploaded per second end to end.
+        """
+        total_seconds = time.perf_counter() - self._start
+        uploaded = self._metrics["upload"].documents
+        return {
+            "mode": "pipelined",
+            "workers": self.workers,
+            "queue_batches": self._embed_queue.maxsize,
+            "batch_rows": STAGE_BATCH_ROWS,
+            "taxonomies": len(self.jobs),
+            "documents_parsed": self._documents_parsed,
+            "documents_changed": self._metrics["embed"].documents,
+            "documents_uploaded": uploaded,
+            "documents_failed": len(self._failed_ids),
+            "taxonomies_failed": sorted(self._failed_entries),
+            "total_seconds": round(total_seconds, 3),
+            "time_to_first_upload_seconds": round(self._first_upload_seconds, 3) if self._first_upload_seconds is not None else None,
+            "documents_per_second": round(uploaded / total_seconds, 1) if total_seconds else None,
+            "stages": {name: metrics.as_dict(total_seconds) for name, metrics in self._metrics.items()},
+        }
+
+    def run(self) -> dict:
+        """
+        Runs the three stages until every taxonomy is uploaded.
+
+        :return: The throughput report (see report) with the upload summary expected by publish_manifests.
+        """
+        self._start = time.perf_counter()
+        # Smallest taxonomies first, so the first documents are searchable as soon as possible
+        self.jobs = sorted(self.jobs, key=lambda job: Path(job[1]).stat().st_size)
+        executor = None
+        futures = {}
+        if self.workers > 1 and len(self.jobs) > 1:
+            # The worker processes are started before the stage threads
+            executor = ProcessPoolExecutor(max_workers=min(self.workers, len(self.jobs)))
+            futures = {executor.submit(_parse_entry, ttl_path, ttl): entry_id for entry_id, ttl_path, ttl in self.jobs}
+
+        threads = [
+            threading.Thread(target=self._run_stage, args=(self._parse_stage, futures), name="index-parse"),
+            threading.Thread(target=self._run_stage, args=(self._embed_stage,), name="index-embed"),
+            threading.Thread(target=self._run_stage, args=(self._upload_stage,), name="index-upload"),
+        ]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            self._abort.set()
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+        if self._errors:
+            raise self._errors[0]
+
+        self._fit_vector_settings()
+        report = self.report()
+        report["upload_summary"] = {
+            "uploaded": report["documents_uploaded"],
+            "failed_ids": self._failed_ids,
+            "failed_files": [stage_path("", entry_id) for entry_id in self._failed_entries],
+        }
+        return report
+
+
+def create_index_pipelined(
+    input_documents_folder: str,
+    local_index_without_content_folder: str,
+    manifest_folder: str,
+    incremental: bool = True,
+    workers: int = 1,
+    stage_folders: tuple = None,
+    report_path: str = INDEX_PIPELINE_REPORT_FILE,
+    index_client=None,
+    checkpoint=None,
+) -> dict:
+    """
+    Parses, compares with the manifests, embeds and uploads the taxonomies listed in the index without content with
+    the stages overlapped (see IndexPipeline), then publishes the manifests. The index is created or updated first.
+    When the vectors are reduced by a PCA that no previous run fitted, the vectors would have to be embedded before
+    anything could be uploaded: None is returned and the staged indexation has to be used.
+
+    :param input_documents_folder: The folder containing the input documents in ttl format.
+    :param local_index_without_content_folder: The folder containing the index elements without content.
+    :param manifest_folder: The folder containing the manifests of the last successful publish.
+    :param incremental: Whether to skip the unchanged concepts (False republishes every concept).
+    :param workers: The number of worker processes used to parse the taxonomies.
+    :param stage_folders: Optional (chunked, delta, embedded) folders where the stage files are also written.
+    :param report_path: The JSON file where the throughput report is written (no file when empty).
+    :param index_client: The SearchClient of the index (created when not provided).
+    :param checkpoint: The IndexCheckpoint of the run, if any.
+    :return: The throughput report, or None when the staged indexation has to be used.
+    """
+    check_paths_exists([input_documents_folder, local_index_without_content_folder, manifest_folder])
+    settings = load_vector_settings(manifest_folder, refit=not incremental)
+    if settings.reduction == "pca" and settings.reduces and not settings.fitted:
+        logging.info("INDEX_PIPELINE: the PCA of the vector settings is not fitted yet, the staged indexation is used")
+        return None
+
+    jobs = []
+    for entry_without_content_path in sorted(Path(local_index_without_content_folder).glob("*.json")):
+        entry = read_index_element_from_path(entry_without_content_path)
+        jobs.append(
+            (
+                get_file_name_from_index_element(entry),
+                Path(input_documents_folder) / entry[INDEX_TTL_FILENAME_COLUMN],
+                entry[INDEX_TAXO_NAME_COLUMN],
+            )
+        )
+
+    logging.info("INDEX_PIPELINE: create_or_update_index_on_azure")
+    CreateOrUpdateIndexOnAzure(settings)
+    pipeline = IndexPipeline(jobs, manifest_folder, settings, incremental, workers, index_client, stage_folders, checkpoint)
+    report = pipeline.run()
+    upload_summary = report.pop("upload_summary")
+
+    if settings.fitted:
+        settings.save(Path(manifest_folder) / VECTOR_SETTINGS_FILE_NAME)
+        if stage_folders:
+            settings.save(Path(stage_folders[2]) / VECTOR_SETTINGS_FILE_NAME)
+
+    logging.info("INDEX_PIPELINE: publish_manifests")
+    publish_manifests(
+        manifest_folder, upload_summary, lambda ids: DeleteDocumentsFromAzure(ids, index_client), checkpoint
+    )
+
+    cache = get_embedding_cache()
+    if cache is not None:
+        logging.info(f"INDEX_PIPELINE: embedding cache stats: {cache.stats()}")
+    logging.info(
+        f"INDEX_PIPELINE: {report['documents_uploaded']} documents uploaded in {report['total_seconds']}s "
+        f"({report['documents_per_second']} documents/s), first upload after {report['time_to_first_upload_seconds']}s"
+    )
+    for name, stage in report["stages"].items():
+        logging.info(f"INDEX_PIPELINE: {name}: {stage}")
+    if report_path:
+        with open(report_path, "w") as file:
+            json.dump(report, file, indent=2)
+    return report
@@ -1,7 +1,9 @@
 # Import relevant libraries
 import os
 import sys
+import logging
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
 
 # Import custom functions from other folders
@@ -10,69 +12,113 @@ from utils.data_utils import (
     check_paths_exists,
     get_file_name_from_index_element,
     read_index_element_from_path,
-    push_entry_to_path,
 )
+from utils.stage_files import stage_path, write_stage_documents
 from utils.RDF import ScrapingRDF
+from utils.rdf_stream import stream_concept_documents, use_streaming
 
 load_dotenv(override=True)
 
 INDEX_TTL_FILENAME_COLUMN = os.getenv("INDEX_TTL_FILENAME_COLUMN")
 INDEX_TAXO_NAME_COLUMN = os.getenv("INDEX_TAXO_NAME_COLUMN")
+INDEX_PARALLEL_FILE_MIN_BYTES = int(os.getenv("INDEX_PARALLEL_FILE_MIN_BYTES", str(20 * 1024 * 1024)))
 
 def _create_index_of_entry_with_chunked_content(
-    ttl_path: Path, ttl: str, entry_with_chunked_content_path: Path
+    ttl_path: Path, ttl: str, entry_with_chunked_content_path: Path, workers: int = 1
 ):
     """
     Processes RDF data from a given ttl (Turtle) file and pushes the  
-    processed entry to a specified path
+    processed entry to a specified path. Files of at least TTL_STREAMING_MIN_BYTES are
+    parsed in streaming mode, with a memory footprint bounded by TTL_STREAMING_MAX_MEMORY_BYTES.
     
     :param ttl_path: The path to the ttl file containing RDF data.  
     :param ttl: The name of the ttl file in string format.  
     :param entry_with_chunked_content_path: The path where the processed entry with chunked content will be stored.  
+    :param workers: The number of worker processes used to render the concepts of the file.  
+    :return: The number of concepts written.
     """
 
-    index_entries = ScrapingRDF().ScrapeRDF({ttl_path: ttl}, [])
-    push_entry_to_path(index_entries, entry_with_chunked_content_path)
+    if use_streaming(Path(ttl_path).stat().st_size):
+        logging.info(f"INDEX_WITH_CHUNKED_CONTENT: streaming {ttl_path}")
+        return write_stage_documents(stream_concept_documents(ttl_path, ttl), entry_with_chunked_content_path)
+
+    index_entries = ScrapingRDF().ScrapeRDF({ttl_path: ttl}, [], workers=workers)
+    return write_stage_documents(index_entries, entry_with_chunked_content_path)
 
 
 def _create_index_with_chunked_content(
     input_documents_folder: Path,
     local_index_without_content_folder: Path,
     local_index_with_chunked_content_folder: Path,
+    workers: int = 1,
+    checkpoint=None,
 ):
     """
     Processes RDF data from input documents and updates index elements,  
     which initially lack content, by adding chunked content to them. The updated index  
     elements are then saved to a specified folder.
+    With several workers, files of at least INDEX_PARALLEL_FILE_MIN_BYTES are processed one at a time
+    with their concepts rendered by all the workers, then the other files are parsed side by side,
+    one per worker process.
+    Taxonomies that the checkpoint journal records as parsed from the same ttl file are not parsed again.
 
     :param input_documents_folder: The folder containing the input documents in ttl format.  
     :param local_index_without_content_folder: The folder containing index elements without content.  
     :param local_index_with_chunked_content_folder: The folder where the updated index elements with chunked content will be stored.  
+    :param workers: The number of worker processes.  
+    :param checkpoint: The IndexCheckpoint of the run, if any.  
     """
     # Get all index elements without content
-    entries_without_content_paths = local_index_without_content_folder.glob("*.json")
+    entries_without_content_paths = sorted(local_index_without_content_folder.glob("*.json"))
+    jobs = []
 
     # Iterate over all index elements without content
     for entry_without_content_path in entries_without_content_paths:
         # Read index element
         entry = read_index_element_from_path(entry_without_content_path)
         entry_id = get_file_name_from_index_element(entry)
-        entry_with_chunked_content_path = local_index_with_chunked_content_folder / str(
-            entry_id + ".json"
-        )
+        entry_with_chunked_content_path = stage_path(local_index_with_chunked_content_folder, entry_id)
 
         ttl_path = input_documents_folder / entry[INDEX_TTL_FILENAME_COLUMN]
 
         ttl = entry[INDEX_TAXO_NAME_COLUMN] #get_clean_pdf_document(ttl_path, entry)
-        _create_index_of_entry_with_chunked_content(
-            entry, ttl_path, ttl, entry_with_chunked_content_path
-        )
+        if checkpoint is not None and entry_with_chunked_content_path.exists() and checkpoint.is_parsed(entry_id, ttl_path):
+            logging.info(f"INDEX_WITH_CHUNKED_CONTENT: {entry_id} already parsed, resuming")
+            continue
+        jobs.append((ttl_path, ttl, entry_with_chunked_content_path))
+
+    def mark_parsed(job, concepts):
+        if checkpoint is not None:
+            checkpoint.mark_parsed(job[2].stem, job[0], concepts)
+
+    if workers <= 1:
+        for job in jobs:
+            mark_parsed(job, _create_index_of_entry_with_chunked_content(*job))
+        return
+
+    # Streamed files stay in this process so their memory bound holds
+    small_jobs = []
+    for job in jobs:
+        size = Path(job[0]).stat().st_size
+        if size >= INDEX_PARALLEL_FILE_MIN_BYTES or use_streaming(size):
+            mark_parsed(job, _create_index_of_entry_with_chunked_content(*job, workers=workers))
+        else:
+            small_jobs.append(job)
+
+    if small_jobs:
+        with ProcessPoolExecutor(max_workers=min(workers, len(small_jobs))) as executor:
+            # Consuming the results re-raises the errors of the workers
+            concepts = executor.map(_create_index_of_entry_with_chunked_content, *zip(*small_jobs))
+            for job, job_concepts in zip(small_jobs, concepts):
+                mark_parsed(job, job_concepts)
 
 
 def create_index_with_chunked_content(
     input_documents_folder: str,
     local_index_without_content_folder: str,
     local_index_with_content_folder: str,
+    workers: int = 1,
+    checkpoint=None,
 ):
     """
     Validates the existence of the provided folder paths, converts them  
@@ -82,6 +128,8 @@ def create_index_with_chunked_content(
     :param input_documents_folder: The path to the folder containing input documents in ttl format.  
     :param local_index_without_content_folder: The path to the folder containing index elements without content.  
     :param local_index_with_content_folder: The path to the folder where the updated index elements with chunked content will be stored.  
+    :param workers: The number of worker processes.  
+    :param checkpoint: The IndexCheckpoint of the run, if any.  
     """
     check_paths_exists(
         [
@@ -100,4 +148,6 @@ def create_index_with_chunked_content(
         input_documents_folder,
         local_index_without_content_folder,
         local_index_with_content_folder,
+        workers,
+        checkpoint,
     )
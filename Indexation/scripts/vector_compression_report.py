@@ -0,0 +1,167 @@
+# Import relevant libraries
+import os
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+import numpy as np
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Import custom functions from other folders
+from utils.stage_files import STAGE_FILE_SUFFIX, count_stage_documents, iter_stage_batches
+from utils.vector_compression import (
+    INDEX_VECTOR_OVERSAMPLING,
+    INDEX_VECTOR_SAMPLE_ROWS,
+    CompressedVectors,
+    VectorSettings,
+    normalize_rows,
+)
+
+DEFAULT_CONFIGURATIONS = [
+    "none",
+    "scalar",
+    "binary",
+    "truncate:768",
+    "truncate:512",
+    "truncate:256",
+    "pca:768",
+    "pca:512",
+    "pca:256",
+    "pca:512+scalar",
+    "pca:768+binary",
+]
+
+
+def parse_configuration(configuration: str, oversampling: float = INDEX_VECTOR_OVERSAMPLING) -> VectorSettings:
+    """
+    Reads a configuration written as [truncate|pca:<dimensions>][+][none|scalar|binary], e.g. pca:512+scalar.
+
+    :param configuration: The configuration.
+    :param oversampling: The oversampling of the binary rescoring.
+    :return: The VectorSettings (not fitted).
+    """
+    compression = "none"
+    reduction = "truncate"
+    dimensions = 0
+    for part in configuration.split("+"):
+        if ":" in part:
+            reduction, dimensions = part.split(":")
+            dimensions = int(dimensions)
+        else:
+            compression = part
+    return VectorSettings(compression, dimensions, reduction, oversampling)
+
+
+def load_embedded_vectors(folder: str, column_vector: str) -> np.ndarray:
+    """
+    Reads the vectors of every stage file of an embedded folder into one float32 matrix.
+
+    :param folder: The embedded folder, built without reduction.
+    :param column_vector: The name of the vector column.
+    :return: The matrix, one vector per row.
+    """
+    paths = sorted(Path(folder).glob("*" + STAGE_FILE_SUFFIX))
+    if not paths:
+        raise FileNotFoundError(f"No stage file found in {folder}")
+    total = sum(count_stage_documents(path) for path in paths)
+    vectors = None
+    position = 0
+    for path in paths:
+        for _, batch in iter_stage_batches(path, columns=[column_vector]):
+            matrix = batch[column_vector]
+            if vectors is None:
+                vectors = np.empty((total, matrix.shape[1]), dtype=np.float32)
+            vectors[position:position + len(matrix)] = matrix
+            position += len(matrix)
+    return vectors
+
+
+def compression_report(
+    vectors: np.ndarray,
+    configurations: list[str] = DEFAULT_CONFIGURATIONS,
+    queries: int = 200,
+    top: int = 10,
+    seed: int = 0,
+    oversampling: float = INDEX_VECTOR_OVERSAMPLING,
+) -> list[dict]:
+    """
+    Measures, for each vector configuration, the recall@top of the nearest neighbours of sampled indexed vectors
+    against the exact float32 search, and the memory taken by the stored vectors.
+
+    :param vectors: The float32 embeddings of the index, one per row, with the dimensions of the embedding model.
+    :param configurations: The configurations to measure (see parse_configuration).
+    :param queries: The number of indexed vectors used as queries (each one is excluded from its own results).
+    :param top: The number of neighbours compared.
+    :param seed: The seed of the query sample.
+    :param oversampling: The candidates per result rescored with full-precision vectors by the compressed configurations.
+    :return: One dictionary per configuration.
+    """
+    rng = np.random.default_rng(seed)
+    query_rows = rng.choice(len(vectors), size=min(queries, len(vectors)), replace=False)
+    sample = vectors[rng.choice(len(vectors), size=min(INDEX_VECTOR_SAMPLE_ROWS, len(vectors)), replace=False)]
+
+    exact = normalize_rows(vectors.copy())
+    truth = []
+    for row in query_rows:
+        scores = exact @ exact[row]
+        scores[row] = -np.inf
+        truth.append(set(np.argpartition(-scores, top)[:top].tolist()))
+    float32_bytes = exact.nbytes
+    del exact
+
+    report = []
+    for configuration in configurations:
+        settings = parse_configuration(configuration, oversampling)
+        start = time.perf_counter()
+        settings.fit(sample)
+        store = CompressedVectors.from_matrix(settings.reduce(vectors), settings)
+        build_seconds = time.perf_counter() - start
+
+        recalls = []
+        start = time.perf_counter()
+        for row, expected in zip(query_rows, truth):
+            positions, _ = store.search(settings.reduce(vectors[row]), 0, len(store), top + 1)
+            found = [position for position in positions.tolist() if position != row][:top]
+            recalls.append(len(expected.intersection(found)) / top)
+        query_seconds = time.perf_counter() - start
+
+        report.append({
+            "configuration": configuration,
+            "oversampling": settings.oversampling if settings.compression != "none" else None,
+            "dimensions": store.dimensions,
+            "bytes_per_vector": store.nbytes // len(store),
+            "vector_megabytes": round(store.nbytes / 1024 / 1024, 1),
+            "size_ratio": round(store.nbytes / float32_bytes, 4),
+            "rescoring_megabytes_on_disk": round(store.originals.nbytes / 1024 / 1024, 1) if store.originals is not None else 0,
+            f"recall@{top}": round(float(np.mean(recalls)), 4),
+            "mean_query_ms": round(1000 * query_seconds / len(query_rows), 2),
+            "build_seconds": round(build_seconds, 2),
+        })
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the recall and the size of the vector compression and reduction modes against exact float32 search."
+    )
+    parser.add_argument("folder", help="Embedded stage folder built without reduction (e.g. index_embedded).")
+    parser.add_argument("--column", default="Libelle_Definition_vector", help="Vector column.")
+    parser.add_argument("--configurations", default=",".join(DEFAULT_CONFIGURATIONS), help="Comma-separated configurations.")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--oversampling", type=float, default=INDEX_VECTOR_OVERSAMPLING)
+    parser.add_argument("--output", default=None, help="JSON file where the report is written.")
+    arguments = parser.parse_args()
+
+    report = compression_report(
+        load_embedded_vectors(arguments.folder, arguments.column),
+        arguments.configurations.split(","),
+        arguments.queries,
+        arguments.top,
+        oversampling=arguments.oversampling,
+    )
+    if arguments.output:
+        with open(arguments.output, "w") as file:
+            json.dump(report, file, indent=2)
+    print(json.dumps(report, indent=2))
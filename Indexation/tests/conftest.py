@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The modules import each other as utils.*, from the Indexation folder
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,91 @@
+import os
+
+import numpy as np
+
+import utils.index_checkpoint as index_checkpoint
+from utils.index_checkpoint import IndexCheckpoint, open_index_checkpoint
+
+
+def documents(labels):
+    return [{"id": f"T_{i}", "uri": f"http://x/{i}", "Taxonomie": "T", "Libelle_Definition": label} for i, label in enumerate(labels)]
+
+
+def reopen(checkpoint):
+    checkpoint.close()
+    return IndexCheckpoint(checkpoint.path)
+
+
+def test_parsed_source_is_reused_until_the_file_changes(tmp_path):
+    ttl = tmp_path / "T.ttl"
+    ttl.write_text("ex:a ex:b ex:c .")
+    checkpoint = IndexCheckpoint(str(tmp_path / "checkpoint.sqlite"))
+    assert not checkpoint.is_parsed("T", str(ttl))
+
+    checkpoint.mark_parsed("T", str(ttl), 1)
+    checkpoint = reopen(checkpoint)
+    assert checkpoint.is_parsed("T", str(ttl))
+
+    ttl.write_text("ex:a ex:b ex:d .")
+    os.utime(ttl, ns=(0, 0))
+    assert not checkpoint.is_parsed("T", str(ttl))
+    checkpoint.close()
+
+
+def test_resume_keeps_the_progress_of_unchanged_concepts(tmp_path):
+    checkpoint = IndexCheckpoint(str(tmp_path / "checkpoint.sqlite"))
+    batch = documents(["a", "b", "c", "d"])
+    assert checkpoint.register_delta("T", batch) == 0
+
+    vectors = np.arange(8, dtype=np.float32).reshape(4, 2)
+    checkpoint.mark_embedded("T", ["T_0", "T_1", "T_2"], vectors[:3])
+    checkpoint.mark_uploaded("T", ["T_0"])
+
+    # The run is interrupted, the next one computes the same delta but T_2 changed in between
+    checkpoint = reopen(checkpoint)
+    assert checkpoint.register_delta("T", documents(["a", "b", "changed", "d"])) == 2
+
+    ids = ["T_0", "T_1", "T_2", "T_3"]
+    assert checkpoint.uploaded_ids("T", ids) == {"T_0"}
+    embedded = checkpoint.embedded_vectors("T", ids)
+    assert sorted(embedded) == ["T_1"]
+    np.testing.assert_array_equal(embedded["T_1"], vectors[1])
+    checkpoint.close()
+
+
+def test_concepts_left_out_of_the_delta_are_forgotten(tmp_path):
+    checkpoint = IndexCheckpoint(str(tmp_path / "checkpoint.sqlite"))
+    checkpoint.register_delta("T", documents(["a", "b"]))
+    checkpoint.mark_uploaded("T", ["T_0", "T_1"])
+
+    checkpoint.register_delta("T", documents(["a"]))
+    assert checkpoint.uploaded_ids("T", ["T_0", "T_1"]) == {"T_0"}
+    checkpoint.close()
+
+
+def test_status_and_clear(tmp_path):
+    ttl = tmp_path / "T.ttl"
+    ttl.write_text("ex:a ex:b ex:c .")
+    checkpoint = IndexCheckpoint(str(tmp_path / "checkpoint.sqlite"))
+    checkpoint.mark_parsed("source", str(ttl), 3)
+    checkpoint.register_delta("T", documents(["a", "b", "c"]), source="source")
+    checkpoint.mark_embedded("T", ["T_0", "T_1"], np.zeros((2, 2), dtype=np.float32))
+    checkpoint.mark_uploaded("T", ["T_0"])
+
+    (status,) = checkpoint.status()
+    assert {key: status[key] for key in ("taxonomy", "parsed", "concepts", "to_publish", "embedded", "uploaded")} == {
+        "taxonomy": "T", "parsed": True, "concepts": 3, "to_publish": 3, "embedded": 2, "uploaded": 1,
+    }
+
+    checkpoint.clear("T")
+    assert checkpoint.status() == []
+    assert not checkpoint.is_parsed("source", str(ttl))
+    checkpoint.close()
+
+
+def test_open_index_checkpoint(tmp_path, monkeypatch):
+    checkpoint = open_index_checkpoint(str(tmp_path))
+    assert checkpoint.path == str(tmp_path / index_checkpoint.INDEX_CHECKPOINT_FILE_NAME)
+    checkpoint.close()
+
+    monkeypatch.setattr(index_checkpoint, "INDEX_CHECKPOINT", False)
+    assert open_index_checkpoint(str(tmp_path)) is None
@@ -0,0 +1,71 @@
+from utils.index_manifest import compute_delta, concept_hash, load_manifest, save_manifest
+
+
+def concept(uri, label="label"):
+    return {"uri": uri, "Taxonomie": "T", "Libelle_Definition": label}
+
+
+def test_new_concepts_get_ids_in_uri_order():
+    documents = [concept("http://x/c"), concept("http://x/a"), concept("http://x/b")]
+    changed, removed, manifest = compute_delta(documents, {"concepts": {}, "next_id": 1})
+
+    assert [document["uri"] for document in changed] == ["http://x/a", "http://x/b", "http://x/c"]
+    assert [document["id"] for document in changed] == ["T_1", "T_2", "T_3"]
+    assert removed == []
+    assert manifest["next_id"] == 4
+
+
+def test_existing_concepts_keep_their_id_and_new_ones_continue():
+    _, _, manifest = compute_delta([concept("http://x/b"), concept("http://x/d")], {"concepts": {}, "next_id": 1})
+
+    documents = [concept("http://x/a"), concept("http://x/b"), concept("http://x/d")]
+    changed, removed, manifest = compute_delta(documents, manifest)
+
+    assert {document["uri"]: document["id"] for document in documents} == {
+        "http://x/a": "T_3", "http://x/b": "T_1", "http://x/d": "T_2",
+    }
+    assert [document["uri"] for document in changed] == ["http://x/a"]
+    assert removed == []
+    assert manifest["next_id"] == 4
+
+
+def test_changed_and_removed_concepts():
+    _, _, manifest = compute_delta(
+        [concept("http://x/a"), concept("http://x/b"), concept("http://x/c")], {"concepts": {}, "next_id": 1}
+    )
+
+    changed, removed, manifest = compute_delta([concept("http://x/a", "new label"), concept("http://x/c")], manifest)
+
+    assert [(document["uri"], document["id"]) for document in changed] == [("http://x/a", "T_1")]
+    assert removed == ["T_2"]
+    assert set(manifest["concepts"]) == {"http://x/a", "http://x/c"}
+    # The id of a removed concept is not given again
+    assert manifest["next_id"] == 4
+
+
+def test_force_marks_every_concept_as_changed():
+    documents = [concept("http://x/a"), concept("http://x/b")]
+    _, _, manifest = compute_delta(documents, {"concepts": {}, "next_id": 1})
+
+    changed, removed, _ = compute_delta([concept("http://x/a"), concept("http://x/b")], manifest)
+    assert changed == [] and removed == []
+
+    changed, _, _ = compute_delta([concept("http://x/a"), concept("http://x/b")], manifest, force=True)
+    assert [document["id"] for document in changed] == ["T_1", "T_2"]
+
+
+def test_hash_ignores_the_id():
+    document = concept("http://x/a")
+    assert concept_hash(document) == concept_hash(dict(document, id="T_42"))
+    assert concept_hash(document) != concept_hash(concept("http://x/a", "other"))
+
+
+def test_manifest_round_trip(tmp_path):
+    path = tmp_path / "T.json"
+    assert load_manifest(path) == {"concepts": {}, "next_id": 1}
+
+    _, _, manifest = compute_delta([concept("http://x/a")], load_manifest(path))
+    save_manifest(manifest, path)
+
+    assert load_manifest(path) == manifest
+    assert not path.with_suffix(".json.tmp").exists()
@@ -0,0 +1,80 @@
+import io
+import re
+from pathlib import Path
+
+import pytest
+
+from benchmarks.synthetic_skos import generate_taxonomy
+from utils.RDF import ScrapingRDF
+from utils.rdf_stream import iter_turtle_statements, stream_concept_documents
+
+TAXONOMIES = Path(__file__).resolve().parents[1] / "Taxonomies"
+# rdflib names the blank nodes of a parse with a random prefix and a counter
+BLANK_NODE = re.compile(r"\bn[0-9a-f]{32}(b[0-9]+)\b")
+
+# Turtle constructs that the statement splitter has to step over: SPARQL-style prefixes, '.' inside IRIs, strings,
+# long strings and comments, blank node property lists, collections and a statement spread over several lines
+EDGE_CASES_TTL = """\
+PREFIX skos: <http://www.w3.org/2004/02/skos/core#>
+@prefix ex: <http://example.org/v1.0/> .
+
+ex:root a skos:Concept ; skos:prefLabel "Root. Top"@en , "Racine"@fr . # a comment. with dots
+ex:child a skos:Concept ;
+    skos:prefLabel "Child"@en ;
+    skos:definition \"\"\"A definition.
+On two lines; with "quotes".\"\"\"@en ;
+    skos:broader ex:root ;
+    skos:related [ skos:prefLabel "Anonymous"@en ] ;
+    skos:note ( "first." "second" ) .
+<http://example.org/v1.0/other> a skos:Concept ; skos:prefLabel 'Other'@en ; skos:related ex:child .
+"""
+
+
+def by_uri(documents):
+    # Document ids follow the parsing order; they are given again by the manifest (see compute_delta)
+    documents = [
+        {key: BLANK_NODE.sub(r"_:\1", value) for key, value in document.items() if key != "id"} for document in documents
+    ]
+    return {document["uri"]: document for document in documents}
+
+
+def graph_documents(path):
+    return ScrapingRDF().ScrapeRDF({str(path): "T"}, [], workers=1)
+
+
+def assert_same_documents(path, max_memory_bytes):
+    expected = by_uri(graph_documents(path))
+    streamed = by_uri(stream_concept_documents(str(path), "T", max_memory_bytes=max_memory_bytes))
+    assert expected
+    assert streamed == expected
+
+
+@pytest.mark.parametrize("max_memory_bytes", [64 * 1024, 256 * 1024 * 1024])
+def test_synthetic_taxonomy_matches_graph(tmp_path, max_memory_bytes):
+    path = tmp_path / "synthetic.ttl"
+    generate_taxonomy(str(path), concepts=300, seed=3)
+    assert_same_documents(path, max_memory_bytes)
+
+
+def test_real_taxonomy_matches_graph():
+    assert_same_documents(TAXONOMIES / "nace2_1_en_fr.ttl", 64 * 1024)
+
+
+def test_edge_cases_match_graph(tmp_path):
+    path = tmp_path / "edge_cases.ttl"
+    path.write_text(EDGE_CASES_TTL, encoding="utf-8")
+    assert_same_documents(path, 64 * 1024)
+
+
+def test_file_object_source(tmp_path):
+    path = tmp_path / "edge_cases.ttl"
+    path.write_text(EDGE_CASES_TTL, encoding="utf-8")
+    streamed = by_uri(stream_concept_documents(io.BytesIO(EDGE_CASES_TTL.encode("utf-8")), "T"))
+    assert streamed == by_uri(graph_documents(path))
+
+
+def test_statements_split_outside_strings_and_comments():
+    statements = list(iter_turtle_statements(io.StringIO(EDGE_CASES_TTL)))
+    assert len(statements) == 5
+    assert statements[0] == "PREFIX skos: <http://www.w3.org/2004/02/skos/core#>"
+    assert "On two lines" in statements[3]
@@ -0,0 +1,121 @@
+import numpy as np
+
+from utils.stage_files import (
+    StageWriter, changes_path, count_stage_documents, iter_stage_batches, iter_stage_documents,
+    merge_stage_file, read_stage_documents, write_stage_documents,
+)
+
+
+def documents(start, stop):
+    return [{"id": f"T_{i}", "uri": f"http://x/{i}", "Libelle_Definition": f"concept {i}"} for i in range(start, stop)]
+
+
+def vectors(start, stop, dimensions=4):
+    return np.arange(start * dimensions, stop * dimensions, dtype=np.float32).reshape(-1, dimensions) / 7
+
+
+def write(path, start, stop, batch_rows):
+    with StageWriter(path) as writer:
+        for batch_start in range(start, stop, batch_rows):
+            batch_stop = min(batch_start + batch_rows, stop)
+            writer.write(documents(batch_start, batch_stop), {"Vector": vectors(batch_start, batch_stop)})
+    return writer.rows
+
+
+def test_round_trip_over_several_batches(tmp_path):
+    path = tmp_path / "T.parquet"
+    assert write(path, 0, 10, batch_rows=4) == 10
+    assert count_stage_documents(path) == 10
+
+    read_documents, read_vectors = [], []
+    for batch, batch_vectors in iter_stage_batches(path, batch_rows=3):
+        assert len(batch) <= 3
+        read_documents.extend(batch)
+        read_vectors.append(batch_vectors["Vector"])
+
+    assert read_documents == documents(0, 10)
+    matrix = np.concatenate(read_vectors)
+    assert matrix.dtype == np.float32
+    np.testing.assert_array_equal(matrix, vectors(0, 10))
+
+
+def test_read_text_fields_and_columns(tmp_path):
+    path = tmp_path / "T.parquet"
+    write(path, 0, 5, batch_rows=2)
+
+    assert read_stage_documents(path) == documents(0, 5)
+    assert read_stage_documents(path, columns=["id"]) == [{"id": f"T_{i}"} for i in range(5)]
+
+
+def test_vectors_put_back_in_documents(tmp_path):
+    path = tmp_path / "T.parquet"
+    write(path, 0, 3, batch_rows=3)
+
+    (batch,) = list(iter_stage_documents(path))
+    assert [document["id"] for document in batch] == ["T_0", "T_1", "T_2"]
+    assert batch[1]["Vector"] == vectors(0, 3)[1].tolist()
+
+
+def test_write_from_a_generator(tmp_path):
+    path = tmp_path / "T.parquet"
+    assert write_stage_documents(iter(documents(0, 7)), path, batch_rows=3) == 7
+    assert read_stage_documents(path) == documents(0, 7)
+
+
+def test_empty_writer_leaves_no_file(tmp_path):
+    path = tmp_path / "T.parquet"
+    write(path, 0, 3, batch_rows=3)
+
+    assert write_stage_documents([], path) == 0
+    assert not path.exists()
+    assert not path.with_suffix(".tmp").exists()
+
+
+def test_failed_write_keeps_the_previous_file(tmp_path):
+    path = tmp_path / "T.parquet"
+    write(path, 0, 3, batch_rows=3)
+
+    try:
+        with StageWriter(path) as writer:
+            writer.write(documents(10, 12), {"Vector": vectors(10, 12)})
+            raise RuntimeError("interrupted")
+    except RuntimeError:
+        pass
+
+    assert read_stage_documents(path) == documents(0, 3)
+    assert not path.with_suffix(".tmp").exists()
+
+
+def test_merge_replaces_adds_and_removes_rows(tmp_path):
+    path = tmp_path / "T.parquet"
+    write(path, 0, 6, batch_rows=4)
+
+    changed = [dict(document, Libelle_Definition="changed") for document in documents(2, 3)] + documents(6, 8)
+    changed_vectors = np.concatenate([np.full((1, 4), -1, dtype=np.float32), vectors(6, 8)])
+    with StageWriter(changes_path(path)) as writer:
+        writer.write(changed, {"Vector": changed_vectors})
+
+    merge_stage_file(path, removed_ids=["T_4"])
+
+    assert not changes_path(path).exists()
+    merged = {}
+    for batch, batch_vectors in iter_stage_batches(path):
+        for document, vector in zip(batch, batch_vectors["Vector"]):
+            merged[document["id"]] = (document["Libelle_Definition"], vector.tolist())
+
+    assert sorted(merged) == ["T_0", "T_1", "T_2", "T_3", "T_5", "T_6", "T_7"]
+    assert merged["T_2"] == ("changed", [-1.0] * 4)
+    assert merged["T_3"] == ("concept 3", vectors(0, 6)[3].tolist())
+    assert merged["T_7"] == ("concept 7", vectors(6, 8)[1].tolist())
+
+
+def test_merge_without_changes_only_removes(tmp_path):
+    path = tmp_path / "T.parquet"
+    write(path, 0, 3, batch_rows=3)
+    modified = path.stat().st_mtime_ns
+
+    merge_stage_file(path)
+    assert path.stat().st_mtime_ns == modified
+
+    merge_stage_file(path, removed_ids=["T_0"])
+    assert [document["id"] for document in read_stage_documents(path)] == ["T_1", "T_2"]
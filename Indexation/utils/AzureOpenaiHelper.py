@@ -7,6 +7,11 @@ from tenacity import retry, wait_random_exponential, stop_after_attempt
 
 from dotenv import load_dotenv
 
+from utils.embedding_cache import get_embedding_cache
+from utils.embedding_scheduler import EmbeddingScheduler
+from utils.rate_limits import estimate_tokens
+from utils.instrumentation import record_api_calls
+
 load_dotenv(override=True)
 
 AZURE_OPENAI_API_KEY = os.environ.get("AZURE_OPENAI_API_KEY")
@@ -15,6 +20,27 @@ AZURE_OPENAI_EMBEDDING_API_VERSION = os.environ.get(
     "AZURE_OPENAI_EMBEDDING_API_VERSION"
 )
 AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
+EMBEDDING_BATCH_MAX_INPUTS = int(os.getenv("EMBEDDING_BATCH_MAX_INPUTS", "256"))
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "100000"))
+
+_client = None
+
+
+def _get_client() -> AzureOpenAI:
+    """
+    Return the Azure OpenAI client shared by all the synchronous embedding requests of the process,
+    so its connection pool is reused instead of opening a new connection per text.
+
+    :return: The shared AzureOpenAI client.
+    """
+    global _client
+    if _client is None:
+        _client = AzureOpenAI(
+            api_key=AZURE_OPENAI_API_KEY,
+            api_version=AZURE_OPENAI_EMBEDDING_API_VERSION,
+            azure_endpoint=AZURE_OPENAI_ENDPOINT,
+        )
+    return _client
 
 
 def _normalize_text(s):
@@ -36,22 +62,17 @@ def _normalize_text(s):
 
 
 @retry(wait=wait_random_exponential(min=1, max=10), stop=stop_after_attempt(3))
-def _get_embedding(text: str) -> list:
+def _request_embedding(text: str) -> list:
     """
-    Retrieve the embedding for the given text using the Azure OpenAI API. This function uses the Azure OpenAI API to generate embeddings for the input text.  
-    It retries the request with exponential backoff in case of failure.  
+    Request the embedding for the given text from the Azure OpenAI API.
+    It retries the request with exponential backoff in case of failure.
   
     :param text: The text to retrieve the embedding for.  
     :return: The embedding for the given text.  
     """
     try:
-        client = AzureOpenAI(
-            api_key=AZURE_OPENAI_API_KEY,
-            api_version=AZURE_OPENAI_EMBEDDING_API_VERSION,
-            azure_endpoint=AZURE_OPENAI_ENDPOINT,
-        )
-
-        response = client.embeddings.create(
+        record_api_calls("embeddings", 1)
+        response = _get_client().embeddings.create(
             input=text, model=AZURE_OPENAI_EMBEDDING_DEPLOYMENT
         )
         return response.data[0].embedding
@@ -62,6 +83,26 @@ def _get_embedding(text: str) -> list:
         )
 
 
+def _get_embedding(text: str) -> list:
+    """
+    Retrieve the embedding for the given text, from the embedding cache when possible and
+    from the Azure OpenAI API otherwise.
+
+    :param text: The text to retrieve the embedding for.
+    :return: The embedding for the given text.
+    """
+    cache = get_embedding_cache()
+    if cache is not None:
+        embedding = cache.get(text, AZURE_OPENAI_EMBEDDING_DEPLOYMENT)
+        if embedding is not None:
+            return embedding
+
+    embedding = _request_embedding(text)
+    if cache is not None:
+        cache.put(text, embedding, AZURE_OPENAI_EMBEDDING_DEPLOYMENT)
+    return embedding
+
+
 def text_to_embedding(text: str) -> list:
     """
     Retrieves the embedding for the given text using the Azure OpenAI API.
@@ -72,3 +113,67 @@ def text_to_embedding(text: str) -> list:
     text = _normalize_text(text)
     embedding = _get_embedding(text)
     return embedding
+
+
+def _split_into_batches(
+    texts: list[str],
+    max_inputs: int = EMBEDDING_BATCH_MAX_INPUTS,
+    max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS,
+) -> list[list[int]]:
+    """
+    Group the positions of the texts into batches respecting both the maximum number of inputs
+    and the maximum (estimated) number of tokens per embeddings request.
+
+    :param texts: The texts to group.
+    :param max_inputs: The maximum number of texts in one batch.
+    :param max_tokens: The maximum estimated number of tokens in one batch.
+    :return: A list of batches, each batch being a list of positions in texts.
+    """
+    batches = []
+    batch = []
+    batch_tokens = 0
+    for position, text in enumerate(texts):
+        tokens = estimate_tokens(text)
+        if batch and (len(batch) >= max_inputs or batch_tokens + tokens > max_tokens):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append(position)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def texts_to_embeddings(texts: list[str]) -> list[list]:
+    """
+    Retrieves the embeddings for a list of texts using the Azure OpenAI API.
+    The texts are normalized, looked up in the embedding cache, and the remaining ones are
+    packed into as few requests as the input and token limits allow. The requests are sent
+    concurrently by the EmbeddingScheduler within the configured rate limits.
+
+    :param texts: The texts to retrieve the embeddings for.
+    :return: The embeddings, in the same order as the input texts.
+    """
+    texts = [_normalize_text(text) for text in texts]
+    cache = get_embedding_cache()
+    if cache is not None:
+        embeddings = cache.get_many(texts, AZURE_OPENAI_EMBEDDING_DEPLOYMENT)
+    else:
+        embeddings = [None] * len(texts)
+
+    missing = [position for position, embedding in enumerate(embeddings) if embedding is None]
+    missing_texts = [texts[position] for position in missing]
+    batches = _split_into_batches(missing_texts)
+    batches_texts = [[missing_texts[position] for position in batch] for batch in batches]
+
+    def on_batch_done(batch_position, batch_embeddings):
+        for position, embedding in zip(batches[batch_position], batch_embeddings):
+            embeddings[missing[position]] = embedding
+        # Cached as soon as they are received, so a failure later in the run loses nothing
+        if cache is not None:
+            cache.put_many(batches_texts[batch_position], batch_embeddings, AZURE_OPENAI_EMBEDDING_DEPLOYMENT)
+
+    if batches_texts:
+        EmbeddingScheduler().run(batches_texts, on_batch_done)
+    return embeddings
@@ -1,10 +1,18 @@
 # Import relevant libraries
 import os
 import json
+import time
+import random
 import pathlib
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tenacity import retry, wait_random_exponential, stop_after_attempt
 from dotenv import load_dotenv
+from utils.stage_files import STAGE_FILE_SUFFIX, iter_stage_documents, read_stage_documents, stage_path
+from utils.instrumentation import record_api_calls
+from utils.vector_compression import VectorSettings
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents import SearchClient
 from azure.search.documents.indexes.models import (
@@ -14,16 +22,18 @@ from azure.search.documents.indexes.models import (
     SearchFieldDataType,
     SemanticField,
     VectorSearchProfile,
-    SemanticSettings,
-    VectorSearchAlgorithmKind,
-    HnswVectorSearchAlgorithmConfiguration,
+    SemanticSearch,
+    HnswAlgorithmConfiguration,
     SemanticConfiguration,
     SearchIndex,
-    PrioritizedFields,
+    SemanticPrioritizedFields,
     VectorSearch,
     AzureOpenAIVectorizer,
-    AzureOpenAIParameters,
+    AzureOpenAIVectorizerParameters,
     HnswParameters,
+    ScalarQuantizationCompression,
+    ScalarQuantizationParameters,
+    BinaryQuantizationCompression,
 )
 
 
@@ -40,13 +50,58 @@ AZURE_OPENAI_EMBEDDING_API_VERSION = os.environ.get(
     "AZURE_OPENAI_EMBEDDING_API_VERSION"
 )
 AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
+# The model of the deployment, required by the vectorizer (text-embedding-ada-002, text-embedding-3-small or -large)
+AZURE_OPENAI_EMBEDDING_MODEL = os.getenv("AZURE_OPENAI_EMBEDDING_MODEL", AZURE_OPENAI_EMBEDDING_DEPLOYMENT)
 
+# Azure AI Search accepts at most 1000 documents and 16 MB per indexing request
+UPLOAD_BATCH_MAX_DOCUMENTS = int(os.getenv("UPLOAD_BATCH_MAX_DOCUMENTS", "500"))
+UPLOAD_BATCH_MAX_BYTES = int(os.getenv("UPLOAD_BATCH_MAX_BYTES", str(8 * 1024 * 1024)))
+UPLOAD_MAX_WORKERS = int(os.getenv("UPLOAD_MAX_WORKERS", "8"))
+UPLOAD_BATCH_MAX_RETRIES = int(os.getenv("UPLOAD_BATCH_MAX_RETRIES", "6"))
+UPLOAD_DEAD_LETTER_FILE = os.getenv("UPLOAD_DEAD_LETTER_FILE", "failed_uploads.jsonl")
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "1536"))
 
-def CreateOrUpdateIndexOnAzure():
+
+def _vector_compressions(vector_settings: VectorSettings) -> list:
+    """
+    Returns the compression configuration of the vector field: none, int8 scalar quantization or binary quantization,
+    both rescoring the oversampled candidates with the original vectors.
+
+    :param vector_settings: The vector settings of the index.
+    :return: The list of compressions of the vector search configuration.
+    """
+    if vector_settings.compression == "scalar":
+        return [
+            ScalarQuantizationCompression(
+                compression_name="myCompression",
+                rerank_with_original_vectors=True,
+                default_oversampling=vector_settings.oversampling,
+                parameters=ScalarQuantizationParameters(quantized_data_type="int8"),
+            )
+        ]
+    if vector_settings.compression == "binary":
+        return [
+            BinaryQuantizationCompression(
+                compression_name="myCompression",
+                rerank_with_original_vectors=True,
+                default_oversampling=vector_settings.oversampling,
+            )
+        ]
+    return []
+
+
+def CreateOrUpdateIndexOnAzure(vector_settings: VectorSettings = None):
     """
     Create or update a search index on Azure Search service. This function configures and creates (or updates) a search index on Azure Search service,  
     including fields, vector search configurations, and semantic configurations.  
+    The dimensions and the compression of the vector field follow the vector settings. Reduced vectors are not produced
+    by the embedding model, so the vectorizer is then left out of the vector profile.
+
+    :param vector_settings: The vector settings returned by the embedding step (default: float32 vectors of EMBEDDING_DIMENSIONS).
     """
+    vector_settings = vector_settings or VectorSettings()
+    dimensions = vector_settings.output_dimensions(vector_settings.source_dimensions or EMBEDDING_DIMENSIONS)
+    compressions = _vector_compressions(vector_settings)
     IndexClient = SearchIndexClient(
         endpoint=AZURE_SEARCH_SERVICE_ENDPOINT, credential=credential
     )
@@ -67,32 +122,37 @@ def CreateOrUpdateIndexOnAzure():
             name="Libelle_Definition_vector",
             type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
             searchable=True,
-            vector_search_dimensions=1536,
-            vector_search_profile="myHnswProfile",
+            vector_search_dimensions=dimensions,
+            vector_search_profile_name="myHnswProfile",
         ),
     ]
 
-    # Configure the vector search configuration
+    # Configure the vector search configuration (GA API of azure-search-documents 11.5)
     vector_search = VectorSearch(
         algorithms=[
-            HnswVectorSearchAlgorithmConfiguration(
+            HnswAlgorithmConfiguration(
                 name="myHnsw",
-                kind=VectorSearchAlgorithmKind.HNSW,
                 parameters=HnswParameters(
                     m=4, ef_construction=400, ef_search=500, metric="cosine"
                 ),
             ),
         ],
         profiles=[
-            VectorSearchProfile(name="myHnswProfile", algorithm="myHnsw", vectorizer="myVectorizer"),
+            VectorSearchProfile(
+                name="myHnswProfile",
+                algorithm_configuration_name="myHnsw",
+                vectorizer_name=None if vector_settings.reduces else "myVectorizer",
+                compression_name="myCompression" if compressions else None,
+            ),
         ],
+        compressions=compressions,
         vectorizers=[
         AzureOpenAIVectorizer(
-            name="myVectorizer",
-            azure_open_ai_parameters=AzureOpenAIParameters(
-                resource_uri=AZURE_OPENAI_ENDPOINT,
-                deployment_id = AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
-                model_name=AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
+            vectorizer_name="myVectorizer",
+            parameters=AzureOpenAIVectorizerParameters(
+                resource_url=AZURE_OPENAI_ENDPOINT,
+                deployment_name=AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
+                model_name=AZURE_OPENAI_EMBEDDING_MODEL,
                 api_key=AZURE_OPENAI_API_KEY
             )
         )
@@ -101,21 +161,21 @@ def CreateOrUpdateIndexOnAzure():
 
     semantic_config = SemanticConfiguration(
         name="openai-poc-semantic-config",
-        prioritized_fields=PrioritizedFields(
+        prioritized_fields=SemanticPrioritizedFields(
             title_field=SemanticField(field_name="Libelle_Definition"),
-            prioritized_content_fields=[SemanticField(field_name="Libelle_Definition"), SemanticField(field_name="Parents")],
+            content_fields=[SemanticField(field_name="Libelle_Definition"), SemanticField(field_name="Parents")],
         ),
     )
 
-    # # Create the semantic settings with the configuration
-    semantic_settings = SemanticSettings(configurations=[semantic_config])
+    # # Create the semantic search with the configuration
+    semantic_search = SemanticSearch(configurations=[semantic_config])
 
-    # Create the search index with the semantic settings
+    # Create the search index with the semantic search
     index = SearchIndex(
         name=AZURE_SEARCH_INDEX_NAME,
         fields=fields,
         vector_search=vector_search,
-        semantic_settings=semantic_settings,
+        semantic_search=semantic_search,
     )
     result = IndexClient.create_or_update_index(index)
     logging.info(f" {result.name} created")
@@ -135,28 +195,238 @@ def GetSearchClient():
     )
 
 
-def UploadIndexToAzure(FolderPath: str):
+def _split_documents_into_batches(documents: list[dict]) -> list[list[dict]]:
+    """
+    Group documents into upload batches respecting both the maximum number of documents
+    and the maximum payload size of an indexing request.
+
+    :param documents: The documents to upload.
+    :return: A list of batches of documents.
+    """
+    batches = []
+    batch = []
+    batch_bytes = 0
+    for document in documents:
+        document_bytes = len(json.dumps(document))
+        if batch and (
+            len(batch) >= UPLOAD_BATCH_MAX_DOCUMENTS
+            or batch_bytes + document_bytes > UPLOAD_BATCH_MAX_BYTES
+        ):
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(document)
+        batch_bytes += document_bytes
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _retry_after_seconds(error: Exception) -> float:
+    """
+    Reads the delay requested by the service in the headers of a throttled response.
+
+    :param error: The error raised by the SearchClient.
+    :return: The number of seconds to wait, or None when the response has no such header.
+    """
+    response = getattr(error, "response", None)
+    headers = response.headers if response is not None else {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def _is_transient(error: Exception) -> bool:
+    return isinstance(error, ServiceRequestError) or isinstance(error, ServiceResponseError) or (
+        isinstance(error, HttpResponseError) and error.status_code is not None
+        and (error.status_code == 429 or error.status_code >= 500)
+    )
+
+
+def _upload_batch(index_client: SearchClient, batch: list[dict]) -> tuple[list[dict], list[tuple]]:
+    """
+    Upload one batch of documents in a single indexing request. The request is sent again on throttling (429),
+    server errors and timeouts, after the delay given by the Retry-After headers or an exponential backoff.
+
+    :param index_client: The SearchClient of the index.
+    :param batch: The documents of the batch.
+    :return: The documents of the batch that the service did not index, to retry individually, and the
+        documents of a batch that could not be sent, as (document, error) tuples.
+    """
+    for attempt in range(UPLOAD_BATCH_MAX_RETRIES + 1):
+        try:
+            record_api_calls("search", 1, retries=1 if attempt else 0)
+            results = index_client.merge_or_upload_documents(documents=batch)
+            break
+        except Exception as e:
+            if attempt == UPLOAD_BATCH_MAX_RETRIES or not _is_transient(e):
+                logging.info(f"Batch of {len(batch)} documents failed: {e}")
+                return [], [(document, str(e)) for document in batch]
+            delay = _retry_after_seconds(e) or random.uniform(1, min(2 ** attempt, 30))
+            logging.warning(f"Batch of {len(batch)} documents failed, sending it again in {delay:.1f}s: {e}")
+            time.sleep(delay)
+
+    failed_keys = {result.key for result in results if not result.succeeded}
+    return [document for document in batch if document["id"] in failed_keys], []
+
+
+@retry(wait=wait_random_exponential(min=1, max=10), stop=stop_after_attempt(3), reraise=True)
+def _upload_document(index_client: SearchClient, document: dict):
+    """
+    Upload a single document, retrying with exponential backoff in case of failure.
+
+    :param index_client: The SearchClient of the index.
+    :param document: The document to upload.
+    """
+    record_api_calls("search", 1, retries=1)
+    result = index_client.merge_or_upload_documents(documents=[document])[0]
+    if not result.succeeded:
+        raise Exception(f"{result.status_code}: {result.error_message}")
+
+
+def UploadDocumentsToAzure(documents: list[dict], index_client: SearchClient = None) -> dict:
+    """
+    Upload documents to Azure Search service in batches over a bounded thread pool. A batch is sent again on
+    transient errors, and only the documents the service did not index are retried individually.
+
+    :param documents: The documents to upload.
+    :param index_client: The SearchClient of the index (created when not provided).
+    :return: A dictionary with the number of uploaded documents and the list of permanent failures as (document, error) tuples.
+    """
+    index_client = index_client or GetSearchClient()
+    batches = _split_documents_into_batches(documents)
+    retry_documents = []
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_MAX_WORKERS) as executor:
+        futures = [executor.submit(_upload_batch, index_client, batch) for batch in batches]
+        for future in as_completed(futures):
+            rejected, batch_failed = future.result()
+            retry_documents.extend(rejected)
+            failed.extend(batch_failed)
+
+    for document in retry_documents:
+        try:
+            _upload_document(index_client, document)
+        except Exception as e:
+            failed.append((document, str(e)))
+
+    return {
+        "uploaded": len(documents) - len(failed),
+        "failed": failed,
+        "batches": len(batches),
+        "retried": len(retry_documents),
+    }
+
+
+def UploadCheckpointedDocumentsToAzure(
+    documents: list[dict], taxonomy: str, index_client: SearchClient = None, checkpoint=None
+) -> dict:
+    """
+    Upload documents of a taxonomy (see UploadDocumentsToAzure), skipping the ones the checkpoint journal records
+    as uploaded and journaling the ones uploaded now.
+
+    :param documents: The documents to upload.
+    :param taxonomy: The id of the taxonomy of the documents.
+    :param index_client: The SearchClient of the index (created when not provided).
+    :param checkpoint: The IndexCheckpoint of the run, if any.
+    :return: The summary of UploadDocumentsToAzure.
     """
-    Upload index documents from the specified folder to Azure Search service. This function reads JSON files from the specified folder and uploads the index  
-    documents to Azure Search service.  
+    if checkpoint is None:
+        return UploadDocumentsToAzure(documents, index_client)
+    done = checkpoint.uploaded_ids(taxonomy, [document["id"] for document in documents])
+    documents = [document for document in documents if document["id"] not in done]
+    if not documents:
+        return {"uploaded": 0, "failed": [], "batches": 0, "retried": 0}
+    summary = UploadDocumentsToAzure(documents, index_client)
+    failed_ids = {document["id"] for document, _ in summary["failed"]}
+    checkpoint.mark_uploaded(taxonomy, [document["id"] for document in documents if document["id"] not in failed_ids])
+    return summary
+
+
+def DeleteDocumentsFromAzure(document_ids: list[str], index_client: SearchClient = None):
+    """
+    Delete documents from Azure Search service by id, in batches.
+
+    :param document_ids: The ids of the documents to delete.
+    :param index_client: The SearchClient of the index (created when not provided).
+    """
+    index_client = index_client or GetSearchClient()
+    for start in range(0, len(document_ids), UPLOAD_BATCH_MAX_DOCUMENTS):
+        batch = document_ids[start:start + UPLOAD_BATCH_MAX_DOCUMENTS]
+        record_api_calls("search", 1)
+        index_client.delete_documents(documents=[{"id": document_id} for document_id in batch])
+
+
+def _write_dead_letters(failed: list[tuple], entry_path, dead_letter_path: str):
+    """
+    Append the documents that could not be uploaded to the dead-letter file (one JSON object per line).
+
+    :param failed: The (document, error) tuples of the permanent failures.
+    :param entry_path: The index file the documents come from.
+    :param dead_letter_path: The path of the dead-letter file.
+    """
+    with open(dead_letter_path, "a") as file:
+        for document, error in failed:
+            file.write(json.dumps({"file": str(entry_path), "error": error, "document": document}) + "\n")
+
+
+def UploadIndexToAzure(FolderPath: str, dead_letter_path: str = UPLOAD_DEAD_LETTER_FILE, checkpoint=None, delta_folder: str = None):
+    """
+    Upload index documents from the specified folder to Azure Search service. This function reads the stage files of the specified folder
+    row batch by row batch and uploads the index documents to Azure Search service in batches. Documents that still fail after being
+    retried individually are written to a dead-letter file. With a checkpoint journal, the uploaded documents are
+    journaled batch by batch and the ones an interrupted run already uploaded are skipped. With a delta folder, only
+    the documents of its stage files (the concepts added or changed by the run) are uploaded.
   
-    :param FolderPath: The path to the folder containing index documents in JSON format.  
+    :param FolderPath: The path to the folder containing index documents in stage files (Parquet).  
+    :param dead_letter_path: The path of the file where the documents that could not be uploaded are written.
+    :param checkpoint: The IndexCheckpoint of the run, if any.
+    :param delta_folder: The folder of the added or changed documents, if only they are to be uploaded.
+    :return: A dictionary with the number of uploaded documents, the ids written to the dead-letter file and the files that could not be read.
     """
     index_client = GetSearchClient()
-    index_entry_paths = pathlib.Path(FolderPath).glob("*")
+    index_entry_paths = pathlib.Path(FolderPath).glob("*" + STAGE_FILE_SUFFIX)
     failed_to_upload = []
+    uploaded = 0
+    failed_ids = []
+    start = time.perf_counter()
+
     for entry_path in index_entry_paths:
+        delta_ids = None
+        if delta_folder is not None:
+            delta_path = stage_path(delta_folder, entry_path.stem)
+            if not delta_path.exists():
+                continue
+        logging.info(f"Uploading documents from {entry_path}")
         try:
-            with open(entry_path) as file:
-                index_list = json.load(file)
-                for index in index_list:
-                    # if not is_document_in_azure(index["id"]):
-                    logging.info(f"Uploading {index['id']}")
-                    index_client.upload_documents(documents=[index])
+            if delta_folder is not None:
+                delta_ids = {document["id"] for document in read_stage_documents(delta_path, columns=["id"])}
+            for index_list in iter_stage_documents(entry_path):
+                if delta_ids is not None:
+                    index_list = [document for document in index_list if document["id"] in delta_ids]
+                    if not index_list:
+                        continue
+                summary = UploadCheckpointedDocumentsToAzure(index_list, entry_path.stem, index_client, checkpoint)
+                uploaded += summary["uploaded"]
+                if summary["failed"]:
+                    failed_ids.extend(document["id"] for document, _ in summary["failed"])
+                    _write_dead_letters(summary["failed"], entry_path, dead_letter_path)
         except Exception as e:
             logging.info(entry_path)
             logging.info(e)
-            # raise e
             failed_to_upload.append(entry_path)
 
+    elapsed = time.perf_counter() - start
+    logging.info(
+        f"Uploaded {uploaded} documents in {elapsed:.1f}s ({uploaded / elapsed if elapsed else 0:.1f} documents/s), "
+        f"{len(failed_ids)} written to {dead_letter_path}"
+    )
     logging.info(failed_to_upload)
+
+    return {"uploaded": uploaded, "failed_ids": failed_ids, "failed_files": failed_to_upload}
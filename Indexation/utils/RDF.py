@@ -12,10 +12,63 @@ from dotenv import load_dotenv
 import ast
 import os
 import re
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from typing import Any, Dict, Iterable, Iterator, List, Optional
 
 load_dotenv(override=True)
 
+INDEX_PARALLEL_MIN_CONCEPTS = int(os.getenv("INDEX_PARALLEL_MIN_CONCEPTS", "5000"))
+
+SKOS_PREF_LABEL = SKOS.prefLabel
+SKOS_ALT_LABEL = SKOS.altLabel
+SKOS_DEFINITION = SKOS.definition
+SKOS_RELATED = SKOS.related
+SKOS_BROADER = SKOS.broader
+SKOS_NARROWER = SKOS.narrower
+
+
+def _group_literals_by_language(objects):
+    """
+    Groups the literal objects of a predicate by language tag ('default' when untagged).
+
+    :param objects: The objects of a predicate, in the order of the graph.
+    :return: A dictionary {language: [texts]}.
+    """
+    labels = {}
+    for obj in objects:
+        if isinstance(obj, Literal):
+            lang = obj.language if obj.language else 'default'
+            if lang not in labels:
+                labels[lang] = []
+            labels[lang].append(str(obj))
+    return labels
+
+
+class ConceptTable():
+    """
+    The triples of the concepts of an RDF graph, walked once.
+
+    Attributes:
+    - predicates: {concept: {predicate: [objects]}} in the order of the graph.
+    - pref_labels: {concept: {language: [prefLabels]}}, the labels used to describe the neighbours of a concept.
+    """
+    def __init__(self) -> None:
+        self.predicates = {}
+        self.pref_labels = {}
+
+    def update(self, other):
+        """
+        Adds the concepts of another table to this one.
+
+        :param other: The ConceptTable to merge.
+        """
+        self.predicates.update(other.predicates)
+        self.pref_labels.update(other.pref_labels)
+
+
 class ScrapingRDF():
     """  
     A class to scrape and process RDF data.  
@@ -34,7 +87,34 @@ class ScrapingRDF():
     def __init__(self) -> None:
         pass
 
-    def extract_concept_info(self, graph, concept_uri):  
+    def build_concept_table(self, graph, concept_uris=None):
+        """
+        Walks the triples of every concept once and groups their objects by predicate.
+
+        The labels of the neighbours of a concept are then read from the prefLabel map of the
+        table instead of querying the graph again for every neighbour.
+
+        :param graph: The RDF graph to extract information from.
+        :param concept_uris: The concepts to include (default: every subject having a prefLabel).
+        :return: The ConceptTable of the concepts.
+        """
+        if concept_uris is None:
+            concept_uris = graph.subjects(predicate=SKOS_PREF_LABEL, unique=True)
+
+        concept_table = ConceptTable()
+        for concept in concept_uris:
+            predicates = {}
+            for predicate, obj in graph.predicate_objects(concept):
+                if predicate not in predicates:
+                    predicates[predicate] = []
+                predicates[predicate].append(obj)
+            concept_table.predicates[concept] = predicates
+            concept_table.pref_labels[concept] = _group_literals_by_language(
+                predicates.get(SKOS_PREF_LABEL, [])
+            )
+        return concept_table
+
+    def extract_concept_info(self, graph, concept_uri, concept_table=None):  
         """
         Extracts information about a concept from the RDF graph.  
   
@@ -44,48 +124,44 @@ class ScrapingRDF():
   
         :param graph: The RDF graph to extract information from.  
         :param concept_uri: The URI of the concept to extract information for.  
+        :param concept_table: The ConceptTable built by build_concept_table (default: built for the concept and its neighbours).  
   
         :return: A dictionary containing the extracted concept information.  
         """
         concept = URIRef(concept_uri)  
+
+        if concept_table is None:
+            concept_table = self.build_concept_table(graph, [concept])
+            neighbours = [
+                entity
+                for predicate in (SKOS_RELATED, SKOS_BROADER, SKOS_NARROWER)
+                for entity in concept_table.predicates[concept].get(predicate, [])
+            ]
+            concept_table.update(self.build_concept_table(graph, neighbours))
+
+        predicates = concept_table.predicates.get(concept, {})
         
-        def get_labels_and_definitions(predicate):  
-            labels = {}  
-            for obj in graph.objects(concept, predicate):  
-                if isinstance(obj, Literal):  
-                    lang = obj.language if obj.language else 'default'  
-                    if lang not in labels:  
-                        labels[lang] = []  
-                    labels[lang].append(str(obj))  
-            return labels  
-        
-        pref_labels = get_labels_and_definitions(SKOS.prefLabel)  
-        alt_labels = get_labels_and_definitions(SKOS.altLabel)  
-        definitions = get_labels_and_definitions(SKOS.definition)  
-        
-        related_entities = list(graph.objects(concept, SKOS.related))  
-        broader_entities = list(graph.objects(concept, SKOS.broader))  
-        narrower_entities = list(graph.objects(concept, SKOS.narrower))  
+        pref_labels = _group_literals_by_language(predicates.get(SKOS_PREF_LABEL, []))  
+        alt_labels = _group_literals_by_language(predicates.get(SKOS_ALT_LABEL, []))  
+        definitions = _group_literals_by_language(predicates.get(SKOS_DEFINITION, []))  
         
         def get_related_labels(entities):  
             related_labels = {}  
             for entity in entities:  
-                for obj in graph.objects(entity, SKOS.prefLabel):  
-                    if isinstance(obj, Literal):  
-                        lang = obj.language if obj.language else 'default'  
-                        if lang not in related_labels:  
-                            related_labels[lang] = []  
-                        related_labels[lang].append(str(obj))  
+                for lang, labels in concept_table.pref_labels.get(entity, {}).items():  
+                    if lang not in related_labels:  
+                        related_labels[lang] = []  
+                    related_labels[lang].extend(labels)  
             return related_labels
 
-        related_entities_labels = get_related_labels(related_entities)  
-        broader_entities_labels = get_related_labels(broader_entities)  
-        narrower_entities_labels = get_related_labels(narrower_entities)
+        related_entities_labels = get_related_labels(predicates.get(SKOS_RELATED, []))  
+        broader_entities_labels = get_related_labels(predicates.get(SKOS_BROADER, []))  
+        narrower_entities_labels = get_related_labels(predicates.get(SKOS_NARROWER, []))
 
-        # Extract triples linked to the concept  
-        linked_triples = list(graph.triples((concept, None, None)))
-        linked_triples_str = " ".join([f"{s} {p} {o}" for s, p, o in linked_triples])  
-    
+        # Triples linked to the concept, in the order of the graph  
+        linked_triples_str = " ".join(
+            [f"{concept} {predicate} {obj}" for predicate, objects in predicates.items() for obj in objects]
+        )  
 
         return {  
             "pref_labels": pref_labels,  
@@ -142,33 +218,104 @@ class ScrapingRDF():
 
         return document, full_text 
 
-    def ScrapeRDF(self, RDFs, KnowledgeBase):
+    def ScrapeRDF(self, RDFs, KnowledgeBase, workers=1):
         """
         Scrapes RDF data and builds a knowledge base. This method parses RDF files, extracts concept information, concatenates the information,  
         and builds a knowledge base by appending the documents to the provided knowledge base.  
+        Concepts are rendered in the order of their URI, so the ids are the same from one run to the next.  
+        Taxonomies of at least INDEX_PARALLEL_MIN_CONCEPTS concepts are rendered by a pool of worker processes.  
+        Parsed files are kept in the graph cache (GRAPH_CACHE_DIR), so an unchanged file is not parsed again.  
   
         :param RDFs: A dictionary where keys are paths to RDF files and values are taxonomy names.  
         :param KnowledgeBase: A list to which the extracted documents will be appended.  
+        :param workers: The number of worker processes used to render the concepts of a large taxonomy.  
   
         :return: The updated knowledge base with the extracted documents.  
         """
-        for key, value in RDFs.items():
+        # Imported here since the concept store of the graph cache builds on the SKOS predicates of this module
+        from utils.graph_cache import load_taxonomy
 
-            g = Graph()  
-            g.parse(key, format="ttl")  
+        for key, value in RDFs.items():
 
-            # Extract all concept URIs  
-            concept_uris = set(g.subjects(predicate=SKOS.prefLabel))  
+            # Parsed taxonomy, from the graph cache when the file did not change
+            concept_store = load_taxonomy(key).concept_store
             KnowledgeBase = []
 
-            id = 1
+            if workers > 1 and len(concept_store) >= INDEX_PARALLEL_MIN_CONCEPTS:
+                logging.info(f"RDF: rendering {len(concept_store)} concepts of {value} with {workers} workers")
+                KnowledgeBase = _render_concepts_in_parallel(concept_store, value, workers)
+                continue
 
-            for concept_uri in concept_uris:  
-                concept_info = self.extract_concept_info(g, concept_uri)  
-                document, combined_text = self.concatenate_info(concept_info, concept_uri, value, id, lang='en')
+            for position in range(len(concept_store)):
+                concept_info = concept_store.concept_info(position)
+                document, combined_text = self.concatenate_info(
+                    concept_info, concept_store.concept_uri(position), value, position + 1, lang='en'
+                )
                 KnowledgeBase.append(document)
                 logging.info(combined_text)
 
-                id += 1
+        return KnowledgeBase
+
+
+# Concept store of the taxonomy being rendered, shared read-only with the worker processes
+_shared_concept_store = None
+
+
+def _init_render_worker(concept_store):
+    """
+    Initializes a worker process with the concept store, when it cannot be inherited by fork.
+
+    :param concept_store: The ConceptStore of the taxonomy.
+    """
+    global _shared_concept_store
+    _shared_concept_store = concept_store
+
+
+def _render_concepts(start, stop, taxonomie):
+    """
+    Renders a slice of the concepts of a taxonomy from the shared concept store.
+
+    :param start: The position of the first concept of the slice.
+    :param stop: The position after the last concept of the slice.
+    :param taxonomie: The taxonomy to which the concepts belong.
+    :return: The documents of the slice, in order.
+    """
+    scraper = ScrapingRDF()
+    documents = []
+    for position in range(start, stop):
+        concept_info = _shared_concept_store.concept_info(position)
+        document, _ = scraper.concatenate_info(
+            concept_info, _shared_concept_store.concept_uri(position), taxonomie, position + 1, lang='en'
+        )
+        documents.append(document)
+    return documents
+
+
+def _render_concepts_in_parallel(concept_store, taxonomie, workers):
+    """
+    Splits the rendering of the concepts of a taxonomy across worker processes. Where fork is available the
+    workers inherit the concept store from the parent process; otherwise it is sent once to each worker.
+
+    :param concept_store: The ConceptStore of the taxonomy.
+    :param taxonomie: The taxonomy to which the concepts belong.
+    :param workers: The number of worker processes.
+    :return: The documents of the concepts, in the order of the store.
+    """
+    global _shared_concept_store
+    concepts = len(concept_store)
+    slice_size = math.ceil(concepts / (workers * 4))
+    starts = list(range(0, concepts, slice_size))
+    stops = [min(start + slice_size, concepts) for start in starts]
+
+    if "fork" in multiprocessing.get_all_start_methods():
+        _shared_concept_store = concept_store
+        executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork"))
+    else:
+        executor = ProcessPoolExecutor(workers, initializer=_init_render_worker, initargs=(concept_store,))
 
-        return KnowledgeBase
\ No newline at end of file
+    try:
+        with executor:
+            results = executor.map(_render_concepts, starts, stops, repeat(taxonomie))
+            return [document for documents in results for document in documents]
+    finally:
+        _shared_concept_store = None
@@ -1,15 +1,30 @@
 # Import relevant libraries
 import os
+import json
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from azure.core import MatchConditions
 from azure.storage.blob import BlobServiceClient
 from dotenv import load_dotenv
 from pathlib import Path
 import shutil
 
+from utils.instrumentation import record_api_calls
+
 load_dotenv(override=True)
 
 AZURE_BLOB_ENDPOINT = os.getenv("AZURE_BLOB_ENDPOINT")
 AZURE_BLOB_CONTAINER_NAME = os.getenv("AZURE_BLOB_CONTAINER_NAME")
+# Local mirror of the container, kept between runs so unchanged blobs are not downloaded again
+BLOB_SYNC_FOLDER = os.getenv("BLOB_SYNC_FOLDER", "blob_mirror")
+BLOB_SYNC_MAX_WORKERS = int(os.getenv("BLOB_SYNC_MAX_WORKERS", "8"))
+# Ranges of one blob downloaded in parallel, and size of a range
+BLOB_DOWNLOAD_CONCURRENCY = int(os.getenv("BLOB_DOWNLOAD_CONCURRENCY", "4"))
+BLOB_DOWNLOAD_CHUNK_BYTES = int(os.getenv("BLOB_DOWNLOAD_CHUNK_BYTES", str(4 * 1024 * 1024)))
+BLOB_SYNC_STATE_FILE = ".blob_sync.json"
+# Suffix of a blob being downloaded, renamed once complete
+BLOB_DOWNLOAD_SUFFIX = ".download"
 
 def get_blob_sas_token() -> str:
     """
@@ -32,45 +47,160 @@ def get_blob_service_client(sas_token: str) -> BlobServiceClient:
     :param sas_token: The SAS token for accessing Azure Blob Storage.  
     :return: An instance of BlobServiceClient.
     """
-    return BlobServiceClient(AZURE_BLOB_ENDPOINT, credential=sas_token)
+    return BlobServiceClient(
+        AZURE_BLOB_ENDPOINT,
+        credential=sas_token,
+        max_single_get_size=BLOB_DOWNLOAD_CHUNK_BYTES,
+        max_chunk_get_size=BLOB_DOWNLOAD_CHUNK_BYTES,
+    )
 
 
-def download_blob(blob_client, local_path: str):
+def download_blob(blob_client, local_path: str, etag: str = None) -> str:
     """
-    Download a blob to the specified local path.
+    Download a blob to the specified local path. The blob is streamed to disk range by range (BLOB_DOWNLOAD_CHUNK_BYTES,
+    BLOB_DOWNLOAD_CONCURRENCY ranges in parallel), so it is never fully held in memory, and the file only replaces the
+    previous one once complete.
 
     :param blob_client: The blob client to download from.  
     :param local_path: The local file path where the blob content will be saved.  
-    :return: This function does not return any value.
+    :param etag: The ETag the blob is expected to have (the download fails if the blob changed since it was listed).
+    :return: The ETag of the downloaded blob.
+    """
+    local_path = Path(local_path)
+    local_path.parent.mkdir(parents=True, exist_ok=True)
+    temporary_path = local_path.with_name(local_path.name + BLOB_DOWNLOAD_SUFFIX)
+    logging.info(f"AZURE_STORAGE_HELPER: downloading blob to {local_path}")
+    conditions = {"etag": etag, "match_condition": MatchConditions.IfNotModified} if etag else {}
+    try:
+        downloader = blob_client.download_blob(max_concurrency=BLOB_DOWNLOAD_CONCURRENCY, **conditions)
+        with open(temporary_path, "wb") as file:
+            downloader.readinto(file)
+        temporary_path.replace(local_path)
+    finally:
+        temporary_path.unlink(missing_ok=True)
+    record_api_calls("blob", 1, byte_count=downloader.size)
+    return downloader.properties.etag
+
+
+def _load_sync_state(local_folder_path: Path) -> dict:
+    """
+    Reads the ETag and size of the blobs downloaded by the previous syncs.
+    """
+    try:
+        with open(local_folder_path / BLOB_SYNC_STATE_FILE) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_sync_state(local_folder_path: Path, state: dict):
     """
-    with open(local_path, "wb") as file:
-        logging.info(f"AZURE_STORAGE_HELPER: downloading blob to {local_path}")
-        file.write(blob_client.download_blob().readall())
+    Writes the ETag and size of the downloaded blobs.
+    """
+    temporary_path = local_folder_path / str(BLOB_SYNC_STATE_FILE + ".tmp")
+    with open(temporary_path, "w") as file:
+        json.dump(state, file, indent=1, sort_keys=True)
+    temporary_path.replace(local_folder_path / BLOB_SYNC_STATE_FILE)
+
+
+def sync_blob_container_to_local_folder(
+    container_client, local_folder_path: str, max_workers: int = None
+) -> dict:
+    """
+    Mirrors a blob container in a local folder. The blobs are listed with their ETag and size, and only the ones
+    that are new, changed (other ETag or size) or missing locally are downloaded, over a bounded thread pool.
+    Local files of blobs deleted from the container are removed. The ETags are kept in a state file of the folder.
+
+    :param container_client: The ContainerClient of the container.
+    :param local_folder_path: The local folder mirroring the container.
+    :param max_workers: The number of blobs downloaded in parallel (default: BLOB_SYNC_MAX_WORKERS).
+    :return: A dictionary with the downloaded, unchanged, removed and failed blob names, and the downloaded bytes.
+    """
+    local_folder_path = Path(local_folder_path)
+    local_folder_path.mkdir(parents=True, exist_ok=True)
+    previous_state = _load_sync_state(local_folder_path)
+    state = {}
+    to_download = []
+    unchanged = []
+    start = time.perf_counter()
+
+    for blob in container_client.list_blobs():
+        local_path = local_folder_path / blob.name
+        known = previous_state.get(blob.name)
+        if (
+            known is not None
+            and known["etag"] == blob.etag
+            and known["size"] == blob.size
+            and local_path.is_file()
+            and local_path.stat().st_size == blob.size
+        ):
+            state[blob.name] = known
+            unchanged.append(blob.name)
+        else:
+            to_download.append(blob)
+
+    downloaded = []
+    failed = []
+    downloaded_bytes = 0
+    with ThreadPoolExecutor(max_workers=max(1, max_workers or BLOB_SYNC_MAX_WORKERS)) as executor:
+        futures = {
+            executor.submit(
+                download_blob, container_client.get_blob_client(blob.name), local_folder_path / blob.name, blob.etag
+            ): blob
+            for blob in to_download
+        }
+        for future in as_completed(futures):
+            blob = futures[future]
+            try:
+                etag = future.result()
+            except Exception as e:
+                logging.info(f"AZURE_STORAGE_HELPER: {blob.name} could not be downloaded: {e}")
+                failed.append(blob.name)
+                continue
+            state[blob.name] = {"etag": etag, "size": blob.size}
+            downloaded.append(blob.name)
+            downloaded_bytes += blob.size
+
+    # Blobs deleted from the container (failed downloads keep their previous file)
+    removed = []
+    for name in previous_state:
+        if name not in state and name not in failed:
+            (local_folder_path / name).unlink(missing_ok=True)
+            removed.append(name)
+        elif name in failed:
+            state[name] = previous_state[name]
+    _save_sync_state(local_folder_path, state)
+
+    elapsed = time.perf_counter() - start
+    logging.info(
+        f"AZURE_STORAGE_HELPER: synced {local_folder_path} in {elapsed:.1f}s: {len(downloaded)} downloaded "
+        f"({downloaded_bytes / 1024 / 1024:.1f} MB), {len(unchanged)} unchanged, {len(removed)} removed, {len(failed)} failed"
+    )
+    return {
+        "downloaded": downloaded,
+        "unchanged": unchanged,
+        "removed": removed,
+        "failed": failed,
+        "downloaded_bytes": downloaded_bytes,
+    }
 
 
 def _download_blob_container_to_local_folder(
     blob_url: str, local_folder_path: str, credentials: str
 ):
     """
-    Download all blobs from the container to the local folder.
+    Download the new or changed blobs from the container to the local folder.
     
     :param blob_url: The URL of the blob container.  
     :param local_folder_path: The local folder path where the blobs will be saved.  
     :param credentials: The SAS token or other credentials for accessing the blob container.  
-    :return: This function does not return any value.
+    :return: The summary of the sync (see sync_blob_container_to_local_folder).
     """
-    local_folder_path = Path(local_folder_path)
     blob_service_client = get_blob_service_client(credentials)
     container_client = blob_service_client.get_container_client(
         AZURE_BLOB_CONTAINER_NAME
     )
-
-    for blob_name in container_client.list_blob_names():
-        blob_client = container_client.get_blob_client(blob_name)
-        local_path = local_folder_path / blob_name
-
-        if not local_path.exists():
-            download_blob(blob_client, local_path)
+    return sync_blob_container_to_local_folder(container_client, local_folder_path)
 
 
 def download_blob_container_to_local_folder(
@@ -83,13 +213,13 @@ def download_blob_container_to_local_folder(
     :param blob_url: The URL of the blob container.  
     :param local_folder_path: The local folder path where the blobs will be saved.  
     :param credentials: The SAS token or other credentials for accessing the blob container.  
-  
+    :return: The summary of the sync (see sync_blob_container_to_local_folder).
     """
     # TODO: check blob url
     # TODO: check local folder path
     # TODO: check credentials
 
-    _download_blob_container_to_local_folder(blob_url, local_folder_path, credentials)
+    return _download_blob_container_to_local_folder(blob_url, local_folder_path, credentials)
 
 
 # def download_documents_from_blob_to_path(local_folder_path: str, azure_blob_endpoint:str = AZURE_BLOB_ENDPOINT):
@@ -98,19 +228,57 @@ def download_blob_container_to_local_folder(
 #         azure_blob_endpoint, local_folder_path, sas_token
 #     )
 
+def _link_file(source: Path, destination: Path) -> bool:
+    """
+    Makes destination a hard link to source (a copy when the file system does not support it).
+
+    :return: False when destination already was the same file.
+    """
+    if destination.exists():
+        if os.path.samefile(source, destination):
+            return False
+        destination.unlink()
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+    return True
+
+
+def link_documents_to_folder(local_folder_path: str, input_document_folder: str) -> int:
+    """
+    Links every file of the local folder, subfolders included, into the input document folder at the same relative
+    path (the blob name for a mirror of the container), instead of copying it. A file that was replaced in the local
+    folder (e.g. by a new download) is linked again. The sync state and unfinished downloads are skipped.
+
+    :param local_folder_path: The local folder path where the documents are stored.
+    :param input_document_folder: The destination folder of the documents.
+    :return: The number of files linked or relinked.
+    """
+    linked = 0
+    for directory, _, names in os.walk(local_folder_path):
+        for name in names:
+            if name.startswith(BLOB_SYNC_STATE_FILE) or name.endswith(BLOB_DOWNLOAD_SUFFIX):
+                continue
+            source = Path(directory) / name
+            destination = Path(input_document_folder) / source.relative_to(local_folder_path)
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            linked += _link_file(source, destination)
+    return linked
+
+
 def download_documents_from_blob_to_path(local_folder_path: str, input_document_folder: str):
     """
-    Iterates over all files in the local folder and copies them to  
-    the input document folder.  
-  
-    :param local_folder_path: The local folder path where the documents are initially stored.  
-    :param input_document_folder: The destination folder where the documents will be copied.  
+    Puts the documents in the input document folder. When local_folder_path is a local folder, its files are linked
+    into the input document folder. Otherwise the blob container AZURE_BLOB_CONTAINER_NAME is first synced into
+    BLOB_SYNC_FOLDER (only new or changed blobs are downloaded) and the files of that mirror are linked.
   
+    :param local_folder_path: The local folder path where the documents are stored, or the blob endpoint.  
+    :param input_document_folder: The destination folder of the documents.  
     """
     logging.info(input_document_folder)
-    for name in os.listdir(local_folder_path):
-        # Open file
-            with open(os.path.join(local_folder_path, name)) as f:
-                print(f"Content of '{name}'")
-                # Read content of file
-                shutil.copy2(os.path.join(local_folder_path, name), os.path.join(input_document_folder, name))
\ No newline at end of file
+    if not os.path.isdir(local_folder_path):
+        download_blob_container_to_local_folder(local_folder_path, BLOB_SYNC_FOLDER, get_blob_sas_token())
+        local_folder_path = BLOB_SYNC_FOLDER
+    linked = link_documents_to_folder(local_folder_path, input_document_folder)
+    logging.info(f"AZURE_STORAGE_HELPER: {linked} documents linked into {input_document_folder}")
@@ -0,0 +1,240 @@
+# Import relevant libraries
+import os
+import time
+import random
+import asyncio
+import logging
+import httpx
+from openai import (
+    AsyncAzureOpenAI,
+    RateLimitError,
+    APIConnectionError,
+    APITimeoutError,
+    InternalServerError,
+)
+from dotenv import load_dotenv
+
+from utils.instrumentation import record_api_calls
+from utils.rate_limits import AdaptiveConcurrency, estimate_tokens
+
+load_dotenv(override=True)
+
+AZURE_OPENAI_API_KEY = os.environ.get("AZURE_OPENAI_API_KEY")
+AZURE_OPENAI_ENDPOINT = os.environ.get("AZURE_OPENAI_ENDPOINT")
+AZURE_OPENAI_EMBEDDING_API_VERSION = os.environ.get(
+    "AZURE_OPENAI_EMBEDDING_API_VERSION"
+)
+AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
+EMBEDDING_REQUESTS_PER_MINUTE = int(os.getenv("EMBEDDING_REQUESTS_PER_MINUTE", "720"))
+EMBEDDING_TOKENS_PER_MINUTE = int(os.getenv("EMBEDDING_TOKENS_PER_MINUTE", "120000"))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", "16"))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", "8"))
+
+
+class TokenBucket():
+    """
+    A token bucket refilled continuously at a per-minute rate.
+
+    The bucket holds at most a sixth of the per-minute budget (Azure OpenAI evaluates its quotas
+    over short windows), so bursts stay small. A request bigger than the bucket waits until the
+    bucket is full and then puts it in debt, which delays the following requests accordingly.
+    """
+    def __init__(self, per_minute: int) -> None:
+        self.rate = per_minute / 60
+        self.capacity = max(per_minute / 6, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount: float):
+        """
+        Waits until the bucket can pay for the given amount and takes it.
+
+        :param amount: The number of requests or tokens to take.
+        """
+        async with self._lock:
+            needed = min(amount, self.capacity)
+            self._refill()
+            while self.tokens < needed:
+                await asyncio.sleep((needed - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+
+def _retry_after_seconds(error: RateLimitError) -> float:
+    """
+    Reads the delay requested by the service in the headers of a 429 response.
+
+    :param error: The rate limit error raised by the OpenAI client.
+    :return: The number of seconds to wait, or None when the response has no such header.
+    """
+    headers = error.response.headers if error.response is not None else {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+class EmbeddingScheduler():
+    """
+    Schedules embedding requests on a single AsyncAzureOpenAI client (and connection pool)
+    under a requests-per-minute and a tokens-per-minute budget.
+
+    Throttled requests wait for the delay given by the Retry-After headers and make the
+    concurrency limit shrink, so the scheduler settles just below the deployment quota.
+    A batch that keeps failing for another reason is split and only the failing half is retried.
+
+    Methods:
+    - embed_batches: Embeds a list of batches of texts concurrently.
+    - run: Synchronous entry point around embed_batches.
+    """
+    def __init__(
+        self,
+        requests_per_minute: int = None,
+        tokens_per_minute: int = None,
+        max_concurrency: int = None,
+        max_retries: int = EMBEDDING_MAX_RETRIES,
+    ) -> None:
+        # Read at call time so the command line (or a benchmark) can change them
+        self.requests_per_minute = requests_per_minute or EMBEDDING_REQUESTS_PER_MINUTE
+        self.tokens_per_minute = tokens_per_minute or EMBEDDING_TOKENS_PER_MINUTE
+        self.max_concurrency = max_concurrency or EMBEDDING_MAX_CONCURRENCY
+        self.max_retries = max_retries
+        self.api_calls = 0
+        self.throttled = 0
+        self.retries = 0
+
+    def _create_client(self) -> AsyncAzureOpenAI:
+        """
+        Creates the client shared by all the requests of a run. Retries are handled by the scheduler.
+        """
+        return AsyncAzureOpenAI(
+            api_key=AZURE_OPENAI_API_KEY,
+            api_version=AZURE_OPENAI_EMBEDDING_API_VERSION,
+            azure_endpoint=AZURE_OPENAI_ENDPOINT,
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency,
+                ),
+                timeout=60,
+            ),
+        )
+
+    async def _request(self, client, texts: list[str]) -> list[list]:
+        """
+        Sends one embeddings request once the budgets allow it, waiting and retrying on throttling
+        and transient errors.
+
+        :param client: The shared AsyncAzureOpenAI client.
+        :param texts: The texts of the batch.
+        :return: The embeddings, in the same order as the input texts.
+        """
+        tokens = sum(estimate_tokens(text) for text in texts)
+        for attempt in range(self.max_retries + 1):
+            await self._requests_bucket.acquire(1)
+            await self._tokens_bucket.acquire(tokens)
+            try:
+                async with self._concurrency as sent:
+                    self.api_calls += 1
+                    response = await client.embeddings.create(
+                        input=texts, model=AZURE_OPENAI_EMBEDDING_DEPLOYMENT
+                    )
+                self._concurrency.on_success()
+                embeddings = [None] * len(texts)
+                for item in response.data:
+                    embeddings[item.index] = item.embedding
+                return embeddings
+
+            except RateLimitError as e:
+                if attempt == self.max_retries:
+                    raise e
+                self.throttled += 1
+                self.retries += 1
+                self._concurrency.on_throttle(sent)
+                delay = _retry_after_seconds(e) or min(2 ** attempt, 60)
+                logging.warning(
+                    f"EMBEDDING_SCHEDULER: throttled, waiting {delay:.1f}s (concurrency limit {self._concurrency.limit:.1f})"
+                )
+                await asyncio.sleep(delay)
+
+            except (APIConnectionError, APITimeoutError, InternalServerError) as e:
+                if attempt == self.max_retries:
+                    raise e
+                self.retries += 1
+                await asyncio.sleep(random.uniform(1, min(2 ** attempt, 30)))
+
+    async def _embed_batch(self, client, texts: list[str]) -> list[list]:
+        """
+        Embeds one batch, splitting it in two halves when it fails so only the failing half is retried.
+
+        :param client: The shared AsyncAzureOpenAI client.
+        :param texts: The texts of the batch.
+        :return: The embeddings, in the same order as the input texts.
+        """
+        try:
+            return await self._request(client, texts)
+        except Exception as e:
+            if len(texts) == 1 or isinstance(e, RateLimitError):
+                raise Exception(
+                    f"Error getting embeddings with endpoint={AZURE_OPENAI_ENDPOINT} with error={e} for {len(texts)} texts"
+                )
+            logging.warning(
+                f"EMBEDDING_SCHEDULER: batch of {len(texts)} texts failed, splitting it: {e}"
+            )
+            middle = len(texts) // 2
+            first, second = await asyncio.gather(
+                self._embed_batch(client, texts[:middle]),
+                self._embed_batch(client, texts[middle:]),
+            )
+            return first + second
+
+    async def embed_batches(self, batches: list[list[str]], on_batch_done=None) -> list[list[list]]:
+        """
+        Embeds a list of batches of texts concurrently.
+
+        :param batches: The batches of texts, each one sent as a single request when possible.
+        :param on_batch_done: Optional callback called with (batch_position, embeddings) as soon as a batch is embedded.
+        :return: The embeddings of each batch, in the same order as the batches.
+        """
+        self._requests_bucket = TokenBucket(self.requests_per_minute)
+        self._tokens_bucket = TokenBucket(self.tokens_per_minute)
+        self._concurrency = AdaptiveConcurrency(self.max_concurrency)
+
+        async def embed(position, client, texts):
+            embeddings = await self._embed_batch(client, texts)
+            if on_batch_done is not None:
+                on_batch_done(position, embeddings)
+            return embeddings
+
+        async with self._create_client() as client:
+            return await asyncio.gather(
+                *[embed(position, client, texts) for position, texts in enumerate(batches)]
+            )
+
+    def run(self, batches: list[list[str]], on_batch_done=None) -> list[list[list]]:
+        """
+        Synchronous entry point around embed_batches.
+
+        :param batches: The batches of texts.
+        :param on_batch_done: Optional callback called with (batch_position, embeddings) as soon as a batch is embedded.
+        :return: The embeddings of each batch, in the same order as the batches.
+        """
+        start = time.perf_counter()
+        results = asyncio.run(self.embed_batches(batches, on_batch_done))
+        logging.info(
+            f"EMBEDDING_SCHEDULER: {len(batches)} batches in {time.perf_counter() - start:.1f}s, "
+            f"{self.api_calls} calls, {self.throttled} throttled, {self.retries} retries"
+        )
+        record_api_calls("embeddings", self.api_calls, self.retries)
+        return results
@@ -0,0 +1,210 @@
+# Import relevant libraries
+import os
+import time
+import pickle
+import tempfile
+import hashlib
+import logging
+from pathlib import Path
+import rdflib
+from rdflib import Graph
+from dotenv import load_dotenv
+
+from utils.concept_store import ConceptStore
+
+load_dotenv(override=True)
+
+# Kept outside the source tree by default, in the cache folder of the user
+GRAPH_CACHE_DIR = os.getenv("GRAPH_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "taxonomy_graph_cache"))
+GRAPH_CACHE_MAX_BYTES = int(os.getenv("GRAPH_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# Bumped whenever the layout of a cache file changes, so old files are ignored
+GRAPH_CACHE_FORMAT = 2
+
+
+def file_digest(data: bytes) -> str:
+    """
+    Computes the cache key of a Turtle file from its content.
+
+    :param data: The bytes of the file.
+    :return: The hexadecimal SHA-256 of the bytes.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+class ParsedTaxonomy():
+    """
+    A parsed Turtle taxonomy in a compact form: a ConceptStore, where every distinct string is stored once and the
+    triples are rows of integer arrays, grouped by subject in the order of the graph.
+
+    Attributes:
+    - concept_store: The ConceptStore of the taxonomy, from which the concepts are rendered.
+    - graph: The rdflib graph, rebuilt from the store the first time it is read.
+    """
+    def __init__(self, concept_store: ConceptStore, graph: Graph = None) -> None:
+        self.concept_store = concept_store
+        self._graph = graph
+
+    @classmethod
+    def from_graph(cls, graph: Graph):
+        """
+        Builds the compact form of a parsed graph. The graph is not kept, so its memory is freed once the store is
+        built.
+
+        :param graph: The parsed rdflib graph.
+        :return: The ParsedTaxonomy of the graph.
+        """
+        return cls(ConceptStore.from_graph(graph))
+
+    @property
+    def graph(self) -> Graph:
+        if self._graph is None:
+            self._graph = Graph()
+            self._graph.addN(
+                (subject, predicate, obj, self._graph) for subject, predicate, obj in self.concept_store.iter_triples()
+            )
+        return self._graph
+
+    def to_bytes(self) -> bytes:
+        """
+        Serializes the compact form: the string table and the arrays of the store, which makes the file smaller and
+        faster to load than a pickled graph.
+
+        :return: The serialized taxonomy.
+        """
+        content = {
+            "format": GRAPH_CACHE_FORMAT,
+            "rdflib": rdflib.__version__,
+            **self.concept_store.to_content(),
+        }
+        return pickle.dumps(content, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        """
+        Deserializes a taxonomy written by to_bytes.
+
+        :param data: The serialized taxonomy.
+        :return: The ParsedTaxonomy, or None when the data was written by another format or rdflib version.
+        """
+        content = pickle.loads(data)
+        if content.get("format") != GRAPH_CACHE_FORMAT or content.get("rdflib") != rdflib.__version__:
+            return None
+        return cls(ConceptStore.from_content(content))
+
+
+class GraphCache():
+    """
+    A directory of parsed taxonomies keyed by the SHA-256 of the Turtle file bytes.
+    When the files exceed max_bytes, the least recently used ones are deleted.
+
+    Methods:
+    - get: Loads a parsed taxonomy.
+    - put: Stores a parsed taxonomy.
+    """
+    def __init__(self, directory: str = GRAPH_CACHE_DIR, max_bytes: int = GRAPH_CACHE_MAX_BYTES) -> None:
+        self.directory = Path(directory).expanduser()
+        self.max_bytes = max_bytes
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, digest: str) -> Path:
+        return self.directory / str(digest + ".pickle")
+
+    def get(self, digest: str):
+        """
+        Loads a parsed taxonomy.
+
+        :param digest: The SHA-256 of the Turtle file.
+        :return: The ParsedTaxonomy, or None when it is not cached.
+        """
+        path = self._path(digest)
+        try:
+            with open(path, "rb") as file:
+                taxonomy = ParsedTaxonomy.from_bytes(file.read())
+        except (OSError, pickle.UnpicklingError, EOFError, KeyError, TypeError):
+            return None
+        if taxonomy is not None:
+            # The modification time records the last use, for the eviction
+            os.utime(path)
+        return taxonomy
+
+    def put(self, digest: str, taxonomy: ParsedTaxonomy):
+        """
+        Stores a parsed taxonomy and evicts the least recently used files if needed.
+
+        :param digest: The SHA-256 of the Turtle file.
+        :param taxonomy: The ParsedTaxonomy to store.
+        """
+        path = self._path(digest)
+        # A temporary file of its own, so processes storing the same taxonomy do not write into each other's file
+        with tempfile.NamedTemporaryFile(dir=self.directory, suffix=".tmp", delete=False) as file:
+            try:
+                file.write(taxonomy.to_bytes())
+            except BaseException:
+                file.close()
+                os.unlink(file.name)
+                raise
+        os.replace(file.name, path)
+        self._evict()
+
+    def _evict(self):
+        """
+        Deletes the least recently used files above max_bytes.
+        """
+        files = sorted(self.directory.glob("*.pickle"), key=lambda path: path.stat().st_mtime)
+        total = sum(path.stat().st_size for path in files)
+        for path in files:
+            if total <= self.max_bytes:
+                break
+            total -= path.stat().st_size
+            path.unlink(missing_ok=True)
+            logging.info(f"GRAPH_CACHE: evicted {path.name}")
+
+
+_graph_cache = None
+
+
+def get_graph_cache():
+    """
+    Returns the graph cache shared by the process, or None when GRAPH_CACHE_DIR is empty.
+
+    :return: The shared GraphCache instance or None.
+    """
+    global _graph_cache
+    if not GRAPH_CACHE_DIR:
+        return None
+    if _graph_cache is None:
+        _graph_cache = GraphCache()
+    return _graph_cache
+
+
+def load_taxonomy(source) -> ParsedTaxonomy:
+    """
+    Parses a Turtle taxonomy, or loads it from the graph cache when the same bytes were parsed before.
+
+    :param source: The path of the Turtle file, or its bytes.
+    :return: The ParsedTaxonomy of the file.
+    """
+    if isinstance(source, (bytes, bytearray)):
+        data = bytes(source)
+        name = "uploaded file"
+    else:
+        data = Path(source).read_bytes()
+        name = Path(source).name
+
+    start = time.perf_counter()
+    cache = get_graph_cache()
+    digest = file_digest(data)
+    if cache is not None:
+        taxonomy = cache.get(digest)
+        if taxonomy is not None:
+            logging.info(f"GRAPH_CACHE: {name} loaded from cache in {time.perf_counter() - start:.3f}s")
+            return taxonomy
+
+    graph = Graph()
+    graph.parse(data=data, format="ttl")
+    taxonomy = ParsedTaxonomy.from_graph(graph)
+    logging.info(f"GRAPH_CACHE: {name} parsed in {time.perf_counter() - start:.3f}s")
+    if cache is not None:
+        cache.put(digest, taxonomy)
+    return taxonomy
@@ -0,0 +1,270 @@
+# Import relevant libraries
+import os
+import time
+import sqlite3
+import logging
+import threading
+from pathlib import Path
+import numpy as np
+from dotenv import load_dotenv
+
+from utils.index_manifest import CONCEPT_ID_COLUMN, concept_hash
+
+load_dotenv(override=True)
+
+INDEX_CHECKPOINT = os.getenv("INDEX_CHECKPOINT", "true").lower() in ("1", "true", "yes")
+INDEX_CHECKPOINT_FILE_NAME = "index_checkpoint.sqlite"
+
+STAGE_PARSED = 1
+STAGE_EMBEDDED = 2
+STAGE_UPLOADED = 3
+STAGE_NAMES = {STAGE_PARSED: "parsed", STAGE_EMBEDDED: "embedded", STAGE_UPLOADED: "uploaded"}
+
+# SQLite limits the number of variables of a single statement
+_SQL_CHUNK = 500
+
+
+def _source_signature(source_path: str) -> tuple:
+    stat = Path(source_path).stat()
+    return stat.st_size, stat.st_mtime_ns
+
+
+class IndexCheckpoint():
+    """
+    A journal of the indexation run in progress, stored in a local SQLite file (in WAL mode, committed after every
+    batch), so a run that crashed or was preempted resumes where it stopped instead of starting over.
+
+    For each ttl file it records whether it was parsed (with the size and modification time of the file), and
+    for each concept to publish (by document id, with its content hash) the last stage it completed: parsed,
+    embedded (with its vector, until it is uploaded) or uploaded. The entries of a taxonomy are deleted once its
+    manifest is published, so the journal only holds unfinished work.
+
+    Methods:
+    - is_parsed / mark_parsed: Parsing of a ttl file.
+    - register_delta: Records the concepts to publish, keeping the progress of the unchanged ones.
+    - embedded_vectors / mark_embedded: Embedding of the concepts.
+    - uploaded_ids / mark_uploaded: Upload of the concepts.
+    - clear: Forgets a published taxonomy.
+    - status: Progress per taxonomy.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS sources (source TEXT PRIMARY KEY, taxonomy TEXT, source_size INTEGER, "
+            "source_mtime INTEGER, concepts INTEGER, parsed_at REAL)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS concepts (taxonomy TEXT NOT NULL, id TEXT NOT NULL, hash TEXT NOT NULL, "
+            "stage INTEGER NOT NULL, vector BLOB, updated_at REAL NOT NULL, PRIMARY KEY (taxonomy, id))"
+        )
+        self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def is_parsed(self, source: str, source_path: str) -> bool:
+        """
+        Tells whether the ttl file was parsed as it is now (same size and modification time).
+
+        :param source: The name of the chunked file of the ttl (without extension).
+        :param source_path: The path of the ttl file.
+        :return: True when its chunked documents can be reused.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT source_size, source_mtime FROM sources WHERE source = ? AND parsed_at IS NOT NULL",
+                (source,),
+            ).fetchone()
+        return row is not None and tuple(row) == _source_signature(source_path)
+
+    def mark_parsed(self, source: str, source_path: str, concepts: int = None):
+        """
+        Records that the chunked documents of the ttl file were written.
+
+        :param source: The name of the chunked file of the ttl (without extension).
+        :param source_path: The path of the ttl file.
+        :param concepts: The number of parsed concepts.
+        """
+        size, mtime = _source_signature(source_path)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO sources (source, source_size, source_mtime, concepts, parsed_at) VALUES (?, ?, ?, ?, ?)",
+                (source, size, mtime, concepts, time.time()),
+            )
+            self._connection.commit()
+
+    def register_delta(self, taxonomy: str, documents: list[dict], source: str = None):
+        """
+        Records the concepts of the taxonomy that have to be published. The concepts already journaled with the same
+        content keep their stage, the changed ones start again from parsed and the others are forgotten.
+
+        :param taxonomy: The id of the taxonomy (the name of its manifest).
+        :param documents: The added or changed documents, with their id.
+        :param source: The name of the chunked file the documents come from.
+        :return: The number of documents already embedded or uploaded by an interrupted run.
+        """
+        hashes = {document[CONCEPT_ID_COLUMN]: concept_hash(document) for document in documents}
+        now = time.time()
+        with self._lock:
+            journaled = dict(
+                self._connection.execute("SELECT id, hash FROM concepts WHERE taxonomy = ?", (taxonomy,)).fetchall()
+            )
+            stale = [(taxonomy, concept_id) for concept_id, content_hash in journaled.items() if hashes.get(concept_id) != content_hash]
+            self._connection.executemany("DELETE FROM concepts WHERE taxonomy = ? AND id = ?", stale)
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO concepts (taxonomy, id, hash, stage, vector, updated_at) VALUES (?, ?, ?, ?, NULL, ?)",
+                [(taxonomy, concept_id, content_hash, STAGE_PARSED, now) for concept_id, content_hash in hashes.items()],
+            )
+            if source is not None:
+                self._connection.execute("UPDATE sources SET taxonomy = ? WHERE source = ?", (taxonomy, source))
+            self._connection.commit()
+            (resumed,) = self._connection.execute(
+                "SELECT COUNT(*) FROM concepts WHERE taxonomy = ? AND stage > ?", (taxonomy, STAGE_PARSED)
+            ).fetchone()
+        if resumed:
+            logging.info(f"INDEX_CHECKPOINT: {taxonomy}: resuming, {resumed} of {len(hashes)} concepts already embedded or uploaded")
+        return resumed
+
+    def _select(self, query: str, taxonomy: str, ids: list[str]) -> list:
+        rows = []
+        with self._lock:
+            for start in range(0, len(ids), _SQL_CHUNK):
+                chunk = ids[start:start + _SQL_CHUNK]
+                rows.extend(
+                    self._connection.execute(
+                        query.format(",".join("?" * len(chunk))), [taxonomy, *chunk]
+                    ).fetchall()
+                )
+        return rows
+
+    def embedded_vectors(self, taxonomy: str, ids: list[str]) -> dict:
+        """
+        Returns the vectors journaled for the documents that were already embedded.
+
+        :param taxonomy: The id of the taxonomy.
+        :param ids: The document ids.
+        :return: A dictionary {document id: float32 vector as embedded}.
+        """
+        rows = self._select(
+            "SELECT id, vector FROM concepts WHERE taxonomy = ? AND vector IS NOT NULL AND id IN ({})", taxonomy, ids
+        )
+        return {concept_id: np.frombuffer(vector, dtype=np.float32) for concept_id, vector in rows}
+
+    def mark_embedded(self, taxonomy: str, ids: list[str], vectors: np.ndarray):
+        """
+        Records the vectors of embedded documents.
+
+        :param taxonomy: The id of the taxonomy.
+        :param ids: The document ids.
+        :param vectors: The float32 vectors as embedded, one row per document.
+        """
+        now = time.time()
+        rows = [
+            (STAGE_EMBEDDED, np.asarray(vector, dtype=np.float32).tobytes(), now, taxonomy, concept_id)
+            for concept_id, vector in zip(ids, vectors)
+        ]
+        with self._lock:
+            self._connection.executemany(
+                "UPDATE concepts SET stage = MAX(stage, ?), vector = ?, updated_at = ? WHERE taxonomy = ? AND id = ?", rows
+            )
+            self._connection.commit()
+
+    def uploaded_ids(self, taxonomy: str, ids: list[str]) -> set:
+        """
+        Returns the documents that were already uploaded.
+
+        :param taxonomy: The id of the taxonomy.
+        :param ids: The document ids.
+        :return: The set of uploaded document ids.
+        """
+        rows = self._select(
+            f"SELECT id FROM concepts WHERE taxonomy = ? AND stage = {STAGE_UPLOADED} AND id IN ({{}})", taxonomy, ids
+        )
+        return {concept_id for (concept_id,) in rows}
+
+    def mark_uploaded(self, taxonomy: str, ids: list[str]):
+        """
+        Records that documents are in the index. Their vectors are no longer kept.
+
+        :param taxonomy: The id of the taxonomy.
+        :param ids: The uploaded document ids.
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.executemany(
+                "UPDATE concepts SET stage = ?, vector = NULL, updated_at = ? WHERE taxonomy = ? AND id = ?",
+                [(STAGE_UPLOADED, now, taxonomy, concept_id) for concept_id in ids],
+            )
+            self._connection.commit()
+
+    def clear(self, taxonomy: str):
+        """
+        Forgets a taxonomy once its manifest is published.
+
+        :param taxonomy: The id of the taxonomy.
+        """
+        with self._lock:
+            self._connection.execute("DELETE FROM concepts WHERE taxonomy = ?", (taxonomy,))
+            self._connection.execute("DELETE FROM sources WHERE taxonomy = ?", (taxonomy,))
+            self._connection.commit()
+
+    def status(self) -> list[dict]:
+        """
+        Returns the progress of the unfinished taxonomies.
+
+        :return: One dictionary per taxonomy with its parsed concepts, the concepts to publish, how many of them
+            reached each stage and the time of the last update.
+        """
+        with self._lock:
+            # A ttl parsed but not compared with its manifest yet is listed under its own name
+            taxonomies = {
+                taxonomy or source: {"taxonomy": taxonomy or source, "parsed": parsed_at is not None, "concepts": concepts, "last_update": parsed_at}
+                for source, taxonomy, concepts, parsed_at in self._connection.execute(
+                    "SELECT source, taxonomy, concepts, parsed_at FROM sources"
+                ).fetchall()
+            }
+            rows = self._connection.execute(
+                "SELECT taxonomy, stage, COUNT(*), MAX(updated_at) FROM concepts GROUP BY taxonomy, stage"
+            ).fetchall()
+        for taxonomy, stage, count, updated_at in rows:
+            entry = taxonomies.setdefault(
+                taxonomy, {"taxonomy": taxonomy, "parsed": True, "concepts": None, "last_update": None}
+            )
+            # Counted apart from the entry, whose "parsed" key tells whether the ttl file was parsed
+            stages = entry.setdefault("stages", {})
+            stages[STAGE_NAMES[stage]] = stages.get(STAGE_NAMES[stage], 0) + count
+            entry["last_update"] = max(entry["last_update"] or 0, updated_at)
+
+        status = []
+        for entry in sorted(taxonomies.values(), key=lambda entry: entry["taxonomy"]):
+            stages = entry.get("stages", {})
+            to_publish = sum(stages.values())
+            uploaded = stages.get("uploaded", 0)
+            status.append({
+                "taxonomy": entry["taxonomy"],
+                "parsed": entry["parsed"],
+                "concepts": entry["concepts"],
+                "to_publish": to_publish,
+                "embedded": stages.get("embedded", 0) + uploaded,
+                "uploaded": uploaded,
+                "last_update": entry["last_update"],
+            })
+        return status
+
+
+def open_index_checkpoint(manifest_folder: str):
+    """
+    Opens the journal of the manifest folder, or returns None when INDEX_CHECKPOINT is false.
+
+    :param manifest_folder: The folder containing the manifests.
+    :return: The IndexCheckpoint or None.
+    """
+    if not INDEX_CHECKPOINT:
+        return None
+    path = Path(manifest_folder) / INDEX_CHECKPOINT_FILE_NAME
+    logging.info(f"INDEX_CHECKPOINT: opening {path}")
+    return IndexCheckpoint(str(path))
@@ -0,0 +1,109 @@
+# Import relevant libraries
+import json
+import time
+import uuid
+import hashlib
+from pathlib import Path
+
+CONCEPT_KEY_COLUMN = "uri"
+CONCEPT_ID_COLUMN = "id"
+# Written in the manifest folder, see save_index_version
+INDEX_VERSION_FILE_NAME = "index_version.txt"
+
+
+def concept_hash(document: dict) -> str:
+    """
+    Compute the content hash of a concept document. The id is left out since it is assigned by the manifest.
+
+    :param document: The concept document.
+    :return: The hexadecimal SHA-256 of the document content.
+    """
+    content = {key: value for key, value in document.items() if key != CONCEPT_ID_COLUMN}
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    ).hexdigest()
+
+
+def load_manifest(path: Path) -> dict:
+    """
+    Read the manifest of a taxonomy, or return an empty manifest if it does not exist yet.
+    The manifest maps the uri of each published concept to its document id and content hash.
+
+    :param path: The path of the manifest file.
+    :return: The manifest as a dictionary with the keys "concepts" and "next_id".
+    """
+    if not Path(path).exists():
+        return {"concepts": {}, "next_id": 1}
+    with open(path) as file:
+        return json.load(file)
+
+
+def save_manifest(manifest: dict, path: Path):
+    """
+    Write the manifest of a taxonomy. The file is replaced atomically so a crash never leaves a truncated manifest.
+
+    :param manifest: The manifest to write.
+    :param path: The path of the manifest file.
+    """
+    path = Path(path)
+    temporary_path = path.with_suffix(path.suffix + ".tmp")
+    with open(temporary_path, "w") as file:
+        json.dump(manifest, file)
+    temporary_path.replace(path)
+
+
+def compute_delta(documents: list[dict], manifest: dict, force: bool = False) -> tuple[list[dict], list[str], dict]:
+    """
+    Compare the concept documents of a taxonomy with its manifest from the last successful publish.
+    Concepts already in the manifest keep their document id, new concepts get the next free id.
+
+    :param documents: The concept documents produced by the current run.
+    :param manifest: The manifest of the last successful publish.
+    :param force: Whether to consider every concept as changed, e.g. to republish a whole taxonomy.
+    :return: A tuple containing the added or changed documents, the ids of the removed concepts, and the new manifest.
+    """
+    previous_concepts = manifest["concepts"]
+    next_id = manifest["next_id"]
+    concepts = {}
+    changed_documents = []
+
+    # Sorting makes the ids given to new concepts independent of the parsing order
+    for document in sorted(documents, key=lambda document: document[CONCEPT_KEY_COLUMN]):
+        key = document[CONCEPT_KEY_COLUMN]
+        content_hash = concept_hash(document)
+        previous = previous_concepts.get(key)
+
+        if previous is None:
+            document[CONCEPT_ID_COLUMN] = "{}_{}".format(document["Taxonomie"], next_id)
+            next_id += 1
+        else:
+            document[CONCEPT_ID_COLUMN] = previous[CONCEPT_ID_COLUMN]
+
+        if force or previous is None or previous["hash"] != content_hash:
+            changed_documents.append(document)
+        concepts[key] = {CONCEPT_ID_COLUMN: document[CONCEPT_ID_COLUMN], "hash": content_hash}
+
+    removed_ids = [
+        previous[CONCEPT_ID_COLUMN]
+        for key, previous in previous_concepts.items()
+        if key not in concepts
+    ]
+    return changed_documents, removed_ids, {"concepts": concepts, "next_id": next_id}
+
+
+def save_index_version(manifest_folder: Path) -> str:
+    """
+    Writes a new version stamp of the index, after a publish that changed it. Azure AI Search gives no version of an
+    index and a publish that updates concepts in place keeps its number of documents, so the RAG app reads this stamp
+    (INDEX_VERSION_PATH) to tell its stored alignments apart.
+
+    :param manifest_folder: The folder containing the manifests.
+    :return: The new version stamp.
+    """
+    version = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    path = Path(manifest_folder) / INDEX_VERSION_FILE_NAME
+    temporary_path = path.with_suffix(path.suffix + ".tmp")
+    temporary_path.write_text(version)
+    temporary_path.replace(path)
+    return version
+
@@ -0,0 +1,244 @@
+# Import relevant libraries
+import io
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import logging
+import threading
+from pathlib import Path
+from contextlib import contextmanager
+
+try:
+    # Not available on Windows, where the peak memory is sampled only
+    import resource
+except ImportError:
+    resource = None
+
+_RSS_SAMPLE_SECONDS = 0.05
+_PROFILE_TOP_FUNCTIONS = 20
+
+_lock = threading.Lock()
+_active_stage = None
+
+
+def _current_rss_bytes() -> int:
+    """
+    Returns the resident memory of the process, or 0 when it cannot be read (e.g. outside Linux).
+    """
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def _max_rss_bytes(who) -> int:
+    """
+    Returns the peak resident memory reported by getrusage (kilobytes on Linux, bytes on macOS).
+    """
+    if resource is None:
+        return 0
+    max_rss = resource.getrusage(who).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def record_api_calls(service: str, calls: int = 0, retries: int = 0, byte_count: int = 0):
+    """
+    Adds API calls made by the stage being measured (no effect outside of a measured stage).
+
+    :param service: The name of the API (e.g. embeddings, search, blob).
+    :param calls: The number of requests sent.
+    :param retries: The number of those requests that were retries.
+    :param byte_count: The number of bytes sent or received.
+    """
+    with _lock:
+        if _active_stage is None:
+            return
+        counters = _active_stage.api.setdefault(service, {"calls": 0, "retries": 0, "bytes": 0})
+        counters["calls"] += calls
+        counters["retries"] += retries
+        counters["bytes"] += byte_count
+
+
+class StageMetrics():
+    """
+    What one stage of the indexation cost: wall and CPU time, items and bytes produced, API calls and retries,
+    and the peak resident memory of the process (and of its worker processes).
+
+    Methods:
+    - add: Adds produced items and bytes.
+    - as_dict: Returns the metrics as a dictionary.
+    """
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.items = 0
+        self.bytes = 0
+        self.api = {}
+        self.peak_rss_bytes = 0
+        self.children_peak_rss_bytes = 0
+        self.error = None
+        self.profile = None
+        self.details = {}
+
+    def add(self, items: int = 0, byte_count: int = 0):
+        """
+        Adds items (e.g. documents) and bytes produced by the stage.
+
+        :param items: The number of items.
+        :param byte_count: The number of bytes.
+        """
+        self.items += items
+        self.bytes += byte_count
+
+    def as_dict(self) -> dict:
+        return {
+            "stage": self.name,
+            "wall_seconds": round(self.wall_seconds, 3),
+            "cpu_seconds": round(self.cpu_seconds, 3),
+            "items": self.items,
+            "items_per_second": round(self.items / self.wall_seconds, 1) if self.wall_seconds else None,
+            "bytes": self.bytes,
+            "megabytes_per_second": round(self.bytes / 1024 / 1024 / self.wall_seconds, 2) if self.wall_seconds else None,
+            "api": self.api,
+            "api_calls": sum(counters["calls"] for counters in self.api.values()),
+            "retries": sum(counters["retries"] for counters in self.api.values()),
+            "peak_rss_mb": round(self.peak_rss_bytes / 1024 / 1024, 1),
+            "children_peak_rss_mb": round(self.children_peak_rss_bytes / 1024 / 1024, 1),
+            "error": self.error,
+            "profile": self.profile,
+            **self.details,
+        }
+
+
+class Instrumentation():
+    """
+    Measures the stages of an indexation run and writes them to a JSON report, to find and follow regressions.
+
+    The peak resident memory of a stage is sampled by a background thread (and bounded by the getrusage peak where
+    the resource module exists). With a profile folder, each stage runs under cProfile and its profile is written
+    to <profile folder>/<stage>.prof, with the functions of highest cumulative time in the report. cProfile only
+    sees the thread that runs the stage, not the thread pools or the worker processes it starts.
+
+    Methods:
+    - stage: Context manager measuring one stage.
+    - report: Returns the report of the run.
+    - write: Writes the report to a JSON file.
+    """
+    def __init__(self, profile_folder: str = None, run_details: dict = None) -> None:
+        self.profile_folder = Path(profile_folder) if profile_folder else None
+        self.run_details = run_details or {}
+        self.stages = []
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+
+    def _sample_rss(self, metrics: StageMetrics, stop: threading.Event):
+        while not stop.wait(_RSS_SAMPLE_SECONDS):
+            metrics.peak_rss_bytes = max(metrics.peak_rss_bytes, _current_rss_bytes())
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Measures the stage run inside the with block. The API calls recorded meanwhile (see record_api_calls) are
+        counted for this stage. An error is recorded in the report and raised again.
+
+        :param name: The name of the stage.
+        :return: The StageMetrics of the stage, to add items and bytes to.
+        """
+        global _active_stage
+        metrics = StageMetrics(name)
+        self.stages.append(metrics)
+        logging.info(f"INSTRUMENTATION: stage {name} started")
+
+        # The getrusage peak only grows: it bounds this stage when it grew during the stage
+        max_rss_before = _max_rss_bytes(resource.RUSAGE_SELF) if resource else 0
+        metrics.peak_rss_bytes = _current_rss_bytes()
+        stop = threading.Event()
+        sampler = threading.Thread(target=self._sample_rss, args=(metrics, stop), daemon=True)
+        sampler.start()
+        profiler = cProfile.Profile() if self.profile_folder else None
+
+        with _lock:
+            _active_stage = metrics
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            if profiler is not None:
+                profiler.enable()
+            yield metrics
+        except BaseException as e:
+            metrics.error = repr(e)
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            metrics.wall_seconds = time.perf_counter() - wall_start
+            metrics.cpu_seconds = time.process_time() - cpu_start
+            with _lock:
+                _active_stage = None
+            stop.set()
+            sampler.join()
+            metrics.peak_rss_bytes = max(metrics.peak_rss_bytes, _current_rss_bytes())
+            if resource is not None:
+                max_rss_after = _max_rss_bytes(resource.RUSAGE_SELF)
+                if max_rss_after > max_rss_before:
+                    metrics.peak_rss_bytes = max(metrics.peak_rss_bytes, max_rss_after)
+                metrics.children_peak_rss_bytes = _max_rss_bytes(resource.RUSAGE_CHILDREN)
+            if profiler is not None:
+                metrics.profile = self._write_profile(name, profiler)
+            logging.info(
+                f"INSTRUMENTATION: stage {name} done in {metrics.wall_seconds:.1f}s, {metrics.items} items, "
+                f"peak RSS {metrics.peak_rss_bytes / 1024 / 1024:.0f} MB"
+            )
+
+    def _write_profile(self, name: str, profiler: cProfile.Profile) -> dict:
+        """
+        Writes the profile of a stage and returns its path with the functions of highest cumulative time.
+        """
+        self.profile_folder.mkdir(parents=True, exist_ok=True)
+        path = self.profile_folder / f"{name}.prof"
+        profiler.dump_stats(str(path))
+        stats = pstats.Stats(profiler, stream=io.StringIO()).sort_stats(pstats.SortKey.CUMULATIVE)
+        top = []
+        for function in stats.fcn_list[:_PROFILE_TOP_FUNCTIONS]:
+            _, calls, total_time, cumulative_time, _ = stats.stats[function]
+            file_name, line, function_name = function
+            top.append({
+                "function": f"{Path(file_name).name}:{line}({function_name})",
+                "calls": calls,
+                "total_seconds": round(total_time, 3),
+                "cumulative_seconds": round(cumulative_time, 3),
+            })
+        return {"path": str(path), "top_cumulative": top}
+
+    def report(self) -> dict:
+        """
+        Returns the report of the run: its details and the metrics of every stage.
+
+        :return: The report as a dictionary.
+        """
+        stages = [metrics.as_dict() for metrics in self.stages]
+        return {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started_at)),
+            "wall_seconds": round(time.perf_counter() - self._start, 3),
+            "peak_rss_mb": max((stage["peak_rss_mb"] for stage in stages), default=0.0),
+            **self.run_details,
+            "stages": stages,
+        }
+
+    def write(self, path: str) -> dict:
+        """
+        Writes the report to a JSON file.
+
+        :param path: The path of the JSON file.
+        :return: The report.
+        """
+        report = self.report()
+        with open(path, "w") as file:
+            json.dump(report, file, indent=2)
+        logging.info(f"INSTRUMENTATION: report written to {path}")
+        return report
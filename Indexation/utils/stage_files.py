@@ -0,0 +1,220 @@
+# Import relevant libraries
+import os
+from pathlib import Path
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+STAGE_BATCH_ROWS = int(os.getenv("STAGE_BATCH_ROWS", "2048"))
+STAGE_FILE_SUFFIX = ".parquet"
+# The rows to merge into a stage file, see merge_stage_file
+STAGE_CHANGES_SUFFIX = ".changes"
+
+
+def stage_path(folder: str, entry_id: str) -> Path:
+    """
+    Returns the path of the stage file of a taxonomy in a stage folder.
+
+    :param folder: The stage folder.
+    :param entry_id: The name of the taxonomy entry.
+    :return: The path of the Parquet file.
+    """
+    return Path(folder) / str(entry_id + STAGE_FILE_SUFFIX)
+
+
+def changes_path(path: str) -> Path:
+    """
+    Returns the path where the rows to merge into a stage file are written (not matched by the stage file globs).
+
+    :param path: The path of the stage file.
+    :return: The path of its changes file.
+    """
+    return Path(str(path) + STAGE_CHANGES_SUFFIX)
+
+
+def _record_batch(documents: list[dict], vectors: dict) -> pa.RecordBatch:
+    """
+    Converts documents with text fields, and their vectors, to an Arrow record batch.
+    Vectors are stored as fixed-size lists of float32, i.e. one contiguous buffer per batch.
+    """
+    names = list(documents[0].keys())
+    arrays = [pa.array([document.get(name) for document in documents], type=pa.string()) for name in names]
+    for name, matrix in vectors.items():
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        arrays.append(pa.FixedSizeListArray.from_arrays(pa.array(matrix.reshape(-1)), matrix.shape[1]))
+        names.append(name)
+    return pa.RecordBatch.from_arrays(arrays, names=names)
+
+
+def _split_record_batch(batch: pa.RecordBatch) -> tuple[list[dict], dict]:
+    """
+    Converts an Arrow record batch back to documents with text fields and a float32 matrix per vector column.
+    """
+    names = []
+    columns = []
+    vectors = {}
+    for name, column in zip(batch.schema.names, batch.columns):
+        if pa.types.is_fixed_size_list(column.type):
+            vectors[name] = column.flatten().to_numpy().reshape(len(batch), column.type.list_size)
+        else:
+            names.append(name)
+            columns.append(column.to_pylist())
+    documents = [dict(zip(names, values)) for values in zip(*columns)] if columns else [{} for _ in range(len(batch))]
+    return documents, vectors
+
+
+class StageWriter():
+    """
+    Writes the documents of a taxonomy to a stage file batch by batch, so a stage never holds
+    a whole taxonomy in memory. The file is written under a temporary name and only replaces
+    the previous one once closed without error.
+
+    Methods:
+    - write: Appends a batch of documents and their vectors.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = Path(path)
+        self.rows = 0
+        self._temporary_path = self.path.with_suffix(".tmp")
+        self._writer = None
+
+    def write(self, documents: list[dict], vectors: dict = None):
+        """
+        Appends a batch of documents, written as one row group.
+
+        :param documents: The documents, whose fields are strings.
+        :param vectors: Optional {column: float32 matrix} with one row per document.
+        """
+        if not documents:
+            return
+        batch = _record_batch(documents, vectors or {})
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self._temporary_path, batch.schema, compression="zstd")
+        self._writer.write_batch(batch)
+        self.rows += len(documents)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._writer is not None:
+            self._writer.close()
+        if exc_type is not None:
+            self._temporary_path.unlink(missing_ok=True)
+        elif self._writer is not None:
+            self._temporary_path.replace(self.path)
+        else:
+            # Nothing was written: no stale file from a previous run should remain
+            self.path.unlink(missing_ok=True)
+
+
+def write_stage_documents(documents, path: str, batch_rows: int = STAGE_BATCH_ROWS) -> int:
+    """
+    Writes the documents produced by an iterable (e.g. a generator) to a stage file, batch by batch.
+
+    :param documents: The iterable of documents, whose fields are strings.
+    :param path: The path of the stage file.
+    :param batch_rows: The number of documents per row group.
+    :return: The number of documents written.
+    """
+    with StageWriter(path) as writer:
+        batch = []
+        for document in documents:
+            batch.append(document)
+            if len(batch) >= batch_rows:
+                writer.write(batch)
+                batch = []
+        writer.write(batch)
+    return writer.rows
+
+
+def iter_stage_batches(path: str, batch_rows: int = STAGE_BATCH_ROWS, columns: list[str] = None):
+    """
+    Reads a stage file batch by batch. Row groups are read one at a time (ParquetFile.iter_batches reads
+    ahead of the consumer), so only one row group is decoded in memory at once.
+
+    :param path: The path of the stage file.
+    :param batch_rows: The maximum number of documents per batch.
+    :param columns: The columns to read (default: every column).
+    :return: A generator of (documents, {vector column: float32 matrix}) tuples.
+    """
+    parquet_file = pq.ParquetFile(path)
+    for row_group in range(parquet_file.num_row_groups):
+        table = parquet_file.read_row_group(row_group, columns=columns, use_threads=False)
+        for batch in table.to_batches(max_chunksize=batch_rows):
+            yield _split_record_batch(batch)
+
+
+def iter_stage_documents(path: str, batch_rows: int = STAGE_BATCH_ROWS):
+    """
+    Reads a stage file batch by batch, with the vectors put back in the documents as lists of floats
+    (the form expected by the Azure AI Search client).
+
+    :param path: The path of the stage file.
+    :param batch_rows: The maximum number of documents per batch.
+    :return: A generator of lists of documents.
+    """
+    for documents, vectors in iter_stage_batches(path, batch_rows):
+        for name, matrix in vectors.items():
+            for document, vector in zip(documents, matrix.tolist()):
+                document[name] = vector
+        yield documents
+
+
+def read_stage_documents(path: str, columns: list[str] = None) -> list[dict]:
+    """
+    Reads the text fields of all the documents of a stage file.
+
+    :param path: The path of the stage file.
+    :param columns: The columns to read (default: every column but the vectors).
+    :return: The documents.
+    """
+    if columns is None:
+        schema = pq.read_schema(path)
+        columns = [field.name for field in schema if not pa.types.is_fixed_size_list(field.type)]
+    documents = []
+    for batch, _ in iter_stage_batches(path, columns=columns):
+        documents.extend(batch)
+    return documents
+
+
+def count_stage_documents(path: str) -> int:
+    """
+    Returns the number of documents of a stage file, from its metadata.
+
+    :param path: The path of the stage file.
+    :return: The number of documents.
+    """
+    return pq.ParquetFile(path).metadata.num_rows
+
+
+def merge_stage_file(path: str, removed_ids=(), id_column: str = "id"):
+    """
+    Merges the changes file of a stage file (see changes_path), if any, into it: its rows replace the rows with the
+    same id, and the rows of removed_ids are left out. The file is rewritten row group by row group, so the stage
+    folder keeps every document of the taxonomy while a run only processes the changed ones.
+
+    :param path: The path of the stage file.
+    :param removed_ids: The ids of the documents to remove.
+    :param id_column: The column of the document ids.
+    """
+    path = Path(path)
+    changes = changes_path(path)
+    replaced = set(removed_ids)
+    if not replaced and not changes.exists():
+        return
+    if changes.exists():
+        replaced.update(document[id_column] for document in read_stage_documents(changes, columns=[id_column]))
+    with StageWriter(path) as writer:
+        if path.exists():
+            for documents, vectors in iter_stage_batches(path):
+                kept = [position for position, document in enumerate(documents) if document[id_column] not in replaced]
+                if kept:
+                    writer.write([documents[position] for position in kept], {name: matrix[kept] for name, matrix in vectors.items()})
+        if changes.exists():
+            for documents, vectors in iter_stage_batches(changes):
+                writer.write(documents, vectors)
+    changes.unlink(missing_ok=True)
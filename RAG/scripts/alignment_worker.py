@@ -0,0 +1,18 @@
+import os
+import sys
+import logging
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.alignment_jobs import run_worker
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the queued alignment jobs (see utils/alignment_jobs.py).")
+    parser.add_argument("--poll", type=float, default=2.0, help="Seconds to wait when no job is queued (default: 2).")
+    parser.add_argument("--once", action="store_true", help="Stop when no job is queued instead of waiting.")
+    parser.add_argument("--idle", type=float, default=0, help="Stop after waiting this many seconds for a job (default: 0, never).")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(process)d %(levelname)s %(message)s")
+    run_worker(poll_seconds=args.poll, once=args.once, idle_seconds=args.idle)
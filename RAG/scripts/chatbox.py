@@ -1,3 +1,4 @@
+import io
 import json
 import asyncio
 import streamlit as st
@@ -9,7 +10,8 @@ from openpyxl.utils.dataframe import dataframe_to_rows
 
 from utils.import_ttl import import_ttl
 from utils.chat_functions import chat_with_index
-from utils.taxo_mapping import mapping_taxonomies, chatting_and_mapping_taxonomies
+from utils.taxo_mapping import chatting_and_mapping_taxonomies
+from utils.alignment_jobs import get_alignment_jobs, start_workers, JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_CANCELLED
 
 VARIABLES_DATA = [["Class URI", "http://mapping.D4W.com/entity1alignment", ""],["PREFIX", "mapping", "http://mapping.D4W.com/entity1alignment/"],["PREFIX", "align", "http://knowledgeweb.semanticweb.org/heterogeneity/alignment#"],["PREFIX", "skos", "http://www.w3.org/2004/02/skos/core#"],["rdf:type", "align:Alignment", ""],["", "", ""]]
 VARIABLES_DATA_1 = [["Class URI", "http://mapping.D4W.com/entity1", ""],["PREFIX", "align", "http://knowledgeweb.semanticweb.org/heterogeneity/alignment#"],["PREFIX", "skos", "http://www.w3.org/2004/02/skos/core#"],["", "", ""]]
@@ -80,19 +82,16 @@ def set_chatbox_layout(chosen_function):
 
 
     if chosen_function == "Alignement de taxonomies":  
-        # Export mapping button  
-        if st.button("Exporter le mapping"):  
-            response_df = map_taxonomies(st.session_state["ttl_data"][1], st.session_state["selected_taxonomy"])
-            print(response_df)  
-            if response_df is not None:  
-                # Save the DataFrame to an Excel file  
-                excel_file = "mapping_result.xlsx"  
-                #Add Excel template function
-                #response_df.to_excel(excel_file, index=False)
-                write_excel(response_df[["URI", "rdf:type", "align:entity1", "align:entity2", "align:relation", "align:measure^^xsd:float", "owl:annotatedProperty"]], response_df[["URI ", "skos:prefLabel", "skos:definition"]], response_df[["URI  ", "skos:prefLabel ", "skos:definition "]], excel_file)  
-                # Provide a download button  
-                with open(excel_file, "rb") as file:  
-                    st.download_button(label="Télécharger le mapping", data=file, file_name=excel_file)  
+        # Export mapping button: the alignment runs in a background job, see show_mapping_job
+        if st.button("Exporter le mapping"):
+            job_id = submit_mapping(st.session_state["ttl_data"][1], st.session_state["selected_taxonomy"])
+            st.session_state["mapping_job"] = job_id
+            # Kept in the URL so the job is found again after the tab is reloaded
+            st.query_params["job"] = job_id
+
+        job_id = st.session_state.get("mapping_job") or st.query_params.get("job")
+        if job_id:
+            show_mapping_job(job_id)
         
     # Display existing messages in the Streamlit interface  
     for msg in st.session_state.history:  
@@ -129,31 +128,86 @@ def set_chatbox_layout(chosen_function):
     """, unsafe_allow_html=True)
 
 
-def map_taxonomies(ttl_data, selected_taxonomy):
+def submit_mapping(ttl_data, selected_taxonomy):
     """
-    Maps taxonomies based on the provided TTL data and selected taxonomy.  
+    Submits the alignment of the concepts of the TTL data to the background alignment jobs, starting the worker processes if needed.  
   
     :param ttl_data: The TTL data containing taxonomy information.  
     :param selected_taxonomy: The selected taxonomy to map.  
-    :return: DataFrame containing the mapped taxonomies.
-    """
-    mappings = []
-    j = 1
-
-    for index in ttl_data.index:
-        try: 
-            if selected_taxonomy != "All":
-                response, j = mapping_taxonomies(user_label=ttl_data["prefLabel"][index], user_definition=ttl_data["definition"][index], user_uri=ttl_data["subject"][index], j=j, taxonomy_filter=selected_taxonomy, loop=True)
-            else:
-                response, j = mapping_taxonomies(user_label=ttl_data["prefLabel"][index], user_definition=ttl_data["definition"][index], user_uri=ttl_data["subject"][index], j=j, taxonomy_filter=None, loop=True)
-            
-            mappings.extend(response)
-        except: 
-            continue
-    
-    responses = pd.DataFrame.from_records(mappings)
+    :return: The id of the job.
+    """
+    concepts = list(zip(ttl_data["prefLabel"], ttl_data["definition"], ttl_data["subject"]))
+    start_workers()
+    return get_alignment_jobs().submit(concepts, selected_taxonomy if selected_taxonomy != "All" else None)
+
+
+def mapping_excel(mappings):
+    """
+    Writes the mappings of a job to an Excel file in memory.  
+  
+    :param mappings: The mapping rows of the job.  
+    :return: The content of the Excel file.
+    """
+    response_df = pd.DataFrame.from_records(mappings, columns=["URI", "rdf:type", "align:entity1", "align:entity2", "align:relation", "align:measure^^xsd:float", "owl:annotatedProperty", "URI ", "skos:prefLabel", "skos:definition", "URI  ", "skos:prefLabel ", "skos:definition "])
+    excel_file = io.BytesIO()
+    write_excel(response_df[["URI", "rdf:type", "align:entity1", "align:entity2", "align:relation", "align:measure^^xsd:float", "owl:annotatedProperty"]], response_df[["URI ", "skos:prefLabel", "skos:definition"]], response_df[["URI  ", "skos:prefLabel ", "skos:definition "]], excel_file)
+    return excel_file.getvalue()
+
+
+@st.fragment(run_every=2)
+def _poll_mapping_job(job_id):
+    """
+    Shows the progress of a queued or running job, refreshed every 2 seconds without rerunning the rest of the page, and reruns the page once the job ended.  
+  
+    :param job_id: The id of the job.
+    """
+    jobs = get_alignment_jobs()
+    job = jobs.get(job_id)
+    if job is None or job["status"] not in (JOB_QUEUED, JOB_RUNNING):
+        st.rerun()
+
+    if job["status"] == JOB_QUEUED:
+        st.progress(0.0, text=f"Alignement en attente ({job['queue_position']} export(s) dans la file)...")
+    else:
+        st.progress(job["done"] / max(job["total"], 1), text=f"{job['done']}/{job['total']} concepts alignés, {job['failed']} en erreur")
+    if st.button("Annuler l'export", key=f"cancel_{job_id}"):
+        jobs.cancel(job_id)
+
+
+def show_mapping_job(job_id):
+    """
+    Shows a mapping job: its progress while it runs, then the concepts that could not be aligned and the download of the mapping
+    (the partial mapping of a job cancelled while it ran).  
+  
+    :param job_id: The id of the job.
+    """
+    jobs = get_alignment_jobs()
+    job = jobs.get(job_id)
+    if job is None:
+        return
+    if job["status"] in (JOB_QUEUED, JOB_RUNNING):
+        _poll_mapping_job(job_id)
+        return
+    result = jobs.result(job_id)
+    if job["status"] == JOB_CANCELLED:
+        # A job cancelled while it ran keeps the mappings of the concepts aligned until then
+        if result is None:
+            st.info("L'export a été annulé.")
+            return
+        st.info(f"L'export a été annulé: {job['done']}/{job['total']} concepts alignés avant l'annulation.")
+    elif job["status"] != JOB_DONE:
+        st.error(f"L'export a échoué: {job['error']}")
+        return
 
-    return responses
+    mappings, errors = result
+    if errors:
+        st.warning(f"{len(errors)} concepts n'ont pas pu être alignés.")
+        st.dataframe(pd.DataFrame.from_records(errors))
+    # The Excel file is built once per job
+    if st.session_state.get("mapping_excel", (None,))[0] != job_id:
+        st.session_state["mapping_excel"] = (job_id, mapping_excel(mappings))
+    label = "Télécharger le mapping partiel" if job["status"] == JOB_CANCELLED else "Télécharger le mapping"
+    st.download_button(label=label, data=st.session_state["mapping_excel"][1], file_name="mapping_result.xlsx")
 
 async def chat_and_map_taxonomies(user_input, ttl_data, selected_taxonomy, history):
     """
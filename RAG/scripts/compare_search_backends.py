@@ -0,0 +1,75 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.RDF import ScrapingRDF
+from utils.graph_cache import load_taxonomy
+from utils.search_backends import create_search_backend
+from utils.taxo_mapping import _search_taxonomies
+
+
+def compare_search_backends(ttl_path, reference, candidate, taxonomy_filter=None, top=5, limit=None):
+    """
+    Runs the mapping search of every concept of a taxonomy on two search backends and measures how many of the
+    documents found by the reference backend are also found by the candidate backend.
+
+    :param ttl_path: The path of the TTL file whose concepts are used as queries.
+    :param reference: The name of the reference backend (e.g. azure).
+    :param candidate: The name of the compared backend (e.g. hybrid).
+    :param taxonomy_filter: An optional taxonomy to search in.
+    :param top: The number of documents returned per query.
+    :param limit: The maximum number of concepts to query.
+    :return: A dictionary with the recall@top of the candidate, the top-1 agreement and the latency of each backend.
+    """
+    concepts = ScrapingRDF().ScrapeRDF(None, [], load_taxonomy(ttl_path).concept_store)[:limit]
+    backends = {reference: create_search_backend(reference), candidate: create_search_backend(candidate)}
+    latencies = {name: [] for name in backends}
+    recalls = []
+    top1 = []
+
+    for concept in concepts:
+        uris = {}
+        for name, backend in backends.items():
+            start = time.perf_counter()
+            results = _search_taxonomies(concept["prefLabel"], concept["definition"], taxonomy_filter, backend=backend)
+            latencies[name].append(time.perf_counter() - start)
+            uris[name] = [result["uri"] for result in results[:top]]
+        if uris[reference]:
+            recalls.append(len(set(uris[reference]) & set(uris[candidate])) / len(uris[reference]))
+            top1.append(bool(uris[candidate]) and uris[candidate][0] == uris[reference][0])
+
+    return {
+        "queries": len(concepts),
+        "top": top,
+        f"recall@{top}": float(np.mean(recalls)) if recalls else None,
+        "top1_agreement": float(np.mean(top1)) if top1 else None,
+        "latency_ms": {
+            name: {
+                "mean": 1000 * float(np.mean(values)) if values else None,
+                "p95": 1000 * float(np.percentile(values, 95)) if values else None,
+            }
+            for name, values in latencies.items()
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the recall of two search backends on the concepts of a taxonomy.")
+    parser.add_argument("ttl_path", help="TTL file whose concepts are used as queries.")
+    parser.add_argument("--reference", default="azure", help="Reference backend (default: azure).")
+    parser.add_argument("--candidate", default="hybrid", help="Compared backend (default: hybrid).")
+    parser.add_argument("--filter", default=None, help="Taxonomy to search in.")
+    parser.add_argument("--top", type=int, default=5)
+    parser.add_argument("--limit", type=int, default=None, help="Maximum number of concepts to query.")
+    arguments = parser.parse_args()
+
+    print(json.dumps(
+        compare_search_backends(
+            arguments.ttl_path, arguments.reference, arguments.candidate, arguments.filter, arguments.top, arguments.limit
+        ),
+        indent=2,
+    ))
@@ -0,0 +1,11 @@
+import os
+import sys
+from pathlib import Path
+
+# The modules import each other as utils.*, from the RAG folder
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+# The Azure OpenAI clients are created when utils.taxo_mapping is imported; the tests never call them
+os.environ.setdefault("AZURE_OPENAI_API_KEY", "test")
+os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "https://test.openai.azure.com")
+os.environ.setdefault("OPENAI_API_VERSION", "2024-06-01")
@@ -0,0 +1,69 @@
+import json
+
+import pytest
+
+from utils.taxo_mapping import _parse_batch_comparison
+
+
+def match(candidate, relation="none", confidence=0.9):
+    return {"candidate": candidate, "relation": relation, "confidence": confidence}
+
+
+def answer(*alignments):
+    return json.dumps({"alignments": [{"source": source, "matches": matches} for source, matches in alignments]})
+
+
+def test_complete_answer_sorted_by_candidate():
+    content = answer(
+        (2, [match(1, "exactMatch", 1)]),
+        (1, [match(2), match(1, "closeMatch", 0.7)]),
+    )
+    assert _parse_batch_comparison(content, [2, 1]) == [
+        [match(1, "closeMatch", 0.7), match(2)],
+        [match(1, "exactMatch", 1)],
+    ]
+
+
+def test_missing_source_concepts():
+    content = answer((2, [match(1)]))
+    assert _parse_batch_comparison(content, [1, 1, 1]) == [None, [match(1)], None]
+    assert _parse_batch_comparison(json.dumps({"alignments": []}), [1, 2]) == [None, None]
+
+
+@pytest.mark.parametrize("matches", [
+    [match(1)],                                   # a candidate is missing
+    [match(1), match(2), match(3)],               # one candidate too many
+    [match(1), match(1)],                         # a candidate answered twice
+    [match(1), match(2, "broadMatch")],           # unknown relation
+    [match(1), match(2, confidence=1.5)],         # confidence out of range
+    [match(1), match(2, confidence="high")],      # confidence not a number
+    [match(1), {"candidate": 2, "relation": "none"}],
+])
+def test_partial_or_malformed_answer_of_one_source(matches):
+    content = answer((1, matches), (2, [match(1, "exactMatch")]))
+    assert _parse_batch_comparison(content, [2, 1]) == [None, [match(1, "exactMatch")]]
+
+
+@pytest.mark.parametrize("source", [0, 3, "1", None])
+def test_unknown_sources_are_ignored(source):
+    content = json.dumps({"alignments": [{"source": source, "matches": [match(1)]}]})
+    assert _parse_batch_comparison(content, [1, 1]) == [None, None]
+
+
+def test_first_answer_of_a_source_is_kept():
+    content = answer((1, [match(1, "exactMatch")]), (1, [match(1)]))
+    assert _parse_batch_comparison(content, [1]) == [[match(1, "exactMatch")]]
+
+
+def test_later_valid_answer_replaces_a_malformed_one():
+    content = answer((1, [match(1, "broadMatch")]), (1, [match(1, "closeMatch")]))
+    assert _parse_batch_comparison(content, [1]) == [[match(1, "closeMatch")]]
+
+
+def test_cut_answer_raises():
+    # The caller then asks every source concept of the batch again
+    content = answer((1, [match(1)]), (2, [match(1)]))
+    with pytest.raises(ValueError):
+        _parse_batch_comparison(content[:-10], [1, 1])
+    with pytest.raises(KeyError):
+        _parse_batch_comparison(json.dumps({"mappings": []}), [1])
@@ -14,6 +14,53 @@ import re
 
 from typing import Any, Dict, Iterable, Iterator, List, Optional
 
+SKOS_PREF_LABEL = SKOS.prefLabel
+SKOS_ALT_LABEL = SKOS.altLabel
+SKOS_DEFINITION = SKOS.definition
+SKOS_RELATED = SKOS.related
+SKOS_BROADER = SKOS.broader
+SKOS_NARROWER = SKOS.narrower
+
+
+def _group_literals_by_language(objects):
+    """
+    Groups the literal objects of a predicate by language tag ('default' when untagged).
+
+    :param objects: The objects of a predicate, in the order of the graph.
+    :return: A dictionary {language: [texts]}.
+    """
+    labels = {}
+    for obj in objects:
+        if isinstance(obj, Literal):
+            lang = obj.language if obj.language else 'default'
+            if lang not in labels:
+                labels[lang] = []
+            labels[lang].append(str(obj))
+    return labels
+
+
+class ConceptTable():
+    """
+    The triples of the concepts of an RDF graph, walked once.
+
+    Attributes:
+    - predicates: {concept: {predicate: [objects]}} in the order of the graph.
+    - pref_labels: {concept: {language: [prefLabels]}}, the labels used to describe the neighbours of a concept.
+    """
+    def __init__(self) -> None:
+        self.predicates = {}
+        self.pref_labels = {}
+
+    def update(self, other):
+        """
+        Adds the concepts of another table to this one.
+
+        :param other: The ConceptTable to merge.
+        """
+        self.predicates.update(other.predicates)
+        self.pref_labels.update(other.pref_labels)
+
+
 class ScrapingRDF():
     """
     A class to scrape and process RDF data.  
@@ -32,53 +79,81 @@ class ScrapingRDF():
     def __init__(self) -> None:
         pass
 
-    def extract_concept_info(self, graph, concept_uri): 
+    def build_concept_table(self, graph, concept_uris=None):
+        """
+        Walks the triples of every concept once and groups their objects by predicate.
+
+        The labels of the neighbours of a concept are then read from the prefLabel map of the
+        table instead of querying the graph again for every neighbour.
+
+        :param graph: The RDF graph to extract information from.
+        :param concept_uris: The concepts to include (default: every subject having a prefLabel).
+        :return: The ConceptTable of the concepts.
+        """
+        if concept_uris is None:
+            concept_uris = graph.subjects(predicate=SKOS_PREF_LABEL, unique=True)
+
+        concept_table = ConceptTable()
+        for concept in concept_uris:
+            predicates = {}
+            for predicate, obj in graph.predicate_objects(concept):
+                if predicate not in predicates:
+                    predicates[predicate] = []
+                predicates[predicate].append(obj)
+            concept_table.predicates[concept] = predicates
+            concept_table.pref_labels[concept] = _group_literals_by_language(
+                predicates.get(SKOS_PREF_LABEL, [])
+            )
+        return concept_table
+
+    def extract_concept_info(self, graph, concept_uri, concept_table=None):  
         """
         Extracts information about a concept from the RDF graph.  
   
+        This method extracts preferred labels, alternative labels, definitions,  
+        related entities, broader entities, narrower entities, and linked triples  
+        for a given concept URI.  
+  
         :param graph: The RDF graph to extract information from.  
         :param concept_uri: The URI of the concept to extract information for.  
+        :param concept_table: The ConceptTable built by build_concept_table (default: built for the concept and its neighbours).  
+  
         :return: A dictionary containing the extracted concept information.  
-        """ 
+        """
         concept = URIRef(concept_uri)  
+
+        if concept_table is None:
+            concept_table = self.build_concept_table(graph, [concept])
+            neighbours = [
+                entity
+                for predicate in (SKOS_RELATED, SKOS_BROADER, SKOS_NARROWER)
+                for entity in concept_table.predicates[concept].get(predicate, [])
+            ]
+            concept_table.update(self.build_concept_table(graph, neighbours))
+
+        predicates = concept_table.predicates.get(concept, {})
         
-        def get_labels_and_definitions(predicate):  
-            labels = {}  
-            for obj in graph.objects(concept, predicate):  
-                if isinstance(obj, Literal):  
-                    lang = obj.language if obj.language else 'default'  
-                    if lang not in labels:  
-                        labels[lang] = []  
-                    labels[lang].append(str(obj))  
-            return labels  
-        
-        pref_labels = get_labels_and_definitions(SKOS.prefLabel)  
-        alt_labels = get_labels_and_definitions(SKOS.altLabel)  
-        definitions = get_labels_and_definitions(SKOS.definition)  
-        
-        related_entities = list(graph.objects(concept, SKOS.related))  
-        broader_entities = list(graph.objects(concept, SKOS.broader))  
-        narrower_entities = list(graph.objects(concept, SKOS.narrower))  
+        pref_labels = _group_literals_by_language(predicates.get(SKOS_PREF_LABEL, []))  
+        alt_labels = _group_literals_by_language(predicates.get(SKOS_ALT_LABEL, []))  
+        definitions = _group_literals_by_language(predicates.get(SKOS_DEFINITION, []))  
         
         def get_related_labels(entities):  
             related_labels = {}  
             for entity in entities:  
-                for obj in graph.objects(entity, SKOS.prefLabel):  
-                    if isinstance(obj, Literal):  
-                        lang = obj.language if obj.language else 'default'  
-                        if lang not in related_labels:  
-                            related_labels[lang] = []  
-                        related_labels[lang].append(str(obj))  
+                for lang, labels in concept_table.pref_labels.get(entity, {}).items():  
+                    if lang not in related_labels:  
+                        related_labels[lang] = []  
+                    related_labels[lang].extend(labels)  
             return related_labels
 
-        related_entities_labels = get_related_labels(related_entities)  
-        broader_entities_labels = get_related_labels(broader_entities)  
-        narrower_entities_labels = get_related_labels(narrower_entities)
+        related_entities_labels = get_related_labels(predicates.get(SKOS_RELATED, []))  
+        broader_entities_labels = get_related_labels(predicates.get(SKOS_BROADER, []))  
+        narrower_entities_labels = get_related_labels(predicates.get(SKOS_NARROWER, []))
 
-        # Extract triples linked to the concept  
-        linked_triples = list(graph.triples((concept, None, None)))
-        linked_triples_str = " ".join([f"{s} {p} {o}" for s, p, o in linked_triples])  
-    
+        # Triples linked to the concept, in the order of the graph  
+        linked_triples_str = " ".join(
+            [f"{concept} {predicate} {obj}" for predicate, objects in predicates.items() for obj in objects]
+        )  
 
         return {  
             "pref_labels": pref_labels,  
@@ -130,25 +205,27 @@ class ScrapingRDF():
 
         return document, full_text 
 
-    def ScrapeRDF(self, g, KnowledgeBase):
+    def ScrapeRDF(self, g, KnowledgeBase, concept_store=None):
         """
         Scrapes RDF data and builds a knowledge base.  
   
-        :param g: The RDF graph to scrape.  
+        :param g: The RDF graph to scrape (unused when concept_store is given).  
         :param KnowledgeBase: A list to which the extracted documents will be appended.  
+        :param concept_store: The ConceptStore of the taxonomy, e.g. loaded from the graph cache (default: built from g).  
         :return: The updated knowledge base with the extracted documents.  
         """
-        concept_uris = set(g.subjects(predicate=SKOS.prefLabel))  
+        if concept_store is None:
+            # Imported here since the concept store builds on the SKOS predicates of this module
+            from utils.concept_store import ConceptStore
+            concept_store = ConceptStore.from_graph(g)
         KnowledgeBase = []
 
-        id = 1
-
-        for concept_uri in concept_uris:  
-            concept_info = self.extract_concept_info(g, concept_uri)  
-            document, combined_text = self.concatenate_info(concept_info, concept_uri, "ttl", id, lang='en')
+        for position in range(len(concept_store)):
+            concept_info = concept_store.concept_info(position)
+            document, combined_text = self.concatenate_info(
+                concept_info, concept_store.concept_uri(position), "ttl", position + 1, lang='en'
+            )
             KnowledgeBase.append(document)
             print(combined_text)
 
-            id += 1
-
         return KnowledgeBase
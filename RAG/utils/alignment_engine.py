@@ -0,0 +1,577 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import httpx
+import numpy as np
+from openai import AsyncAzureOpenAI, RateLimitError, APIConnectionError, APITimeoutError, InternalServerError
+from azure.core.exceptions import HttpResponseError, ServiceRequestError
+from dotenv import load_dotenv
+
+from utils.embedding_cache import get_embedding_cache
+from utils.mapping_store import MAPPING_INDEX_VERSION, get_mapping_store
+from utils.rate_limits import AdaptiveConcurrency, estimate_tokens
+from utils.search_backends import get_search_backend, get_local_search_backend
+from utils.taxo_mapping import (
+    _embedding_deployment,
+    comparison_deployment,
+    _search_query,
+    _taxonomy_filter_condition,
+    _build_matches,
+    _cascade,
+    _comparison_messages,
+    _batch_comparison_prompt,
+    _parse_batch_comparison,
+    _select_batch_mappings,
+    _number_mappings,
+    alignment_settings,
+    BATCH_COMPARISON_RESPONSE_FORMAT,
+)
+
+load_dotenv()
+
+ALIGNMENT_MAX_CONCURRENCY = int(os.getenv("ALIGNMENT_MAX_CONCURRENCY", "16"))
+ALIGNMENT_MAX_RETRIES = int(os.getenv("ALIGNMENT_MAX_RETRIES", "8"))
+# Source concepts compared in one GPT request, within the context window and output limit of the deployment
+ALIGNMENT_BATCH_SIZE = int(os.getenv("ALIGNMENT_BATCH_SIZE", "20"))
+ALIGNMENT_CONTEXT_TOKENS = int(os.getenv("ALIGNMENT_CONTEXT_TOKENS", "128000"))
+ALIGNMENT_MAX_OUTPUT_TOKENS = int(os.getenv("ALIGNMENT_MAX_OUTPUT_TOKENS", "16384"))
+# How the candidates are found: "search" (one search per concept on SEARCH_BACKEND) or "matrix" (every concept at
+# once against the vectors of the local index, see _match_all)
+ALIGNMENT_CANDIDATES = os.getenv("ALIGNMENT_CANDIDATES", "search")
+ALIGNMENT_EMBEDDING_BATCH_SIZE = int(os.getenv("ALIGNMENT_EMBEDDING_BATCH_SIZE", "256"))
+# Memory of the blocks of scores of the matrix mode
+ALIGNMENT_MATRIX_MEMORY_BYTES = int(os.getenv("ALIGNMENT_MATRIX_MEMORY_BYTES", str(256 * 1024 * 1024)))
+# Times a source concept is asked again when its part of the answer is malformed
+ALIGNMENT_MAX_MALFORMED_RETRIES = 2
+
+# Status codes of Azure AI Search when the service is throttling
+_SEARCH_THROTTLE_STATUS = (429, 503)
+
+
+def _retry_after_seconds(error: Exception) -> float:
+    """
+    Reads the delay requested by the service in the headers of a throttled response.
+
+    :param error: The error raised by the OpenAI or the Azure AI Search client.
+    :return: The number of seconds to wait, or None when the response has no such header.
+    """
+    response = getattr(error, "response", None)
+    headers = response.headers if response is not None else {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def _is_throttled(error: Exception) -> bool:
+    return isinstance(error, RateLimitError) or (
+        isinstance(error, HttpResponseError) and error.status_code in _SEARCH_THROTTLE_STATUS
+    )
+
+
+def _is_transient(error: Exception) -> bool:
+    return isinstance(error, (APIConnectionError, APITimeoutError, InternalServerError, ServiceRequestError)) or (
+        isinstance(error, HttpResponseError) and error.status_code is not None and error.status_code >= 500
+    )
+
+
+class _Comparison():
+    """
+    A source concept whose candidates were found, waiting for the GPT comparison. decided holds the mappings the
+    cascade decided without GPT, recorded with the ones of the comparison.
+    """
+    __slots__ = ("position", "label", "definition", "uri", "matches", "candidates", "decided", "input_tokens", "output_tokens", "attempts")
+
+    def __init__(self, position, label, definition, uri, matches, candidates, decided) -> None:
+        self.position = position
+        self.label = label
+        self.definition = definition
+        self.uri = uri
+        self.matches = matches
+        self.candidates = candidates
+        self.decided = decided
+        self.input_tokens = estimate_tokens(f"{label}{definition}") + sum(estimate_tokens(candidate) for candidate in candidates) + 10 * (len(candidates) + 3)
+        # About 20 tokens of JSON per match
+        self.output_tokens = 20 * len(candidates) + 10
+        self.attempts = 0
+
+
+class AlignmentEngine():
+    """
+    Aligns every concept of a taxonomy on the index: for each concept, one embedding of its search query (unless
+    cached) and one search, then a cheap-first cascade (taxo_mapping._cascade) that maps the candidates sharing a label
+    with the concept as exactMatch and drops the candidates scored below the threshold, and a GPT comparison of the
+    candidates left. The concepts are processed concurrently on a single AsyncAzureOpenAI client and the asynchronous
+    search backend.
+
+    In matrix mode (ALIGNMENT_CANDIDATES=matrix), the per-concept searches are replaced by one candidate generation for
+    the whole taxonomy: the search queries are embedded in batches and scored against the vectors of the local index
+    (LOCAL_SEARCH_INDEX_PATH) with blocked matrix products, within a memory budget. The candidates are the vector
+    search results, with the cosine similarity as score.
+
+    The comparisons are batched: up to batch_size source concepts, with their candidates, share one request, so the
+    instructions are sent once per batch instead of once per concept. The batches are sized to fit the context window
+    (ALIGNMENT_CONTEXT_TOKENS) and the output limit (ALIGNMENT_MAX_OUTPUT_TOKENS) of the deployment. The answer follows
+    a strict JSON schema; the source concepts whose part of the answer is malformed are asked again in a smaller batch,
+    and a batch whose request fails is split in two so only the failing half is retried.
+
+    The requests in flight are limited by an AdaptiveConcurrency: throttled requests (429) wait for the delay given
+    by the Retry-After headers and halve the limit, at most once per window, so the engine settles just below the
+    quotas of the deployments.
+    A concept that still fails is recorded with its error and the others go on. The mappings are numbered
+    mapping:cell/1, mapping:cell/2, ... in the order of the concepts, as a serial run would number them.
+
+    The alignment of each concept is kept in the MappingStore, keyed by its uri, label and definition, the taxonomy
+    filter, the version of the index and the alignment settings. A new export of the same taxonomy reuses the stored mappings and only aligns
+    the concepts added or changed since, the concepts that failed, or all of them when the index changed.
+
+    Methods:
+    - align: Aligns a list of concepts.
+    - cancel: Stops a running alignment.
+    - run: Synchronous entry point around align.
+    """
+    def __init__(
+        self,
+        taxonomy_filter: str = None,
+        max_concurrency: int = None,
+        max_retries: int = ALIGNMENT_MAX_RETRIES,
+        batch_size: int = None,
+        backend=None,
+        on_progress=None,
+        candidates: str = None,
+        store=None,
+    ) -> None:
+        """
+        :param taxonomy_filter: The taxonomy of the index to align on, or None for all of them.
+        :param max_concurrency: The maximum number of requests in flight (default: ALIGNMENT_MAX_CONCURRENCY).
+        :param max_retries: The number of retries of a throttled or failed request.
+        :param batch_size: The maximum number of source concepts per comparison request (default: ALIGNMENT_BATCH_SIZE).
+        :param backend: The SearchBackend to query (default: the one chosen by SEARCH_BACKEND, or the local index in matrix mode).
+        :param on_progress: Optional callback called with (done, total, failed) each time a concept is processed.
+        :param candidates: How the candidates are found, "search" or "matrix" (default: ALIGNMENT_CANDIDATES).
+        :param store: The MappingStore of the previous alignments (default: the one of MAPPING_STORE_PATH, if any).
+        """
+        if (candidates or ALIGNMENT_CANDIDATES) not in ("search", "matrix"):
+            raise ValueError(f"Unknown ALIGNMENT_CANDIDATES: {candidates or ALIGNMENT_CANDIDATES}")
+        self.taxonomy_filter = taxonomy_filter
+        self.filter_condition = _taxonomy_filter_condition(taxonomy_filter)
+        self.max_concurrency = max_concurrency or ALIGNMENT_MAX_CONCURRENCY
+        self.max_retries = max_retries
+        self.batch_size = max(1, batch_size or ALIGNMENT_BATCH_SIZE)
+        self.backend = backend
+        self.on_progress = on_progress
+        self.candidates = candidates or ALIGNMENT_CANDIDATES
+        self.store = store
+        self.reused = 0
+        self.cancelled = False
+        self.api_calls = 0
+        self.throttled = 0
+        self.retries = 0
+        self.comparison_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.malformed = 0
+        # Candidates decided by the cascade (exact, dropped) and left to GPT (compared)
+        self.tiers = {"exact": 0, "dropped": 0, "compared": 0}
+
+    def _create_client(self) -> AsyncAzureOpenAI:
+        """
+        Creates the client shared by all the requests of a run. Retries are handled by the engine.
+        """
+        return AsyncAzureOpenAI(
+            api_key=os.environ.get("AZURE_OPENAI_API_KEY"),
+            max_retries=0,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.max_concurrency,
+                    max_keepalive_connections=self.max_concurrency,
+                ),
+                timeout=120,
+            ),
+        )
+
+    async def _request(self, send):
+        """
+        Sends one request once the concurrency limit allows it, waiting and retrying on throttling and transient errors.
+
+        :param send: A function returning the awaitable of the request.
+        :return: The response of the request.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._concurrency as sent:
+                    self.api_calls += 1
+                    response = await send()
+                self._concurrency.on_success()
+                return response
+
+            except Exception as e:
+                if attempt == self.max_retries or not (_is_throttled(e) or _is_transient(e)):
+                    raise e
+                self.retries += 1
+                if _is_throttled(e):
+                    self.throttled += 1
+                    self._concurrency.on_throttle(sent)
+                    delay = _retry_after_seconds(e) or min(2 ** attempt, 60)
+                    logging.warning(
+                        f"ALIGNMENT: throttled, waiting {delay:.1f}s (concurrency limit {self._concurrency.limit:.1f})"
+                    )
+                else:
+                    delay = random.uniform(1, min(2 ** attempt, 30))
+                await asyncio.sleep(delay)
+
+    async def _query_embedding(self, client, search_query: str) -> list:
+        """
+        Retrieves the embedding of a search query, from the embedding cache when possible and from Azure OpenAI otherwise.
+        """
+        deployment = _embedding_deployment()
+        cache = get_embedding_cache()
+        if cache is not None:
+            embedding = cache.get(search_query, deployment)
+            if embedding is not None:
+                return embedding
+
+        response = await self._request(lambda: client.embeddings.create(input=search_query, model=deployment))
+        embedding = response.data[0].embedding
+        if cache is not None:
+            cache.put(search_query, embedding, deployment)
+        return embedding
+
+    async def _retrieve(self, client, backend, position: int, label: str, definition: str, uri: str):
+        """
+        Finds the candidates of one concept with one search, and decides what the cascade can decide without GPT.
+
+        :return: The tuple returned by _prepare.
+        """
+        search_query = _search_query(label, definition)
+        query_vector = await self._query_embedding(client, search_query)
+        search_results = await self._request(
+            lambda: backend.search_async(search_query, query_vector, self.filter_condition, top=5, semantic_query=label)
+        )
+        return self._prepare(position, label, definition, uri, search_results)
+
+    def _prepare(self, position: int, label: str, definition: str, uri: str, search_results: list):
+        """
+        Decides what the cascade can decide about the candidates of one concept without GPT.
+
+        :return: A tuple containing the mappings decided by the cascade and the _Comparison of the candidates left
+                 to GPT, or None when there are none.
+        """
+        if len(search_results) == 0:
+            return [], None
+
+        mappings, search_results, tiers = _cascade(search_results, label, definition, uri)
+        for tier, count in tiers.items():
+            self.tiers[tier] += count
+        if not search_results:
+            return mappings, None
+
+        matches, _ = _build_matches(search_results, label, definition, uri)
+        candidates = [result["Libelle_Definition"] for result in search_results]
+        return mappings, _Comparison(position, label, definition, uri, matches, candidates, mappings)
+
+    async def _embed_batch(self, client, search_queries: list) -> list:
+        """
+        Embeds a batch of search queries with one request, splitting it in two halves when it fails so only the
+        failing half is retried.
+
+        :return: The embedding of each query, or the error that prevented it.
+        """
+        try:
+            response = await self._request(lambda: client.embeddings.create(input=search_queries, model=_embedding_deployment()))
+            return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+        except Exception as e:
+            if len(search_queries) == 1 or _is_throttled(e):
+                return [e] * len(search_queries)
+            logging.warning(f"ALIGNMENT: embedding of {len(search_queries)} concepts failed, splitting it: {e}")
+            middle = len(search_queries) // 2
+            first, second = await asyncio.gather(
+                self._embed_batch(client, search_queries[:middle]),
+                self._embed_batch(client, search_queries[middle:]),
+            )
+            return first + second
+
+    async def _match_all(self, client, backend, concepts: list) -> list:
+        """
+        Finds the candidates of every concept at once (matrix mode): the search queries are embedded in batches of
+        ALIGNMENT_EMBEDDING_BATCH_SIZE (unless cached), then scored against the vectors of the local index with
+        blocked matrix products (LocalSearchBackend.search_many) within ALIGNMENT_MATRIX_MEMORY_BYTES. The results
+        are the documents returned by a search, with the cosine similarity as @search.score.
+
+        :param backend: The LocalSearchBackend holding the vectors of the index.
+        :param concepts: The concepts, as (label, definition, uri) tuples.
+        :return: The search results of each concept, or the error that prevented its search.
+        """
+        search_queries = [_search_query(label, definition) for label, definition, _ in concepts]
+        deployment = _embedding_deployment()
+        cache = get_embedding_cache()
+        embeddings = cache.get_many(search_queries, deployment) if cache is not None else [None] * len(concepts)
+        missing = [position for position, embedding in enumerate(embeddings) if embedding is None]
+        batches = [missing[start:start + ALIGNMENT_EMBEDDING_BATCH_SIZE] for start in range(0, len(missing), ALIGNMENT_EMBEDDING_BATCH_SIZE)]
+        answers = await asyncio.gather(
+            *[self._embed_batch(client, [search_queries[position] for position in batch]) for batch in batches]
+        )
+        for batch, batch_embeddings in zip(batches, answers):
+            for position, embedding in zip(batch, batch_embeddings):
+                embeddings[position] = embedding
+            if cache is not None:
+                embedded = [(search_queries[position], embedding) for position, embedding in zip(batch, batch_embeddings) if not isinstance(embedding, Exception)]
+                if embedded:
+                    cache.put_many(*zip(*embedded), deployment)
+
+        results = list(embeddings)
+        embedded = [position for position, embedding in enumerate(embeddings) if not isinstance(embedding, Exception)]
+        if embedded:
+            start = time.perf_counter()
+            found = await asyncio.to_thread(
+                backend.search_many,
+                np.array([embeddings[position] for position in embedded], dtype=np.float32),
+                self.filter_condition,
+                5,
+                ALIGNMENT_MATRIX_MEMORY_BYTES,
+            )
+            logging.info(f"ALIGNMENT: candidates of {len(embedded)} concepts in {time.perf_counter() - start:.1f}s")
+            for position, search_results in zip(embedded, found):
+                results[position] = search_results
+        return results
+
+    def _fits(self, batch: list, comparison: _Comparison) -> bool:
+        """
+        Tells whether a comparison can join a batch without exceeding the batch size, the context window or the output limit.
+        """
+        if not batch:
+            return True
+        input_tokens = sum(item.input_tokens for item in batch) + comparison.input_tokens
+        output_tokens = sum(item.output_tokens for item in batch) + comparison.output_tokens
+        return (
+            len(batch) < self.batch_size
+            and output_tokens <= ALIGNMENT_MAX_OUTPUT_TOKENS
+            and input_tokens + ALIGNMENT_MAX_OUTPUT_TOKENS + 500 <= ALIGNMENT_CONTEXT_TOKENS
+        )
+
+    async def _compare(self, client, batch: list) -> dict:
+        """
+        Sends one batched comparison request.
+
+        :param batch: The _Comparison of the source concepts.
+        :return: The answer of each source concept, from _parse_batch_comparison, by position.
+        """
+        prompt = _batch_comparison_prompt([(item.label, item.definition, item.candidates) for item in batch])
+        completion = await self._request(
+            lambda: client.chat.completions.create(
+                model=comparison_deployment,
+                messages=_comparison_messages(prompt),
+                response_format=BATCH_COMPARISON_RESPONSE_FORMAT,
+                max_tokens=min(ALIGNMENT_MAX_OUTPUT_TOKENS, sum(item.output_tokens for item in batch) * 2),
+            )
+        )
+        self.comparison_calls += 1
+        if completion.usage is not None:
+            self.prompt_tokens += completion.usage.prompt_tokens
+            self.completion_tokens += completion.usage.completion_tokens
+        try:
+            answers = _parse_batch_comparison(completion.choices[0].message.content, [len(item.candidates) for item in batch])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            # Not JSON, or cut by the output limit: every part is malformed
+            answers = [None] * len(batch)
+        return {item.position: answer for item, answer in zip(batch, answers)}
+
+    async def _compare_batch(self, client, batch: list, record):
+        """
+        Compares a batch of source concepts and records the result of each one. The source concepts whose answer is
+        malformed are compared again in a batch of their own; a batch whose request fails is split in two halves.
+
+        :param batch: The _Comparison of the source concepts.
+        :param record: A function called with (position, mappings, error) for each source concept.
+        """
+        try:
+            answers = await self._compare(client, batch)
+        except Exception as e:
+            if len(batch) == 1 or _is_throttled(e):
+                for item in batch:
+                    record(item, None, e)
+                return
+            logging.warning(f"ALIGNMENT: comparison of {len(batch)} concepts failed, splitting it: {e}")
+            middle = len(batch) // 2
+            await asyncio.gather(
+                self._compare_batch(client, batch[:middle], record),
+                self._compare_batch(client, batch[middle:], record),
+            )
+            return
+
+        malformed = []
+        for item in batch:
+            if answers[item.position] is not None:
+                record(item, _select_batch_mappings(answers[item.position], item.matches), None)
+            elif item.attempts < ALIGNMENT_MAX_MALFORMED_RETRIES:
+                item.attempts += 1
+                malformed.append(item)
+            else:
+                record(item, None, ValueError("malformed comparison answer"))
+        if not malformed:
+            return
+        self.malformed += len(malformed)
+        logging.warning(f"ALIGNMENT: malformed answer for {len(malformed)} of {len(batch)} concepts, asking again")
+        if len(malformed) == len(batch) > 1:
+            middle = len(malformed) // 2
+            await asyncio.gather(
+                self._compare_batch(client, malformed[:middle], record),
+                self._compare_batch(client, malformed[middle:], record),
+            )
+        else:
+            await self._compare_batch(client, malformed, record)
+
+    async def align(self, concepts: list) -> tuple:
+        """
+        Aligns a list of concepts.
+
+        :param concepts: The concepts, as (label, definition, uri) tuples.
+        :return: A tuple containing the numbered mapping rows and the errors, as dictionaries with the position,
+                 uri, label and error of each concept that could not be aligned or compared.
+        """
+        # Fails the whole alignment at once rather than every concept
+        _embedding_deployment()
+        self._concurrency = AdaptiveConcurrency(self.max_concurrency)
+        if self.backend is not None:
+            backend = self.backend
+        else:
+            backend = get_local_search_backend() if self.candidates == "matrix" else get_search_backend()
+        matched = None
+        results = [None] * len(concepts)
+        errors = []
+        done = 0
+        batch = []
+        comparisons = []
+        # Alignments to add to the store, as (concept, mappings)
+        aligned = []
+
+        store = self.store if self.store is not None else get_mapping_store()
+        index_version = None
+        if store is not None:
+            try:
+                index_version = MAPPING_INDEX_VERSION or await asyncio.to_thread(backend.index_version)
+            except Exception as e:
+                logging.warning(f"ALIGNMENT: no version of the index, the mapping store is not used: {e}")
+                store = None
+        # The candidates of the matrix mode are not the ones of the searches
+        settings = {**alignment_settings(), "candidates": self.candidates}
+        stored = (
+            store.get_many(concepts, self.taxonomy_filter, index_version, settings)
+            if store is not None else [None] * len(concepts)
+        )
+        to_align = [position for position, mappings in enumerate(stored) if mappings is None]
+        self.reused = len(concepts) - len(to_align)
+        if store is not None:
+            logging.info(
+                f"ALIGNMENT: {self.reused} concepts unchanged since the last export, {len(to_align)} added or changed"
+            )
+
+        def record(position, label, uri, mappings, error):
+            nonlocal done
+            if error is not None:
+                logging.warning(f"ALIGNMENT: concept {position + 1} ({uri}) failed: {error}")
+                errors.append({"position": position + 1, "uri": uri, "label": label, "error": f"{type(error).__name__}: {error}"})
+            elif store is not None and stored[position] is None:
+                aligned.append((concepts[position], [dict(mapping) for mapping in mappings]))
+            results[position] = mappings
+            done += 1
+            if self.on_progress is not None:
+                self.on_progress(done, len(concepts), len(errors))
+
+        def record_comparison(item, mappings, error):
+            # When the comparison fails, the mappings the cascade decided without it are still returned
+            record(item.position, item.label, item.uri, item.decided + (mappings or []), error)
+
+        def flush(client):
+            nonlocal batch
+            if batch:
+                comparisons.append(asyncio.create_task(self._compare_batch(client, batch, record_comparison)))
+                batch = []
+
+        # The concepts are taken in order by a fixed number of workers, so they complete roughly in order and the
+        # progress is steady, while the AdaptiveConcurrency limits the requests of these workers
+        queue = asyncio.Queue()
+        for position in to_align:
+            queue.put_nowait((position, concepts[position]))
+
+        async def worker(client):
+            while not queue.empty() and not self.cancelled:
+                position, (label, definition, uri) = queue.get_nowait()
+                try:
+                    if matched is None:
+                        mappings, comparison = await self._retrieve(client, backend, position, label, definition, uri)
+                    elif isinstance(matched[position], Exception):
+                        raise matched[position]
+                    else:
+                        mappings, comparison = self._prepare(position, label, definition, uri, matched[position])
+                except Exception as e:
+                    record(position, label, uri, None, e)
+                    continue
+                if comparison is None:
+                    record(position, label, uri, mappings, None)
+                    continue
+                if not self._fits(batch, comparison):
+                    flush(client)
+                batch.append(comparison)
+                if len(batch) >= self.batch_size:
+                    flush(client)
+
+        for position, mappings in enumerate(stored):
+            if mappings is not None:
+                record(position, concepts[position][0], concepts[position][2], mappings, None)
+
+        try:
+            async with self._create_client() as client:
+                if self.candidates == "matrix" and to_align:
+                    matched = dict(zip(to_align, await self._match_all(client, backend, [concepts[position] for position in to_align])))
+                await asyncio.gather(*[worker(client) for _ in range(min(self.max_concurrency, len(to_align)))])
+                flush(client)
+                await asyncio.gather(*comparisons)
+        finally:
+            await backend.aclose()
+            # Also after a failure, so the concepts already aligned are not aligned again
+            if aligned:
+                store.put_many(*zip(*aligned), self.taxonomy_filter, index_version, settings)
+
+        mappings = []
+        j = 1
+        for concept_mappings in results:
+            if concept_mappings:
+                j = _number_mappings(concept_mappings, j)
+                mappings.extend(concept_mappings)
+        errors.sort(key=lambda error: error["position"])
+        return mappings, errors
+
+    def cancel(self):
+        """
+        Stops a running alignment: the concepts not searched yet are skipped, the comparisons already sent are
+        finished, and align returns the mappings of the concepts done. May be called from another thread.
+        """
+        self.cancelled = True
+
+    def run(self, concepts: list) -> tuple:
+        """
+        Synchronous entry point around align.
+
+        :param concepts: The concepts, as (label, definition, uri) tuples.
+        :return: A tuple containing the numbered mapping rows and the errors.
+        """
+        start = time.perf_counter()
+        mappings, errors = asyncio.run(self.align(concepts))
+        logging.info(
+            f"ALIGNMENT: {len(concepts)} concepts in {time.perf_counter() - start:.1f}s ({self.reused} reused), {len(mappings)} mappings, "
+            f"{len(errors)} errors, {self.api_calls} calls, {self.throttled} throttled, {self.retries} retries, "
+            f"{self.comparison_calls} comparisons ({self.prompt_tokens} prompt and {self.completion_tokens} completion tokens, "
+            f"{self.malformed} concepts asked again)"
+        )
+        logging.info(
+            f"ALIGNMENT: candidates {self.tiers['exact']} exact, {self.tiers['dropped']} dropped, "
+            f"{self.tiers['compared']} compared by GPT"
+        )
+        return mappings, errors
@@ -0,0 +1,376 @@
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import threading
+import subprocess
+from dotenv import load_dotenv
+
+load_dotenv()
+
+ALIGNMENT_JOBS_PATH = os.getenv("ALIGNMENT_JOBS_PATH", "alignment_jobs.sqlite")
+# Worker processes started by the app, i.e. exports run at the same time
+ALIGNMENT_JOB_WORKERS = int(os.getenv("ALIGNMENT_JOB_WORKERS", "2"))
+# Requests in flight of one export, kept below ALIGNMENT_MAX_CONCURRENCY so that concurrent exports leave some of the
+# quota of the deployments to the chat
+ALIGNMENT_JOB_MAX_CONCURRENCY = int(os.getenv("ALIGNMENT_JOB_MAX_CONCURRENCY", "8"))
+# A worker (or the running job of a worker) that has not written for this long is considered dead
+ALIGNMENT_JOB_STALE_SECONDS = 120
+_HEARTBEAT_SECONDS = 10
+# Times a job is given to a worker before it is failed, e.g. when it makes every worker that runs it die
+ALIGNMENT_JOB_MAX_ATTEMPTS = int(os.getenv("ALIGNMENT_JOB_MAX_ATTEMPTS", "3"))
+# Workers started by the app stop after waiting this long for a job; the app starts them again when needed
+ALIGNMENT_JOB_WORKER_IDLE_SECONDS = float(os.getenv("ALIGNMENT_JOB_WORKER_IDLE_SECONDS", "600"))
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+_WORKER_SCRIPT = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "scripts", "alignment_worker.py"))
+
+
+class AlignmentJobs():
+    """
+    A queue of alignment jobs in a local SQLite file, shared by the app and the worker processes.
+
+    A job holds the concepts to align and the taxonomy filter, then its progress, and finally its mappings and errors,
+    so it outlives the Streamlit session that submitted it. Workers claim the oldest queued job in a write
+    transaction, so a job is run by one worker; a running job whose worker stopped writing for
+    ALIGNMENT_JOB_STALE_SECONDS is queued again, or failed once it was claimed ALIGNMENT_JOB_MAX_ATTEMPTS times. The updates of a running job only apply while it belongs to the worker
+    that writes them, so a worker that was only slow, and whose job was given to another worker, abandons it. Cancelling
+    a running job only sets a flag, which its worker reads.
+
+    Methods:
+    - submit: Queues a job.
+    - get: Returns the status and progress of a job.
+    - result: Returns the mappings and errors of a finished job.
+    - cancel: Cancels a job.
+    - claim: Gives the oldest queued job to a worker.
+    - progress: Records the progress of a running job.
+    - heartbeat: Records that a worker (and its running job) is alive.
+    - leave: Records that a worker stopped.
+    - finish / fail: Records the end of a job.
+    - live_workers: Returns the number of workers alive.
+    """
+    def __init__(self, path: str = ALIGNMENT_JOBS_PATH) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        # Several processes write the file: wait for their transactions instead of failing
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, taxonomy_filter TEXT, "
+            "concepts TEXT NOT NULL, total INTEGER NOT NULL, done INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0, "
+            "cancel_requested INTEGER NOT NULL DEFAULT 0, worker TEXT, result TEXT, error TEXT, "
+            "created REAL NOT NULL, updated REAL NOT NULL, finished REAL, attempts INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(jobs)")]
+        if "attempts" not in columns:
+            # A queue written before the attempts were counted
+            self._connection.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        self._connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, updated REAL NOT NULL)")
+
+    def _execute(self, statement: str, parameters: tuple = ()):
+        with self._lock:
+            return self._connection.execute(statement, parameters)
+
+    def submit(self, concepts: list, taxonomy_filter: str = None) -> str:
+        """
+        Queues a job.
+
+        :param concepts: The concepts to align, as (label, definition, uri) tuples.
+        :param taxonomy_filter: The taxonomy of the index to align on, or None for all of them.
+        :return: The id of the job.
+        """
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self._execute(
+            "INSERT INTO jobs (id, status, taxonomy_filter, concepts, total, created, updated) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, JOB_QUEUED, taxonomy_filter, json.dumps([list(concept) for concept in concepts]), len(concepts), now, now),
+        )
+        logging.info(f"ALIGNMENT_JOBS: job {job_id} queued ({len(concepts)} concepts)")
+        return job_id
+
+    def get(self, job_id: str) -> dict:
+        """
+        Returns the status and progress of a job.
+
+        :param job_id: The id of the job.
+        :return: A dictionary with the id, status, total, done, failed, error, created and finished of the job,
+                 and its position in the queue when it is queued, or None when there is no such job.
+        """
+        row = self._execute(
+            "SELECT id, status, total, done, failed, error, created, finished FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(("id", "status", "total", "done", "failed", "error", "created", "finished"), row))
+        if job["status"] == JOB_QUEUED:
+            (job["queue_position"],) = self._execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = ? AND created <= ?", (JOB_QUEUED, job["created"])
+            ).fetchone()
+        return job
+
+    def result(self, job_id: str) -> tuple:
+        """
+        Returns the mappings and errors of a finished job.
+
+        :param job_id: The id of the job.
+        :return: A tuple containing the mapping rows and the errors, or None when the job has no result.
+        """
+        row = self._execute("SELECT result FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or row[0] is None:
+            return None
+        result = json.loads(row[0])
+        return result["mappings"], result["errors"]
+
+    def cancel(self, job_id: str):
+        """
+        Cancels a job: a queued job is cancelled at once, a running job once its worker reads the request.
+
+        :param job_id: The id of the job.
+        """
+        now = time.time()
+        self._execute(
+            "UPDATE jobs SET status = ?, updated = ?, finished = ? WHERE id = ? AND status = ?",
+            (JOB_CANCELLED, now, now, job_id, JOB_QUEUED),
+        )
+        self._execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = ?", (job_id, JOB_RUNNING))
+
+    def claim(self, worker: str):
+        """
+        Gives the oldest queued job to a worker, after queuing again the running jobs of dead workers (or failing
+        the ones already claimed ALIGNMENT_JOB_MAX_ATTEMPTS times).
+
+        :param worker: The id of the worker.
+        :return: A tuple containing the id, the concepts and the taxonomy filter of the job, or None when no job is queued.
+        """
+        now = time.time()
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                self._connection.execute(
+                    "UPDATE jobs SET status = ?, worker = NULL, error = ?, finished = ? "
+                    "WHERE status = ? AND updated < ? AND attempts >= ?",
+                    (
+                        JOB_FAILED, f"the workers running it stopped {ALIGNMENT_JOB_MAX_ATTEMPTS} times", now,
+                        JOB_RUNNING, now - ALIGNMENT_JOB_STALE_SECONDS, ALIGNMENT_JOB_MAX_ATTEMPTS,
+                    ),
+                )
+                self._connection.execute(
+                    "UPDATE jobs SET status = ?, worker = NULL WHERE status = ? AND updated < ?",
+                    (JOB_QUEUED, JOB_RUNNING, now - ALIGNMENT_JOB_STALE_SECONDS),
+                )
+                row = self._connection.execute(
+                    "SELECT id, concepts, taxonomy_filter FROM jobs WHERE status = ? ORDER BY created LIMIT 1", (JOB_QUEUED,)
+                ).fetchone()
+                if row is not None:
+                    self._connection.execute(
+                        "UPDATE jobs SET status = ?, worker = ?, updated = ?, attempts = attempts + 1 WHERE id = ?",
+                        (JOB_RUNNING, worker, now, row[0]),
+                    )
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None
+        return row[0], [tuple(concept) for concept in json.loads(row[1])], row[2]
+
+    def progress(self, job_id: str, worker: str, done: int, total: int, failed: int) -> bool:
+        """
+        Records the progress of a running job, unless it no longer belongs to the worker.
+
+        :return: True when the worker has to stop the job: it was asked to be cancelled, or given to another worker.
+        """
+        updated = self._execute(
+            "UPDATE jobs SET done = ?, total = ?, failed = ?, updated = ? WHERE id = ? AND worker = ? AND status = ?",
+            (done, total, failed, time.time(), job_id, worker, JOB_RUNNING),
+        ).rowcount
+        return not updated or self._cancel_requested(job_id)
+
+    def heartbeat(self, worker: str, job_id: str = None) -> bool:
+        """
+        Records that a worker, and its running job if any, is alive.
+
+        :return: True when the worker has to stop its running job: it was asked to be cancelled, or given to another worker.
+        """
+        now = time.time()
+        self._execute("INSERT OR REPLACE INTO workers (id, updated) VALUES (?, ?)", (worker, now))
+        if job_id is None:
+            return False
+        updated = self._execute(
+            "UPDATE jobs SET updated = ? WHERE id = ? AND worker = ? AND status = ?", (now, job_id, worker, JOB_RUNNING)
+        ).rowcount
+        return not updated or self._cancel_requested(job_id)
+
+    def leave(self, worker: str):
+        """
+        Records that a worker stopped, so it is no longer counted as alive.
+        """
+        self._execute("DELETE FROM workers WHERE id = ?", (worker,))
+
+    def _cancel_requested(self, job_id: str) -> bool:
+        row = self._execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row is not None and bool(row[0])
+
+    def finish(self, job_id: str, worker: str, mappings: list, errors: list, cancelled: bool = False) -> bool:
+        """
+        Records the mappings and errors of a job that ended, or was cancelled while running.
+
+        :return: False when the job no longer belongs to the worker, and nothing was recorded.
+        """
+        now = time.time()
+        return bool(self._execute(
+            "UPDATE jobs SET status = ?, result = ?, updated = ?, finished = ? WHERE id = ? AND worker = ? AND status = ?",
+            (
+                JOB_CANCELLED if cancelled else JOB_DONE, json.dumps({"mappings": mappings, "errors": errors}),
+                now, now, job_id, worker, JOB_RUNNING,
+            ),
+        ).rowcount)
+
+    def fail(self, job_id: str, worker: str, error: str) -> bool:
+        """
+        Records the error of a job that could not run.
+
+        :return: False when the job no longer belongs to the worker, and nothing was recorded.
+        """
+        now = time.time()
+        return bool(self._execute(
+            "UPDATE jobs SET status = ?, error = ?, updated = ?, finished = ? WHERE id = ? AND worker = ? AND status = ?",
+            (JOB_FAILED, error, now, now, job_id, worker, JOB_RUNNING),
+        ).rowcount)
+
+    def live_workers(self) -> int:
+        """
+        Returns the number of workers that wrote a heartbeat recently.
+        """
+        (count,) = self._execute(
+            "SELECT COUNT(*) FROM workers WHERE updated >= ?", (time.time() - ALIGNMENT_JOB_STALE_SECONDS,)
+        ).fetchone()
+        return count
+
+
+def run_job(jobs: AlignmentJobs, worker: str, job_id: str, concepts: list, taxonomy_filter: str):
+    """
+    Runs one claimed job with the AlignmentEngine. A thread writes the heartbeat of the job and cancels the engine
+    when the job is asked to be cancelled, or when it was given to another worker; the job is then abandoned without
+    recording its result.
+    """
+    # Imported here so the app can submit jobs without loading the OpenAI and search clients
+    from utils.alignment_engine import AlignmentEngine
+
+    last_progress = 0.0
+    counts = (0, len(concepts), 0)
+
+    def on_progress(done, total, failed):
+        nonlocal last_progress, counts
+        counts = (done, total, failed)
+        now = time.monotonic()
+        if done == total or now - last_progress >= 1:
+            last_progress = now
+            if jobs.progress(job_id, worker, done, total, failed):
+                engine.cancel()
+
+    engine = AlignmentEngine(taxonomy_filter=taxonomy_filter, max_concurrency=ALIGNMENT_JOB_MAX_CONCURRENCY, on_progress=on_progress)
+    stopped = threading.Event()
+
+    def beat():
+        while not stopped.wait(_HEARTBEAT_SECONDS):
+            if jobs.heartbeat(worker, job_id):
+                engine.cancel()
+
+    heartbeat = threading.Thread(target=beat, daemon=True)
+    heartbeat.start()
+    logging.info(f"ALIGNMENT_JOBS: {worker} runs job {job_id} ({len(concepts)} concepts)")
+    try:
+        mappings, errors = engine.run(concepts)
+        jobs.progress(job_id, worker, *counts)
+        if jobs.finish(job_id, worker, mappings, errors, cancelled=engine.cancelled):
+            logging.info(f"ALIGNMENT_JOBS: job {job_id} {'cancelled' if engine.cancelled else 'done'}")
+        else:
+            logging.warning(f"ALIGNMENT_JOBS: job {job_id} was given to another worker, {worker} abandons it")
+    except Exception as e:
+        logging.exception(f"ALIGNMENT_JOBS: job {job_id} failed")
+        if not jobs.fail(job_id, worker, f"{type(e).__name__}: {e}"):
+            logging.warning(f"ALIGNMENT_JOBS: job {job_id} was given to another worker, {worker} abandons it")
+    finally:
+        stopped.set()
+        heartbeat.join()
+
+
+def run_worker(jobs: AlignmentJobs = None, poll_seconds: float = 2.0, once: bool = False, idle_seconds: float = 0):
+    """
+    Runs the queued jobs one after the other, until no job was queued for idle_seconds.
+
+    :param jobs: The AlignmentJobs (default: the one of ALIGNMENT_JOBS_PATH).
+    :param poll_seconds: The time to wait when no job is queued.
+    :param once: Return when no job is queued instead of waiting.
+    :param idle_seconds: The time without a job after which the worker stops (0 runs forever).
+    """
+    jobs = jobs or AlignmentJobs()
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    idle_since = time.monotonic()
+    while True:
+        jobs.heartbeat(worker)
+        job = jobs.claim(worker)
+        if job is None and (once or (idle_seconds and time.monotonic() - idle_since >= idle_seconds)):
+            jobs.leave(worker)
+            # A job submitted while the worker was still counted as alive did not start another worker
+            job = jobs.claim(worker)
+            if job is None:
+                logging.info(f"ALIGNMENT_JOBS: {worker} stops, no job queued")
+                return
+            jobs.heartbeat(worker)
+        if job is None:
+            time.sleep(poll_seconds)
+            continue
+        run_job(jobs, worker, *job)
+        idle_since = time.monotonic()
+
+
+_alignment_jobs = None
+# The workers started by this process, alive before they write their first heartbeat
+_worker_processes = []
+
+
+def get_alignment_jobs() -> AlignmentJobs:
+    """
+    Returns the job queue shared by the process.
+
+    :return: The shared AlignmentJobs instance.
+    """
+    global _alignment_jobs
+    if _alignment_jobs is None:
+        _alignment_jobs = AlignmentJobs()
+    return _alignment_jobs
+
+
+def start_workers(count: int = ALIGNMENT_JOB_WORKERS) -> int:
+    """
+    Starts worker processes until count workers are alive. They run in their own session, so they outlive the script
+    run, the session and the browser tab that started them; they inherit the environment (and secrets) of the app.
+    They stop after waiting ALIGNMENT_JOB_WORKER_IDLE_SECONDS for a job, so they do not outlive the app for long.
+
+    :param count: The number of workers to keep alive.
+    :return: The number of workers started.
+    """
+    started = sum(process.poll() is None for process in _worker_processes)
+    missing = count - max(get_alignment_jobs().live_workers(), started)
+    for _ in range(missing):
+        _worker_processes.append(subprocess.Popen(
+            [sys.executable, _WORKER_SCRIPT, "--idle", str(ALIGNMENT_JOB_WORKER_IDLE_SECONDS)],
+            cwd=os.getcwd(),
+            stdin=subprocess.DEVNULL,
+            start_new_session=True,
+        ))
+    if missing > 0:
+        logging.info(f"ALIGNMENT_JOBS: started {missing} workers")
+    return max(missing, 0)
@@ -0,0 +1,310 @@
+import sys
+from array import array
+import numpy as np
+from rdflib import Graph, URIRef, BNode, Literal
+
+from utils.RDF import SKOS_PREF_LABEL, SKOS_ALT_LABEL, SKOS_DEFINITION, SKOS_RELATED, SKOS_BROADER, SKOS_NARROWER
+
+# Kind of the subject or object of a triple
+KIND_URI = 0
+KIND_BNODE = 1
+KIND_LITERAL = 2
+KIND_LANG_LITERAL = 3
+KIND_TYPED_LITERAL = 4
+
+# Blank nodes are interned with this prefix so they never share an id with the URI of the same text
+_BNODE_PREFIX = "_:"
+
+
+def _term_row(term) -> tuple:
+    """
+    Returns the interned key, the kind and the tag (language or datatype, or None) of an rdflib term.
+    """
+    if isinstance(term, Literal):
+        if term.language:
+            return str(term), KIND_LANG_LITERAL, term.language
+        if term.datatype:
+            return str(term), KIND_TYPED_LITERAL, str(term.datatype)
+        return str(term), KIND_LITERAL, None
+    if isinstance(term, BNode):
+        return _BNODE_PREFIX + str(term), KIND_BNODE, None
+    return str(term), KIND_URI, None
+
+
+class ConceptRecord():
+    """
+    One concept of a ConceptStore: the id of its URI in the string table (also its position among the concepts),
+    the rows of its triples and the rows of its prefLabels. Records are made on demand and hold no text.
+    """
+    __slots__ = ("uri", "start", "stop", "labels_start", "labels_stop")
+
+    def __init__(self, uri: int, start: int, stop: int, labels_start: int, labels_stop: int) -> None:
+        self.uri = uri
+        self.start = start
+        self.stop = stop
+        self.labels_start = labels_start
+        self.labels_stop = labels_stop
+
+
+class ConceptStore():
+    """
+    The triples of a taxonomy without rdflib objects or nested dictionaries: every distinct string (URIs, literal
+    values, language tags, datatypes) is stored once in a string table, and the triples are rows of integer arrays
+    grouped by subject (in the order of the graph) and, within a subject, by predicate (in the order of their first
+    triple). The concepts, sorted, are interned first, so the string id of a concept is its position, and their
+    neighbours are found without a dictionary.
+
+    Methods:
+    - from_graph: Builds the store of a parsed graph.
+    - record: The ConceptRecord of a concept.
+    - concept_uri: The URI of a concept.
+    - concept_info: The information of a concept, as ScrapingRDF.extract_concept_info returns it.
+    - iter_triples: The triples as rdflib terms.
+    - to_content / from_content: Plain Python and numpy content, for the graph cache.
+    """
+    _ARRAYS = ("subjects", "subject_kinds", "offsets", "concept_subjects", "label_starts", "label_stops",
+               "predicates", "objects", "kinds", "tags")
+
+    def __init__(self, strings: list, concepts: int, **arrays) -> None:
+        self.strings = strings
+        self.concepts = concepts
+        for name in self._ARRAYS:
+            setattr(self, name, arrays[name])
+        # Slot of the SKOS predicates in the information of a concept: literals first, then neighbours
+        self._slots = {}
+        for slot, predicate in enumerate(
+            (SKOS_PREF_LABEL, SKOS_ALT_LABEL, SKOS_DEFINITION, SKOS_RELATED, SKOS_BROADER, SKOS_NARROWER)
+        ):
+            string_id = self._find(str(predicate))
+            if string_id >= 0:
+                self._slots[string_id] = slot
+
+    def _find(self, string: str) -> int:
+        """
+        Returns the id of a string, or -1 when the taxonomy does not use it. Only used for a few predicates.
+        """
+        try:
+            return self.strings.index(string, self.concepts)
+        except ValueError:
+            return -1
+
+    def __len__(self) -> int:
+        return self.concepts
+
+    @classmethod
+    def from_graph(cls, graph: Graph):
+        """
+        Builds the store of a parsed graph.
+
+        :param graph: The parsed rdflib graph.
+        :return: The ConceptStore of the graph.
+        """
+        ids = {}
+        strings = []
+
+        def intern(string):
+            if string is None:
+                return -1
+            string_id = ids.get(string)
+            if string_id is None:
+                string_id = ids[string] = len(strings)
+                strings.append(string)
+            return string_id
+
+        concepts = sorted(set(graph.subjects(predicate=SKOS_PREF_LABEL)))
+        for concept in concepts:
+            intern(_term_row(concept)[0])
+        pref_label = intern(str(SKOS_PREF_LABEL))
+
+        subjects, subject_kinds, offsets = array("i"), array("b"), array("q", [0])
+        predicates, objects, kinds, tags = array("i"), array("i"), array("b"), array("i")
+        concept_subjects = array("i", [-1]) * len(concepts)
+        label_starts = array("q", [0]) * len(concepts)
+        label_stops = array("q", [0]) * len(concepts)
+
+        for subject in graph.subjects(unique=True):
+            key, kind, _ = _term_row(subject)
+            subject_id = intern(key)
+            rows = {}
+            for predicate, obj in graph.predicate_objects(subject):
+                obj_key, obj_kind, obj_tag = _term_row(obj)
+                rows.setdefault(intern(str(predicate)), []).append((intern(obj_key), obj_kind, intern(obj_tag)))
+
+            if subject_id < len(concepts):
+                concept_subjects[subject_id] = len(subjects)
+            for predicate, predicate_rows in rows.items():
+                if predicate == pref_label and subject_id < len(concepts):
+                    label_starts[subject_id] = len(predicates)
+                    label_stops[subject_id] = len(predicates) + len(predicate_rows)
+                for obj_id, obj_kind, obj_tag in predicate_rows:
+                    predicates.append(predicate)
+                    objects.append(obj_id)
+                    kinds.append(obj_kind)
+                    tags.append(obj_tag)
+            subjects.append(subject_id)
+            subject_kinds.append(kind)
+            offsets.append(len(predicates))
+
+        return cls(
+            strings,
+            len(concepts),
+            subjects=np.frombuffer(subjects, dtype=np.int32),
+            subject_kinds=np.frombuffer(subject_kinds, dtype=np.int8),
+            offsets=np.frombuffer(offsets, dtype=np.int64),
+            concept_subjects=np.frombuffer(concept_subjects, dtype=np.int32),
+            label_starts=np.frombuffer(label_starts, dtype=np.int64),
+            label_stops=np.frombuffer(label_stops, dtype=np.int64),
+            predicates=np.frombuffer(predicates, dtype=np.int32),
+            objects=np.frombuffer(objects, dtype=np.int32),
+            kinds=np.frombuffer(kinds, dtype=np.int8),
+            tags=np.frombuffer(tags, dtype=np.int32),
+        )
+
+    def record(self, position: int) -> ConceptRecord:
+        """
+        Returns the record of a concept.
+
+        :param position: The position of the concept (0 for the first URI in sorted order).
+        :return: The ConceptRecord of the concept.
+        """
+        subject = int(self.concept_subjects[position])
+        return ConceptRecord(
+            position,
+            int(self.offsets[subject]),
+            int(self.offsets[subject + 1]),
+            int(self.label_starts[position]),
+            int(self.label_stops[position]),
+        )
+
+    def _text(self, string_id: int, kind: int) -> str:
+        """
+        Returns the text of a term as str() of the rdflib term gives it.
+        """
+        string = self.strings[string_id]
+        return string[len(_BNODE_PREFIX):] if kind == KIND_BNODE else string
+
+    def concept_uri(self, position: int) -> str:
+        """
+        Returns the URI (or blank node id) of a concept.
+
+        :param position: The position of the concept.
+        :return: The URI as a string.
+        """
+        return self._text(position, int(self.subject_kinds[self.concept_subjects[position]]))
+
+    def _add_neighbour_labels(self, labels: dict, neighbour: int):
+        """
+        Adds the prefLabels of a neighbour concept to labels, grouped by language tag ('default' when untagged).
+        """
+        strings = self.strings
+        start, stop = self.label_starts[neighbour], self.label_stops[neighbour]
+        for obj, kind, tag in zip(
+            self.objects[start:stop].tolist(), self.kinds[start:stop].tolist(), self.tags[start:stop].tolist()
+        ):
+            if kind >= KIND_LITERAL:
+                lang = strings[tag] if kind == KIND_LANG_LITERAL else "default"
+                if lang not in labels:
+                    labels[lang] = []
+                labels[lang].append(strings[obj])
+
+    def concept_info(self, position: int) -> dict:
+        """
+        Returns the information of a concept, read from the arrays: the same dictionary as
+        ScrapingRDF.extract_concept_info, to be rendered by ScrapingRDF.concatenate_info.
+
+        :param position: The position of the concept.
+        :return: A dictionary containing the extracted concept information.
+        """
+        record = self.record(position)
+        concept_kind = self.subject_kinds[self.concept_subjects[position]]
+        if concept_kind == KIND_BNODE:
+            # Concepts used to be looked up by URI, which left the blank-node ones empty: kept so their documents
+            # (and the hashes of the incremental indexation) do not change
+            record.start = record.stop
+        strings = self.strings
+        slots = self._slots
+        concept_text = self._text(position, concept_kind)
+
+        # prefLabels, altLabels, definitions, then related, broader and narrower labels, by language
+        groups = ({}, {}, {}, {}, {}, {})
+        triples = []
+        for predicate, obj, kind, tag in zip(
+            self.predicates[record.start:record.stop].tolist(), self.objects[record.start:record.stop].tolist(),
+            self.kinds[record.start:record.stop].tolist(), self.tags[record.start:record.stop].tolist(),
+        ):
+            text = strings[obj] if kind != KIND_BNODE else strings[obj][len(_BNODE_PREFIX):]
+            triples += (concept_text, strings[predicate], text)
+            slot = slots.get(predicate)
+            if slot is None:
+                continue
+            if slot < 3:
+                if kind >= KIND_LITERAL:
+                    lang = strings[tag] if kind == KIND_LANG_LITERAL else "default"
+                    if lang not in groups[slot]:
+                        groups[slot][lang] = []
+                    groups[slot][lang].append(text)
+            # Only the concepts have prefLabels, and their string id is their position
+            elif kind <= KIND_BNODE and obj < self.concepts:
+                self._add_neighbour_labels(groups[slot], obj)
+
+        return {
+            "pref_labels": groups[0],
+            "alt_labels": groups[1],
+            "definitions": groups[2],
+            "related_entities_labels": groups[3],
+            "broader_entities_labels": groups[4],
+            "narrower_entities_labels": groups[5],
+            # Triples linked to the concept, grouped by predicate
+            "linked_triples": " ".join(triples),
+        }
+
+    def _term(self, string_id: int, kind: int, tag: int):
+        """
+        Returns the rdflib term of an interned string.
+        """
+        string = self.strings[string_id]
+        if kind == KIND_URI:
+            return URIRef(string)
+        if kind == KIND_BNODE:
+            return BNode(string[len(_BNODE_PREFIX):])
+        if kind == KIND_LANG_LITERAL:
+            return Literal(string, lang=self.strings[tag])
+        if kind == KIND_TYPED_LITERAL:
+            return Literal(string, datatype=URIRef(self.strings[tag]))
+        return Literal(string)
+
+    def iter_triples(self):
+        """
+        Yields the triples of the taxonomy as rdflib terms, e.g. to rebuild its graph.
+
+        :return: A generator of (subject, predicate, object) triples.
+        """
+        for position, (subject, kind) in enumerate(zip(self.subjects.tolist(), self.subject_kinds.tolist())):
+            subject_term = self._term(subject, kind, -1)
+            start, stop = int(self.offsets[position]), int(self.offsets[position + 1])
+            for predicate, obj, obj_kind, tag in zip(
+                self.predicates[start:stop].tolist(), self.objects[start:stop].tolist(),
+                self.kinds[start:stop].tolist(), self.tags[start:stop].tolist(),
+            ):
+                yield subject_term, URIRef(self.strings[predicate]), self._term(obj, obj_kind, tag)
+
+    def to_content(self) -> dict:
+        """
+        Returns the store as plain Python and numpy objects, for pickling.
+        """
+        return {"strings": self.strings, "concepts": self.concepts, **{name: getattr(self, name) for name in self._ARRAYS}}
+
+    @classmethod
+    def from_content(cls, content: dict):
+        """
+        Rebuilds a store from the content returned by to_content.
+        """
+        return cls(content["strings"], content["concepts"], **{name: content[name] for name in cls._ARRAYS})
+
+    def nbytes(self) -> int:
+        """
+        Returns an estimate of the memory used by the store (string table and arrays).
+        """
+        return sum(sys.getsizeof(string) for string in self.strings) + sys.getsizeof(self.strings) + sum(
+            getattr(self, name).nbytes for name in self._ARRAYS
+        )
@@ -0,0 +1,176 @@
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache.sqlite")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "200000"))
+
+
+class EmbeddingCache():
+    """
+    A persistent, content-addressed cache of embeddings stored in a local SQLite file.
+
+    Each embedding is keyed by a SHA-256 of the embedding deployment name and the text,
+    and stored as a float32 blob. When the number of entries exceeds max_entries,
+    the least recently used entries are evicted.
+
+    Methods:
+    - get_many: Looks up the embeddings of a list of texts.
+    - put_many: Stores the embeddings of a list of texts.
+    - stats: Returns the hit/miss counters and the number of entries.
+    """
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH, max_entries: int = EMBEDDING_CACHE_MAX_ENTRIES) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)"
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def key(text: str, deployment: str) -> str:
+        """
+        Computes the cache key of a text for a given embedding deployment.
+
+        :param text: The (normalized) text.
+        :param deployment: The name of the embedding deployment.
+        :return: The hexadecimal SHA-256 key.
+        """
+        return hashlib.sha256(f"{deployment}\x00{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, texts: list[str], deployment: str) -> list:
+        """
+        Looks up the embeddings of a list of texts.
+
+        :param texts: The texts to look up.
+        :param deployment: The name of the embedding deployment.
+        :return: A list with the embedding of each text, or None when it is not cached.
+        """
+        keys = [self.key(text, deployment) for text in texts]
+        found = {}
+        with self._lock:
+            # SQLite limits the number of variables of a single statement
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self._connection.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+                self._connection.commit()
+
+        embeddings = []
+        for key in keys:
+            if key in found:
+                embeddings.append(np.frombuffer(found[key], dtype=np.float32).tolist())
+                self.hits += 1
+            else:
+                embeddings.append(None)
+                self.misses += 1
+        return embeddings
+
+    def put_many(self, texts: list[str], embeddings: list, deployment: str):
+        """
+        Stores the embeddings of a list of texts and evicts the least recently used entries if needed.
+
+        :param texts: The texts that were embedded.
+        :param embeddings: The embedding of each text.
+        :param deployment: The name of the embedding deployment.
+        """
+        now = time.time()
+        rows = [
+            (self.key(text, deployment), np.asarray(embedding, dtype=np.float32).tobytes(), now)
+            for text, embedding in zip(texts, embeddings)
+        ]
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)",
+                rows,
+            )
+            self._evict()
+            self._connection.commit()
+
+    def get(self, text: str, deployment: str):
+        """
+        Looks up the embedding of a single text.
+
+        :param text: The text to look up.
+        :param deployment: The name of the embedding deployment.
+        :return: The embedding, or None when it is not cached.
+        """
+        return self.get_many([text], deployment)[0]
+
+    def put(self, text: str, embedding: list, deployment: str):
+        """
+        Stores the embedding of a single text.
+
+        :param text: The text that was embedded.
+        :param embedding: The embedding of the text.
+        :param deployment: The name of the embedding deployment.
+        """
+        self.put_many([text], [embedding], deployment)
+
+    def _evict(self):
+        """
+        Deletes the least recently used entries above max_entries. The caller holds the lock.
+        """
+        (count,) = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        if count > self.max_entries:
+            self._connection.execute(
+                "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_access LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def stats(self) -> dict:
+        """
+        Returns the hit/miss counters of this process and the number of cached entries.
+
+        :return: A dictionary with the hits, misses, hit_rate and entries.
+        """
+        with self._lock:
+            (count,) = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": count,
+        }
+
+
+_embedding_cache = None
+
+
+def get_embedding_cache():
+    """
+    Returns the embedding cache shared by the process, or None when EMBEDDING_CACHE_PATH is empty.
+
+    :return: The shared EmbeddingCache instance or None.
+    """
+    global _embedding_cache
+    if not EMBEDDING_CACHE_PATH:
+        return None
+    if _embedding_cache is None:
+        logging.info(f"EMBEDDING_CACHE: opening {EMBEDDING_CACHE_PATH}")
+        _embedding_cache = EmbeddingCache()
+    return _embedding_cache
@@ -1,17 +1,17 @@
-from io import BytesIO
 import streamlit as st
-import rdflib
 import pandas as pd
 from utils.RDF import ScrapingRDF
+from utils.rdf_stream import stream_concept_documents, use_streaming
+from utils.graph_cache import load_taxonomy
 
-def _get_concepts_as_table(graph):
+def _get_concepts_as_table(taxonomy):
     """
-    Retrieves concepts from an RDF graph and returns them as a pandas DataFrame.  
+    Retrieves concepts from a parsed taxonomy and returns them as a pandas DataFrame.  
   
-    :param graph: The RDF graph from which to retrieve concepts.  
+    :param taxonomy: The ParsedTaxonomy from which to retrieve concepts.  
     :return: A pandas DataFrame containing the concepts and their annotations.  
     """
-    data = ScrapingRDF().ScrapeRDF(graph, []) #[]  
+    data = ScrapingRDF().ScrapeRDF(None, [], taxonomy.concept_store) #[]  
 
   # Create a pandas DataFrame from the list of dictionaries  
     return pd.DataFrame(data)
@@ -19,16 +19,20 @@ def _get_concepts_as_table(graph):
 def import_ttl(uploaded_file):
     """
     Imports a TTL file, parses it as an RDF graph, and retrieves the concepts as a pandas DataFrame.  
+    Parsed files are kept in the graph cache (GRAPH_CACHE_DIR), keyed by the SHA-256 of their bytes.  
+    No RDF graph is built for the mapping, so None is returned in its place.  
   
     :param uploaded_file: The uploaded TTL file to be imported.  
-    :return: A tuple containing the parsed RDF graph and a pandas DataFrame with the concepts.  
+    :return: A tuple containing None and a pandas DataFrame with the concepts.  
     """
-    bytes_data = BytesIO(st.session_state["uploaded_file"].read())
+    if use_streaming(uploaded_file.size):
+        pandas_data = pd.DataFrame(stream_concept_documents(st.session_state["uploaded_file"], "ttl"))
+        return None, pandas_data
 
-    g = rdflib.Graph()
-    taxonomy_data = g.parse(bytes_data, format="ttl")
-    pandas_data = _get_concepts_as_table(g)
+    # A file uploaded again in a later session is loaded from the graph cache instead of being parsed
+    taxonomy = load_taxonomy(st.session_state["uploaded_file"].read())
+    pandas_data = _get_concepts_as_table(taxonomy)
     print(pandas_data)
     
-    return taxonomy_data, pandas_data
+    return None, pandas_data
 
@@ -0,0 +1,160 @@
+import re
+import math
+import unicodedata
+from collections import Counter
+import numpy as np
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+_LIGATURES = str.maketrans({"œ": "oe", "æ": "ae", "ß": "ss"})
+
+# French and English function words, after accent folding
+STOP_WORDS = frozenset(
+    """
+    a an and are as at be by for from in into is it its of on or that the this to with
+    au aux avec ce ces cet cette dans de des du elle en est et il ils la le les leur leurs lui
+    ma mais me mes mon ne ni nos notre nous on ou par pas pour qu que qui sa se ses son sur
+    ta te tes ton un une vos votre vous d l n s t c j m y
+    """.split()
+)
+
+# Light French/English stemming: longest suffix first, keeping a stem of at least 3 characters
+_SUFFIXES = sorted(
+    [
+        "issements", "issement", "atrices", "atrice", "ateurs", "ateur", "ations", "ation",
+        "ements", "ement", "ments", "ment", "ities", "ites", "ite", "ions", "ion", "ings", "ing",
+        "ness", "euses", "euse", "eux", "ives", "ive", "ifs", "if", "ies", "es", "s", "x", "e", "y",
+    ],
+    key=len,
+    reverse=True,
+)
+
+
+def fold(text: str) -> str:
+    """
+    Lowercases a text and removes its accents (é -> e, œ -> oe).
+
+    :param text: The text to fold.
+    :return: The folded text.
+    """
+    text = unicodedata.normalize("NFKD", text.lower().translate(_LIGATURES))
+    return "".join(character for character in text if not unicodedata.combining(character))
+
+
+def stem(token: str) -> str:
+    """
+    Strips the inflectional and common derivational suffix of a folded French or English token.
+
+    :param token: The folded token.
+    :return: The stem.
+    """
+    if len(token) <= 3:
+        return token
+    for suffix in _SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            return token[: -len(suffix)]
+    return token
+
+
+def analyze(text: str) -> list[str]:
+    """
+    Turns a text into index terms: folding, tokenization, stop word removal and stemming.
+
+    :param text: The text to analyze.
+    :return: The terms, in order.
+    """
+    if not text:
+        return []
+    return [stem(token) for token in _TOKEN.findall(fold(text)) if token not in STOP_WORDS]
+
+
+class LexicalIndex():
+    """
+    An inverted index over one text field with BM25 scoring.
+
+    The postings of a term are stored as two NumPy arrays (document positions in increasing
+    order and term frequencies), so scoring a query is a few vectorized additions, and scoring
+    a contiguous range of documents only reads the matching part of each postings list.
+
+    Methods:
+    - scores: Returns the BM25 score of every document of a range for a query.
+    """
+    def __init__(self, texts: list[str], k1: float = 1.2, b: float = 0.75) -> None:
+        postings = {}
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for position, text in enumerate(texts):
+            terms = analyze(text)
+            lengths[position] = len(terms)
+            for term, frequency in Counter(terms).items():
+                if term not in postings:
+                    postings[term] = ([], [])
+                postings[term][0].append(position)
+                postings[term][1].append(frequency)
+
+        self.size = len(texts)
+        self.k1 = k1
+        average_length = float(lengths.mean()) if self.size and lengths.any() else 1.0
+        # The length normalization of each document, computed once
+        self._normalization = (k1 * (1 - b + b * lengths / average_length)).astype(np.float32)
+        self.postings = {}
+        self.idf = {}
+        for term, (positions, frequencies) in postings.items():
+            self.postings[term] = (np.array(positions, dtype=np.int32), np.array(frequencies, dtype=np.float32))
+            self.idf[term] = math.log(1 + (self.size - len(positions) + 0.5) / (len(positions) + 0.5))
+
+    def scores(self, query: str, start: int = 0, end: int = None) -> np.ndarray:
+        """
+        Scores the documents of a range for a query.
+
+        :param query: The text of the query.
+        :param start: The first document of the range.
+        :param end: The end of the range (default: the last document).
+        :return: The BM25 scores of the documents start to end.
+        """
+        end = self.size if end is None else end
+        scores = np.zeros(end - start, dtype=np.float32)
+        for term in set(analyze(query)):
+            if term not in self.postings:
+                continue
+            positions, frequencies = self.postings[term]
+            first, last = np.searchsorted(positions, [start, end])
+            positions = positions[first:last]
+            frequencies = frequencies[first:last]
+            scores[positions - start] += self.idf[term] * frequencies * (self.k1 + 1) / (
+                frequencies + self._normalization[positions]
+            )
+        return scores
+
+
+def _names_of(libelle_definition: str) -> list[str]:
+    """
+    Reads the label and the alternative labels of an indexed concept, written as
+    "Label EN/Label FR (ou alt 1, alt 2) : definition."
+    """
+    head = libelle_definition.split(":", 1)[0]
+    label, _, alternatives = head.partition("(")
+    names = label.split("/")
+    alternatives = alternatives.rsplit(")", 1)[0].strip()
+    if alternatives.startswith("ou "):
+        alternatives = alternatives[3:]
+    names.extend(alternatives.split(","))
+    return [name for name in names if name.strip()]
+
+
+def label_overlap(label: str, libelle_definition: str) -> float:
+    """
+    Scores how well a label matches the label or one of the alternative labels of an indexed concept,
+    as the best Dice coefficient between their terms.
+
+    :param label: The label of the query.
+    :param libelle_definition: The Libelle_Definition field of the indexed concept.
+    :return: A score from 0 (no common term) to 1 (same terms).
+    """
+    query_terms = set(analyze(label))
+    if not query_terms:
+        return 0.0
+    best = 0.0
+    for name in _names_of(libelle_definition):
+        name_terms = set(analyze(name))
+        if name_terms:
+            best = max(best, 2 * len(query_terms & name_terms) / (len(query_terms) + len(name_terms)))
+    return best
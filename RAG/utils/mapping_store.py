@@ -0,0 +1,159 @@
+import os
+import json
+import sqlite3
+import hashlib
+import logging
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MAPPING_STORE_PATH = os.getenv("MAPPING_STORE_PATH", "mapping_store.sqlite")
+# Overrides the version stamp given by the search backend, e.g. with the date of the last indexation
+MAPPING_INDEX_VERSION = os.getenv("MAPPING_INDEX_VERSION", "")
+
+
+class MappingStore():
+    """
+    A persistent store of the alignment of each source concept, in a local SQLite file.
+
+    The alignment of a concept is keyed by a SHA-256 of its uri, label and definition, of the taxonomy filter, of
+    the version stamp of the index and of the alignment settings, so a concept whose label or definition changed, a
+    different taxonomy, a new index or other settings is aligned again while the other concepts reuse their stored
+    mappings. The mappings are stored as the JSON of their rows, not numbered. Storing the alignments of a new
+    version of an index evicts the ones of its previous versions for the same taxonomy filter, which can no longer
+    be reused; the alignments of other indexes (e.g. the local and the Azure one) are kept.
+
+    Methods:
+    - get_many: Looks up the stored mappings of a list of concepts.
+    - put_many: Stores the mappings of a list of concepts.
+    - stats: Returns the number of stored concepts.
+    """
+    def __init__(self, path: str = MAPPING_STORE_PATH) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(mappings)")]
+        if columns and "scope" not in columns:
+            # A store written before the scopes were recorded: its entries cannot be evicted, it is started again
+            self._connection.execute("DROP TABLE mappings")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS mappings "
+            "(key TEXT PRIMARY KEY, uri TEXT NOT NULL, mappings TEXT NOT NULL, scope TEXT NOT NULL, index_version TEXT NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS mappings_scope ON mappings (scope, index_version)"
+        )
+        self._connection.commit()
+
+    @staticmethod
+    def key(concept: tuple, taxonomy_filter: str, index_version: str, settings: dict = None) -> str:
+        """
+        Computes the key of the alignment of a concept.
+
+        :param concept: The concept, as a (label, definition, uri) tuple.
+        :param taxonomy_filter: The filter of the alignment, or None.
+        :param index_version: The version stamp of the index.
+        :param settings: The settings of the alignment (see alignment_settings in taxo_mapping), or None.
+        :return: The hexadecimal SHA-256 key.
+        """
+        label, definition, uri = concept
+        fields = [
+            str(uri), str(label), str(definition), taxonomy_filter or "", index_version,
+            json.dumps(settings or {}, sort_keys=True),
+        ]
+        return hashlib.sha256("\x00".join(fields).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def scope(taxonomy_filter: str, index_version: str) -> str:
+        """
+        Computes the scope of the alignments evicted together: the index, without its version, and the filter.
+        The version is the part of the stamp after its last colon (e.g. azure:<index name>:<publish stamp>).
+
+        :param taxonomy_filter: The filter of the alignment, or None.
+        :param index_version: The version stamp of the index.
+        :return: The scope.
+        """
+        index = index_version.rpartition(":")[0]
+        return f"{index}\x00{taxonomy_filter or ''}"
+
+    def get_many(self, concepts: list, taxonomy_filter: str, index_version: str, settings: dict = None) -> list:
+        """
+        Looks up the stored mappings of a list of concepts.
+
+        :param concepts: The concepts, as (label, definition, uri) tuples.
+        :param taxonomy_filter: The filter of the alignment, or None.
+        :param index_version: The version stamp of the index.
+        :param settings: The settings of the alignment, or None.
+        :return: A list with the mapping rows of each concept, or None when it has to be aligned.
+        """
+        keys = [self.key(concept, taxonomy_filter, index_version, settings) for concept in concepts]
+        found = {}
+        with self._lock:
+            # SQLite limits the number of variables of a single statement
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                found.update(self._connection.execute(
+                    f"SELECT key, mappings FROM mappings WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall())
+        return [json.loads(found[key]) if key in found else None for key in keys]
+
+    def put_many(self, concepts: list, mappings: list, taxonomy_filter: str, index_version: str, settings: dict = None):
+        """
+        Stores the mappings of a list of concepts, and evicts the mappings stored for other versions of the same
+        index with the same taxonomy filter.
+
+        :param concepts: The concepts, as (label, definition, uri) tuples.
+        :param mappings: The mapping rows of each concept (an empty list when it has no match).
+        :param taxonomy_filter: The filter of the alignment, or None.
+        :param index_version: The version stamp of the index.
+        :param settings: The settings of the alignment, or None.
+        """
+        scope = self.scope(taxonomy_filter, index_version)
+        rows = [
+            (
+                self.key(concept, taxonomy_filter, index_version, settings), str(concept[2]),
+                json.dumps(concept_mappings), scope, index_version,
+            )
+            for concept, concept_mappings in zip(concepts, mappings)
+        ]
+        with self._lock:
+            evicted = self._connection.execute(
+                "DELETE FROM mappings WHERE scope = ? AND index_version != ?", (scope, index_version)
+            ).rowcount
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO mappings (key, uri, mappings, scope, index_version) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._connection.commit()
+        if evicted:
+            logging.info(f"MAPPING_STORE: evicted {evicted} alignments of previous versions of the index")
+
+    def stats(self) -> dict:
+        """
+        Returns the number of stored concepts.
+
+        :return: A dictionary with the entries.
+        """
+        with self._lock:
+            (count,) = self._connection.execute("SELECT COUNT(*) FROM mappings").fetchone()
+        return {"entries": count}
+
+
+_mapping_store = None
+
+
+def get_mapping_store():
+    """
+    Returns the mapping store shared by the process, or None when MAPPING_STORE_PATH is empty.
+
+    :return: The shared MappingStore instance or None.
+    """
+    global _mapping_store
+    if not MAPPING_STORE_PATH:
+        return None
+    if _mapping_store is None:
+        logging.info(f"MAPPING_STORE: opening {MAPPING_STORE_PATH}")
+        _mapping_store = MappingStore()
+    return _mapping_store
@@ -0,0 +1,55 @@
+import time
+import asyncio
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Gives a conservative estimate of the number of tokens of a text without calling a tokenizer.
+    French text with accents tends to use more tokens per character than English, hence 3 characters per token.
+
+    :param text: The text to estimate.
+    :return: The estimated number of tokens.
+    """
+    return len(text) // 3 + 1
+
+
+class AdaptiveConcurrency():
+    """
+    Limits the number of requests in flight with an additive-increase/multiplicative-decrease policy:
+    every success raises the limit by 1/limit, and throttling halves it at most once per window. The window ends
+    when the requests sent before the last decrease have completed: those were sent under the previous limit,
+    so their throttling is not a new signal.
+
+    Entering the context waits for a free slot and gives the time the request was sent, to pass to on_throttle.
+    """
+    def __init__(self, maximum: int, initial: int = None) -> None:
+        self.maximum = maximum
+        self.limit = float(initial or max(maximum // 4, 1))
+        self.in_flight = 0
+        self._decreased = float("-inf")
+        self._condition = asyncio.Condition()
+
+    async def __aenter__(self) -> float:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def on_success(self):
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_throttle(self, sent: float):
+        """
+        Halves the limit, unless the throttled request was sent before the last decrease.
+
+        :param sent: The time the request was sent, as given when entering the context.
+        """
+        if sent < self._decreased:
+            return
+        self._decreased = time.monotonic()
+        self.limit = max(1.0, self.limit / 2)
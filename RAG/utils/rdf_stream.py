@@ -0,0 +1,324 @@
+import io
+import os
+import re
+import sqlite3
+import logging
+import tempfile
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+from rdflib import Graph, URIRef, BNode, Literal
+from dotenv import load_dotenv
+
+from utils.RDF import ScrapingRDF, ConceptTable, SKOS_PREF_LABEL
+
+load_dotenv(override=True)
+
+TTL_STREAMING_MIN_BYTES = int(os.getenv("TTL_STREAMING_MIN_BYTES", str(100 * 1024 * 1024)))
+TTL_STREAMING_MAX_MEMORY_BYTES = int(os.getenv("TTL_STREAMING_MAX_MEMORY_BYTES", str(256 * 1024 * 1024)))
+
+# Rough size of one cached prefLabel entry, used to turn the memory limit into a number of entries
+_LABEL_CACHE_ENTRY_BYTES = 512
+_DIRECTIVE = re.compile(r"^(@prefix|@base|prefix\s|base\s)", re.IGNORECASE)
+
+
+class _TripleRecorder(Graph):
+    """
+    A graph that records the triples given by the parser in order instead of storing them.
+    """
+    def __init__(self) -> None:
+        super().__init__()
+        self.recorded = []
+
+    def add(self, triple):
+        self.recorded.append(triple)
+        return self
+
+
+def iter_turtle_statements(lines):
+    """
+    Splits Turtle text into top-level statements without parsing it.
+
+    A statement ends with a '.' followed by whitespace, outside IRIs, strings, comments,
+    blank node property lists and collections. SPARQL-style PREFIX/BASE lines, which have
+    no final '.', are returned as statements of their own.
+
+    :param lines: An iterable of lines of Turtle text.
+    :return: A generator of statements (strings).
+    """
+    buffer = []
+    pending = False
+    state = None
+    depth = 0
+    for line in lines:
+        if state is None and depth == 0 and not pending and _DIRECTIVE.match(line.strip()):
+            if not line.strip().startswith("@"):
+                buffer = []
+                yield line.strip()
+                continue
+
+        i = 0
+        start = 0
+        length = len(line)
+        while i < length:
+            character = line[i]
+            if state is None:
+                if character == "#":
+                    buffer.append(line[start:i])
+                    buffer.append("\n")
+                    pending = pending or bool(line[start:i].strip())
+                    start = length
+                    break
+                elif character == "<":
+                    state = "<"
+                elif character in "\"'":
+                    if line.startswith(character * 3, i):
+                        state = character * 3
+                        i += 3
+                        continue
+                    state = character
+                elif character in "[(":
+                    depth += 1
+                elif character in "])":
+                    depth -= 1
+                elif character == "." and depth == 0 and (i + 1 == length or line[i + 1] in " \t\r\n#"):
+                    buffer.append(line[start:i + 1])
+                    yield "".join(buffer).strip()
+                    buffer = []
+                    pending = False
+                    start = i + 1
+            elif state == "<":
+                if character == ">":
+                    state = None
+            elif character == "\\":
+                i += 2
+                continue
+            elif len(state) == 1:
+                if character == state:
+                    state = None
+            elif line.startswith(state, i):
+                state = None
+                i += 3
+                continue
+            i += 1
+        buffer.append(line[start:])
+        pending = pending or bool(line[start:].strip())
+
+    rest = "".join(buffer).strip()
+    if rest:
+        yield rest
+
+
+def iter_turtle_triples(lines, chunk_bytes: int):
+    """
+    Parses Turtle text chunk by chunk and yields its triples in document order.
+    Each chunk holds whole statements and is parsed with the prefixes declared so far,
+    so the memory used by the parser is bounded by chunk_bytes rather than by the file size.
+    Blank node labels ("_:b1") are only resolved within a chunk.
+
+    :param lines: An iterable of lines of Turtle text.
+    :param chunk_bytes: The approximate size of the text parsed at once.
+    :return: A generator of (subject, predicate, object) triples.
+    """
+    directives = []
+    chunk = []
+    chunk_size = 0
+
+    def parse(statements):
+        recorder = _TripleRecorder()
+        recorder.parse(data="\n".join(directives + statements), format="ttl")
+        return recorder.recorded
+
+    for statement in iter_turtle_statements(lines):
+        if _DIRECTIVE.match(statement):
+            directives.append(statement)
+            continue
+        chunk.append(statement)
+        chunk_size += len(statement)
+        if chunk_size >= chunk_bytes:
+            yield from parse(chunk)
+            chunk = []
+            chunk_size = 0
+
+    if chunk:
+        yield from parse(chunk)
+
+
+def _term_to_row(term) -> tuple:
+    """
+    Converts an rdflib term to the (kind, value, lang, datatype) columns of the spill store.
+    """
+    if isinstance(term, Literal):
+        return "L", str(term), term.language, str(term.datatype) if term.datatype else None
+    if isinstance(term, BNode):
+        return "B", str(term), None, None
+    return "U", str(term), None, None
+
+
+def _row_to_term(kind: str, value: str, lang: str, datatype: str):
+    """
+    Converts the (kind, value, lang, datatype) columns of the spill store back to an rdflib term.
+    """
+    if kind == "L":
+        return Literal(value, lang=lang, datatype=URIRef(datatype) if datatype else None)
+    if kind == "B":
+        return BNode(value)
+    return URIRef(value)
+
+
+def _subject_key(term) -> str:
+    """
+    Returns the key of a subject in the spill store (blank nodes are prefixed so they never clash with URIs).
+    """
+    return f"_:{term}" if isinstance(term, BNode) else str(term)
+
+
+class _SpilledLabels():
+    """
+    A read-only view on the prefLabel table of the spill store, with a bounded LRU cache.
+    It offers the get method used by ScrapingRDF.extract_concept_info on ConceptTable.pref_labels.
+    """
+    def __init__(self, connection: sqlite3.Connection, cache_entries: int) -> None:
+        self._connection = connection
+        self._cached_get = lru_cache(maxsize=cache_entries)(self._get)
+
+    def _get(self, key: str) -> dict:
+        labels = {}
+        for value, lang in self._connection.execute(
+            "SELECT value, lang FROM labels WHERE subject = ? ORDER BY seq", (key,)
+        ):
+            lang = lang if lang else "default"
+            if lang not in labels:
+                labels[lang] = []
+            # Duplicated triples are kept once, like in a graph
+            if value not in labels[lang]:
+                labels[lang].append(value)
+        return labels
+
+    def get(self, entity, default=None):
+        return self._cached_get(_subject_key(entity)) or default
+
+
+def _spill_triples(connection: sqlite3.Connection, triples):
+    """
+    Writes the triples to the spill store, and the prefLabels to the label table.
+
+    :param connection: The connection to the spill store.
+    :param triples: The triples in document order.
+    """
+    connection.execute(
+        "CREATE TABLE triples (seq INTEGER PRIMARY KEY, subject TEXT, predicate TEXT, kind TEXT, value TEXT, lang TEXT, datatype TEXT)"
+    )
+    connection.execute("CREATE TABLE labels (seq INTEGER PRIMARY KEY, subject TEXT, value TEXT, lang TEXT)")
+
+    batch = []
+    labels = []
+    for seq, (subject, predicate, obj) in enumerate(triples):
+        kind, value, lang, datatype = _term_to_row(obj)
+        batch.append((seq, _subject_key(subject), str(predicate), kind, value, lang, datatype))
+        if predicate == SKOS_PREF_LABEL and kind == "L":
+            labels.append((seq, _subject_key(subject), value, lang))
+        if len(batch) >= 10000:
+            connection.executemany("INSERT INTO triples VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+            connection.executemany("INSERT INTO labels VALUES (?, ?, ?, ?)", labels)
+            batch = []
+            labels = []
+    connection.executemany("INSERT INTO triples VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+    connection.executemany("INSERT INTO labels VALUES (?, ?, ?, ?)", labels)
+
+    connection.execute("CREATE INDEX triples_subject ON triples (subject, seq)")
+    connection.execute("CREATE INDEX labels_subject ON labels (subject, seq)")
+    connection.commit()
+
+
+def _iter_concepts(connection: sqlite3.Connection):
+    """
+    Yields every concept (subject having a prefLabel) of the spill store with its objects grouped by predicate,
+    in the order of their first prefLabel in the document. Duplicated triples are kept once, like in a graph.
+
+    :param connection: The connection to the spill store.
+    :return: A generator of (concept, {predicate: [objects]}) tuples.
+    """
+    concepts = connection.execute(
+        "SELECT subject FROM labels GROUP BY subject ORDER BY MIN(seq)"
+    )
+    for (key,) in concepts:
+        predicates = {}
+        for predicate, kind, value, lang, datatype in connection.execute(
+            "SELECT predicate, kind, value, lang, datatype FROM triples WHERE subject = ? ORDER BY seq", (key,)
+        ):
+            predicate = URIRef(predicate)
+            obj = _row_to_term(kind, value, lang, datatype)
+            if predicate not in predicates:
+                predicates[predicate] = []
+            if obj not in predicates[predicate]:
+                predicates[predicate].append(obj)
+        concept = BNode(key[2:]) if key.startswith("_:") else URIRef(key)
+        yield concept, predicates
+
+
+@contextmanager
+def _open_text(source):
+    """
+    Opens a path or a binary file object as UTF-8 text lines. A file object given by the caller is left open.
+    """
+    if isinstance(source, (str, Path)):
+        with open(source, encoding="utf-8") as lines:
+            yield lines
+    else:
+        lines = io.TextIOWrapper(source, encoding="utf-8")
+        try:
+            yield lines
+        finally:
+            lines.detach()
+
+
+def stream_concept_documents(source, taxonomie: str, max_memory_bytes: int = TTL_STREAMING_MAX_MEMORY_BYTES):
+    """
+    Parses a Turtle taxonomy incrementally and yields its concept documents one by one, without
+    building an rdflib graph of the whole file. The triples are spilled to a temporary SQLite
+    store and the labels of the neighbours are read back through a bounded cache, so the peak
+    memory depends on max_memory_bytes rather than on the size of the file.
+
+    :param source: The path of the Turtle file, or a binary file object.
+    :param taxonomie: The taxonomy to which the concepts belong.
+    :param max_memory_bytes: The memory budget shared by the parser chunks, the SQLite cache and the label cache.
+    :return: A generator of the documents built by ScrapingRDF.concatenate_info.
+    """
+    scraper = ScrapingRDF()
+    with tempfile.TemporaryDirectory() as temporary_directory:
+        connection = sqlite3.connect(Path(temporary_directory) / "concepts.sqlite")
+        try:
+            # A negative cache_size is a number of KiB
+            connection.execute(f"PRAGMA cache_size = -{max(max_memory_bytes // 4 // 1024, 1024)}")
+            connection.execute("PRAGMA journal_mode = OFF")
+            connection.execute("PRAGMA synchronous = OFF")
+
+            with _open_text(source) as lines:
+                _spill_triples(connection, iter_turtle_triples(lines, max(max_memory_bytes // 8, 64 * 1024)))
+
+            concept_table = ConceptTable()
+            concept_table.pref_labels = _SpilledLabels(
+                connection, max(max_memory_bytes // 4 // _LABEL_CACHE_ENTRY_BYTES, 1024)
+            )
+
+            id = 1
+            for concept, predicates in _iter_concepts(connection):
+                concept_table.predicates = {concept: predicates}
+                concept_info = scraper.extract_concept_info(None, concept, concept_table)
+                document, combined_text = scraper.concatenate_info(concept_info, concept, taxonomie, id, lang='en')
+                logging.debug(combined_text)
+                yield document
+                id += 1
+        finally:
+            connection.close()
+
+
+def use_streaming(size: int) -> bool:
+    """
+    Tells whether a taxonomy of the given size should be parsed in streaming mode.
+
+    :param size: The size of the Turtle file in bytes.
+    :return: True when the file is at least TTL_STREAMING_MIN_BYTES.
+    """
+    return size >= TTL_STREAMING_MIN_BYTES
@@ -0,0 +1,418 @@
+import os
+import re
+import asyncio
+import glob
+import hashlib
+import logging
+import numpy as np
+import pyarrow.parquet as pq
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
+from azure.search.documents.models import VectorizedQuery
+from azure.search.documents.models import QueryType, QueryCaptionType, QueryAnswerType
+from dotenv import load_dotenv
+from utils.lexical_index import LexicalIndex, label_overlap
+from utils.vector_compression import VECTOR_SETTINGS_FILE_NAME, SEARCH_MANY_MEMORY_BYTES, CompressedVectors, VectorSettings
+
+load_dotenv()
+
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "azure")
+LOCAL_SEARCH_INDEX_PATH = os.getenv("LOCAL_SEARCH_INDEX_PATH", "")
+VECTOR_COLUMN = os.getenv("VECTOR_COLUMN", "Libelle_Definition_vector")
+# The vector_settings.npz written by the indexation app, when the index stores reduced vectors
+VECTOR_SETTINGS_PATH = os.getenv("VECTOR_SETTINGS_PATH", "")
+# The index_version.txt written by each publish of the indexation app, the version of the Azure index
+INDEX_VERSION_PATH = os.getenv("INDEX_VERSION_PATH", "")
+# Number of results of each retriever fused by the hybrid backend (Azure AI Search reranks the top 50)
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "50"))
+HYBRID_FIELD_WEIGHTS = {"Libelle_Definition": 1.0, "Parents": 0.3}
+RRF_K = 60
+
+# The only filter of the mapping code: Taxonomie eq '...' (a quote is escaped by doubling it, as in OData)
+_TAXONOMY_FILTER = re.compile(r"^\s*Taxonomie\s+eq\s+'((?:[^']|'')*)'\s*$")
+_LOCAL_COLUMNS = ["id", "uri", "Taxonomie", "Libelle_Definition"]
+
+
+def parse_taxonomy_filter(filter_condition):
+    """
+    Reads the taxonomy of a filter of the form Taxonomie eq '...'.
+
+    :param filter_condition: The OData filter, or None.
+    :return: The taxonomy, or None when there is no filter.
+    """
+    if filter_condition is None:
+        return None
+    match = _TAXONOMY_FILTER.match(filter_condition)
+    if match is None:
+        raise ValueError(f"Unsupported filter for the local search backend: {filter_condition}")
+    return match.group(1).replace("''", "'")
+
+
+class SearchBackend():
+    """
+    The interface of the search backends used by the mapping code.
+
+    Methods:
+    - search: Returns the top documents for a query, as dictionaries with at least uri and Libelle_Definition.
+    - search_async: The same search, awaitable.
+    - aclose: Closes the asynchronous resources of the backend.
+    - index_version: Returns a stamp that changes when the index changes.
+    """
+    def search(self, search_query, query_vector, filter_condition=None, top=5, semantic_query=None):
+        """
+        Searches the index.
+
+        :param search_query: The text of the query.
+        :param query_vector: The embedding of the query.
+        :param filter_condition: An optional filter of the form Taxonomie eq '...'.
+        :param top: The number of documents to return.
+        :param semantic_query: The label used by the local lexical reranker (default: search_query).
+        :return: The list of the top documents, best first.
+        """
+        raise NotImplementedError
+
+    async def search_async(self, search_query, query_vector, filter_condition=None, top=5, semantic_query=None):
+        """
+        Searches the index without blocking the event loop. In-process backends search in a worker thread.
+
+        :return: The list of the top documents, best first.
+        """
+        return await asyncio.to_thread(self.search, search_query, query_vector, filter_condition, top, semantic_query)
+
+    async def aclose(self):
+        """
+        Closes the asynchronous resources of the backend, before the event loop that created them ends.
+        """
+
+    def index_version(self) -> str:
+        """
+        Returns a stamp of the index searched by the backend, used to tell stored alignments apart.
+
+        :return: The version stamp.
+        """
+        return type(self).__name__
+
+
+class AzureSearchBackend(SearchBackend):
+    """
+    Hybrid (text + vector) query with semantic ranking on the Azure AI Search index.
+    """
+    def __init__(self, search_client=None) -> None:
+        self._search_client = search_client
+        self._async_search_client = None
+        self.vector_settings = VectorSettings.load(VECTOR_SETTINGS_PATH) if VECTOR_SETTINGS_PATH else None
+
+    @staticmethod
+    def _client_arguments():
+        search_service = os.environ.get("AZURE_COGNITIVE_SEARCH_SERVICE_NAME")
+        return {
+            "endpoint": f"https://{search_service}.search.windows.net",
+            "index_name": os.environ.get("AZURE_SEARCH_INDEX_NAME"),
+            "credential": AzureKeyCredential(os.environ.get("AZURE_SEARCH_ADMIN_KEY")),
+        }
+
+    @property
+    def search_client(self):
+        if self._search_client is None:
+            self._search_client = SearchClient(**self._client_arguments())
+        return self._search_client
+
+    def _query_arguments(self, search_query, query_vector, filter_condition, top):
+        if self.vector_settings is not None:
+            # The index stores reduced vectors: the query is reduced the same way
+            query_vector = self.vector_settings.reduce(query_vector).tolist()
+        vector_query = VectorizedQuery(vector=query_vector, k_nearest_neighbors=top, fields=VECTOR_COLUMN, exhaustive=True)
+        return dict(
+            search_text=search_query,
+            vector_queries=[vector_query],
+            filter=filter_condition,
+            select=["uri", "Libelle_Definition"],
+            query_type=QueryType.SEMANTIC, semantic_configuration_name='openai-poc-semantic-config', query_caption=QueryCaptionType.EXTRACTIVE, query_answer=QueryAnswerType.EXTRACTIVE,
+            top=top
+        )
+
+    def search(self, search_query, query_vector, filter_condition=None, top=5, semantic_query=None):
+        results = self.search_client.search(**self._query_arguments(search_query, query_vector, filter_condition, top))
+        return list(results)
+
+    async def search_async(self, search_query, query_vector, filter_condition=None, top=5, semantic_query=None):
+        # The asynchronous client is bound to the event loop that created it, see aclose
+        if self._async_search_client is None:
+            self._async_search_client = AsyncSearchClient(**self._client_arguments())
+        results = await self._async_search_client.search(**self._query_arguments(search_query, query_vector, filter_condition, top))
+        return [result async for result in results]
+
+    async def aclose(self):
+        if self._async_search_client is not None:
+            await self._async_search_client.close()
+            self._async_search_client = None
+
+    def index_version(self):
+        # Azure AI Search gives no version of an index, and a publish that updates concepts in place keeps its number
+        # of documents: the stamp written by each publish of the indexation app stands for it
+        if not INDEX_VERSION_PATH:
+            raise ValueError(
+                "The version of the Azure index is unknown: set INDEX_VERSION_PATH to the index_version.txt of the "
+                "indexation manifests, or MAPPING_INDEX_VERSION"
+            )
+        with open(INDEX_VERSION_PATH) as file:
+            return f"azure:{os.environ.get('AZURE_SEARCH_INDEX_NAME')}:{file.read().strip()}"
+
+
+class LocalSearchBackend(SearchBackend):
+    """
+    In-process cosine search over the embedded index, with NumPy matrix products.
+
+    The vectors are normalized once at load time, so a query is a single matrix-vector product.
+    The rows are sorted by taxonomy, so a Taxonomie eq '...' filter selects a contiguous slice of
+    the matrix (a pre-partition) instead of scoring every concept.
+    When the index was built with vector settings (vector_settings.npz next to the Parquet files), queries
+    are reduced like the indexed vectors, which are kept in memory as float32, int8 or bits (CompressedVectors).
+
+    Methods:
+    - search: Returns the top documents for a query.
+    - search_many: Returns the top documents for a batch of queries with one matrix-matrix product.
+    """
+    # The text columns loaded by from_stage_files
+    text_columns = _LOCAL_COLUMNS
+
+    def __init__(self, documents: dict, vectors, vector_settings: VectorSettings = None) -> None:
+        """
+        :param documents: {column: numpy array of strings} for the columns id, uri, Taxonomie and Libelle_Definition.
+        :param vectors: The float32 matrix of the vectors, one row per document, or their CompressedVectors.
+        :param vector_settings: The VectorSettings of the index, if any.
+        """
+        if isinstance(vectors, np.ndarray):
+            vectors = CompressedVectors.from_matrix(vectors, vector_settings)
+        taxonomies = documents["Taxonomie"]
+        boundaries = np.flatnonzero(taxonomies[1:] != taxonomies[:-1]) + 1
+        if len(boundaries) + 1 > len(set(taxonomies)):
+            # The rows of a taxonomy are scattered: group them (this copies the matrix)
+            order = np.argsort(taxonomies, kind="stable")
+            documents = {column: values[order] for column, values in documents.items()}
+            vectors = vectors.take(order)
+            taxonomies = documents["Taxonomie"]
+            boundaries = np.flatnonzero(taxonomies[1:] != taxonomies[:-1]) + 1
+
+        self.documents = documents
+        self.vectors = vectors
+        self.vector_settings = vector_settings
+        # Set by from_stage_files, see index_version
+        self.files_version = None
+
+        self.partitions = {}
+        for start, end in zip(np.r_[0, boundaries], np.r_[boundaries, len(taxonomies)]):
+            if end > start:
+                self.partitions[taxonomies[start]] = (int(start), int(end))
+
+    @classmethod
+    def from_stage_files(cls, path: str = LOCAL_SEARCH_INDEX_PATH):
+        """
+        Loads the Parquet files written by the embedding step of the indexation app (one per taxonomy).
+        The vectors are normalized and compressed row group by row group into a single preallocated matrix.
+
+        :param path: A Parquet file or a folder of Parquet files.
+        :return: The LocalSearchBackend of the documents.
+        """
+        if not path:
+            raise ValueError("LOCAL_SEARCH_INDEX_PATH is not set: set it to the index_embedded folder of the indexation app")
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"LOCAL_SEARCH_INDEX_PATH does not exist: {path}")
+        paths = sorted(glob.glob(os.path.join(path, "*.parquet"))) if os.path.isdir(path) else [path]
+        if not paths:
+            raise FileNotFoundError(f"No embedded index found in {path}")
+
+        vector_settings = VectorSettings.load(os.path.join(path, VECTOR_SETTINGS_FILE_NAME)) if os.path.isdir(path) else None
+        parquet_files = [pq.ParquetFile(file_path) for file_path in paths]
+        total = sum(parquet_file.metadata.num_rows for parquet_file in parquet_files)
+        columns = {column: [] for column in cls.text_columns}
+        vectors = None
+        position = 0
+        for parquet_file in parquet_files:
+            for row_group in range(parquet_file.num_row_groups):
+                table = parquet_file.read_row_group(row_group, columns=cls.text_columns + [VECTOR_COLUMN], use_threads=False)
+                for column in cls.text_columns:
+                    columns[column].extend(table.column(column).to_pylist())
+                vector_column = table.column(VECTOR_COLUMN).combine_chunks()
+                if vectors is None:
+                    vectors = CompressedVectors(total, vector_column.type.list_size, vector_settings)
+                vectors.set(position, vector_column.flatten().to_numpy().reshape(len(table), -1))
+                position += len(table)
+
+        documents = {column: np.array(values, dtype=object) for column, values in columns.items()}
+        logging.info(
+            f"SEARCH_BACKENDS: loaded {total} documents from {len(paths)} files "
+            f"({vectors.compression} vectors, {vectors.nbytes / 1024 / 1024:.0f} MB)"
+        )
+        backend = cls(documents, vectors, vector_settings)
+        stamp = hashlib.sha256()
+        for file_path in paths:
+            stamp.update(f"{os.path.basename(file_path)}:{os.path.getsize(file_path)}:{os.path.getmtime(file_path)}\n".encode("utf-8"))
+        backend.files_version = stamp.hexdigest()
+        return backend
+
+    def _partition(self, filter_condition):
+        taxonomy = parse_taxonomy_filter(filter_condition)
+        if taxonomy is None:
+            return 0, len(self.vectors)
+        return self.partitions.get(taxonomy, (0, 0))
+
+    @staticmethod
+    def _top(scores, top):
+        """
+        Returns the positions of the top scores, best first.
+        """
+        top = min(top, len(scores))
+        if top == 0:
+            return np.empty(0, dtype=np.int64)
+        best = np.argpartition(-scores, top - 1)[:top]
+        return best[np.argsort(-scores[best], kind="stable")]
+
+    def index_version(self):
+        if self.files_version is None:
+            stamp = hashlib.sha256()
+            for libelle_definition in self.documents["Libelle_Definition"]:
+                stamp.update(f"{libelle_definition}\n".encode("utf-8"))
+            self.files_version = stamp.hexdigest()
+        return f"{type(self).__name__}:{self.files_version}"
+
+    def _document(self, position):
+        return {column: self.documents[column][position] for column in _LOCAL_COLUMNS}
+
+    def _reduce(self, query_vectors):
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        return self.vector_settings.reduce(query_vectors) if self.vector_settings is not None else query_vectors
+
+    def _results(self, start, positions, scores):
+        return [
+            {
+                **self._document(start + position),
+                "@search.score": float(score),
+            }
+            for position, score in zip(positions, scores)
+        ]
+
+    def search(self, search_query, query_vector, filter_condition=None, top=5, semantic_query=None):
+        start, end = self._partition(filter_condition)
+        return self._results(start, *self.vectors.search(self._reduce(query_vector), start, end, top))
+
+    def search_many(self, query_vectors, filter_condition=None, top=5, memory_bytes=SEARCH_MANY_MEMORY_BYTES):
+        """
+        Searches a batch of queries, reading the matrix once per block of queries (see CompressedVectors.search_many).
+
+        :param query_vectors: The embeddings of the queries, one row per query.
+        :param filter_condition: An optional filter of the form Taxonomie eq '...', shared by the queries.
+        :param top: The number of documents to return per query.
+        :param memory_bytes: The memory budget of the blocks of scores.
+        :return: The list of the top documents of each query.
+        """
+        start, end = self._partition(filter_condition)
+        return [
+            self._results(start, positions, scores)
+            for positions, scores in self.vectors.search_many(self._reduce(query_vectors), start, end, top, memory_bytes)
+        ]
+
+
+class HybridSearchBackend(LocalSearchBackend):
+    """
+    Local equivalent of the hybrid query with semantic ranking of Azure AI Search.
+
+    The top HYBRID_CANDIDATES of the vector search and of a BM25 search over Libelle_Definition
+    and Parents are fused by reciprocal-rank fusion (as Azure does), then reordered by a lexical
+    reranker scoring, from 0 to 4, the overlap between the query label and the label or
+    alternative labels of each candidate.
+
+    Methods:
+    - search: Returns the top documents for a query.
+    """
+    text_columns = _LOCAL_COLUMNS + ["Parents"]
+
+    def __init__(self, documents: dict, vectors, vector_settings: VectorSettings = None) -> None:
+        super().__init__(documents, vectors, vector_settings)
+        self.lexical_indexes = {
+            field: (weight, LexicalIndex(self.documents[field].tolist()))
+            for field, weight in HYBRID_FIELD_WEIGHTS.items()
+            if field in self.documents
+        }
+
+    def search(self, search_query, query_vector, filter_condition=None, top=5, semantic_query=None):
+        start, end = self._partition(filter_condition)
+        if end == start:
+            return []
+
+        lexical_scores = np.zeros(end - start, dtype=np.float32)
+        for weight, lexical_index in self.lexical_indexes.values():
+            lexical_scores += weight * lexical_index.scores(search_query, start, end)
+        lexical_ranking = [
+            position for position in self._top(lexical_scores, HYBRID_CANDIDATES) if lexical_scores[position] > 0
+        ]
+        vector_ranking, _ = self.vectors.search(self._reduce(query_vector), start, end, HYBRID_CANDIDATES)
+
+        fused = {}
+        for ranking in (vector_ranking, lexical_ranking):
+            for rank, position in enumerate(ranking, start=1):
+                fused[position] = fused.get(position, 0.0) + 1 / (RRF_K + rank)
+        candidates = sorted(fused, key=fused.get, reverse=True)[:HYBRID_CANDIDATES]
+
+        label = semantic_query if semantic_query is not None else search_query
+        reranker_scores = {
+            position: 4 * label_overlap(label, self.documents["Libelle_Definition"][start + position])
+            for position in candidates
+        }
+        candidates.sort(key=lambda position: (reranker_scores[position], fused[position]), reverse=True)
+        return [
+            {
+                **self._document(start + position),
+                "@search.score": fused[position],
+                "@search.reranker_score": reranker_scores[position],
+            }
+            for position in candidates[:top]
+        ]
+
+
+_search_backend = None
+_local_search_backend = None
+
+
+def create_search_backend(name: str):
+    """
+    Creates a search backend.
+
+    :param name: "azure", "local" (vector search on the local index) or "hybrid" (BM25 + vector search on the local index).
+    :return: The SearchBackend.
+    """
+    if name == "azure":
+        return AzureSearchBackend()
+    if name == "local":
+        return LocalSearchBackend.from_stage_files(LOCAL_SEARCH_INDEX_PATH)
+    if name == "hybrid":
+        return HybridSearchBackend.from_stage_files(LOCAL_SEARCH_INDEX_PATH)
+    raise ValueError(f"Unknown SEARCH_BACKEND: {name}")
+
+
+def get_search_backend():
+    """
+    Returns the search backend shared by the process, chosen by SEARCH_BACKEND ("azure", "local" or "hybrid").
+
+    :return: The shared SearchBackend instance.
+    """
+    global _search_backend
+    if _search_backend is None:
+        _search_backend = create_search_backend(SEARCH_BACKEND)
+    return _search_backend
+
+
+def get_local_search_backend():
+    """
+    Returns a local search backend over the embedded index, for the searches that need the vectors in memory
+    (search_many): the shared backend when SEARCH_BACKEND is local or hybrid, otherwise one loaded once from
+    LOCAL_SEARCH_INDEX_PATH.
+
+    :return: The shared LocalSearchBackend instance.
+    """
+    global _local_search_backend
+    backend = get_search_backend() if SEARCH_BACKEND != "azure" else _local_search_backend
+    if backend is None:
+        backend = _local_search_backend = LocalSearchBackend.from_stage_files(LOCAL_SEARCH_INDEX_PATH)
+    return backend
@@ -1,25 +1,72 @@
 from openai import AzureOpenAI
-from azure.core.credentials import AzureKeyCredential  
-from azure.search.documents import SearchClient
-from azure.search.documents.models import VectorizableTextQuery
-from azure.search.documents.models import QueryType, QueryCaptionType, QueryAnswerType
 from utils.chat_functions import chat, chat_with_index 
+from utils.embedding_cache import get_embedding_cache
+from utils.search_backends import get_search_backend
+from utils.lexical_index import fold, _names_of
 import rdflib
 from dotenv import load_dotenv
 import os
+import ast
+import json
+import logging
 
 load_dotenv()
 
 # Initialize Azure OpenAI  
 client = AzureOpenAI(api_key=os.environ.get("AZURE_OPENAI_API_KEY"))
-
-# Initialize Azure Cognitive Search Client  
-search_service = os.environ.get("AZURE_COGNITIVE_SEARCH_SERVICE_NAME")  
-index_name = os.environ.get("AZURE_SEARCH_INDEX_NAME")  
-search_api_key = os.environ.get("AZURE_SEARCH_ADMIN_KEY")  
-search_client = SearchClient(endpoint=f"https://{search_service}.search.windows.net",  
-                             index_name=index_name,  
-                             credential=AzureKeyCredential(search_api_key))  
+# Checked when a query is first embedded (see _embedding_deployment), so the chat works without it
+embedding_deployment = os.environ.get("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
+comparison_deployment = "gpt-4o"
+
+COMPARISON_RELATIONS = ["exactMatch", "closeMatch", "none"]
+
+# Cheap-first cascade before the GPT comparison (see _cascade): a candidate sharing a label or an alternative label
+# with the concept (case and accents aside) is an exactMatch, and a candidate scored below the drop threshold is not a
+# match. The threshold applies to the reranker score (0 to 4) of the Azure semantic ranking and of the hybrid backend,
+# or to the cosine similarity of the local backend; 0 keeps every candidate.
+ALIGNMENT_EXACT_LABELS = os.getenv("ALIGNMENT_EXACT_LABELS", "true").lower() in ("1", "true", "yes")
+ALIGNMENT_DROP_RERANKER_SCORE = float(os.getenv("ALIGNMENT_DROP_RERANKER_SCORE", "0.5"))
+ALIGNMENT_DROP_VECTOR_SCORE = float(os.getenv("ALIGNMENT_DROP_VECTOR_SCORE", "0.75"))
+
+# Structured output of the batched comparison: one alignment per source concept, with one match per candidate
+BATCH_COMPARISON_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "concept_alignments",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "alignments": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "source": {"type": "integer"},
+                            "matches": {
+                                "type": "array",
+                                "items": {
+                                    "type": "object",
+                                    "properties": {
+                                        "candidate": {"type": "integer"},
+                                        "relation": {"type": "string", "enum": COMPARISON_RELATIONS},
+                                        "confidence": {"type": "number"},
+                                    },
+                                    "required": ["candidate", "relation", "confidence"],
+                                    "additionalProperties": False,
+                                },
+                            },
+                        },
+                        "required": ["source", "matches"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["alignments"],
+            "additionalProperties": False,
+        },
+    },
+}
   
 def libelle_definition_split(libelle_definition):
     """
@@ -57,45 +104,90 @@ def mapping_confidence_split(mapping):
 
     return maps, confidence
 
-def _search_taxonomies(concept_label, concept_definition, taxonomy_filter=None):  
+def _embedding_deployment():
+    """
+    Returns the deployment that embeds the search queries.
+
+    :return: The name of the embedding deployment.
+    """
+    if not embedding_deployment:
+        # The queries must be embedded by the model of the indexed vectors
+        raise ValueError("AZURE_OPENAI_EMBEDDING_DEPLOYMENT is not set: set it to the embedding deployment used by the indexation")
+    return embedding_deployment
+
+def _get_query_embedding(search_query):
+    """
+    Retrieves the embedding of a search query, from the embedding cache when possible and from Azure OpenAI otherwise.  
+  
+    :param search_query: The text of the search query.  
+    :return: The embedding of the search query.
+    """
+    deployment = _embedding_deployment()
+    cache = get_embedding_cache()
+    if cache is not None:
+        embedding = cache.get(search_query, deployment)
+        if embedding is not None:
+            return embedding
+
+    embedding = client.embeddings.create(input=search_query, model=deployment).data[0].embedding
+    if cache is not None:
+        cache.put(search_query, embedding, deployment)
+    return embedding
+
+def _search_query(concept_label, concept_definition):
     """
-    Searches for taxonomies in the Azure Cognitive Search index based on a concept label and definition.  
+    Builds the search query of a concept from its label and definition.  
+  
+    :param concept_label: The label of the concept.  
+    :param concept_definition: The definition of the concept, or None.  
+    :return: The text of the search query.
+    """
+    if concept_definition is not None:
+        return f"{concept_label}{concept_definition}"
+    return f"{concept_label} "
+
+def _taxonomy_filter_condition(taxonomy_filter):
+    """
+    Builds the filter of the search on one taxonomy.  
+  
+    :param taxonomy_filter: The taxonomy to search in, or None for all of them.  
+    :return: The filter condition, or None.
+    """
+    if taxonomy_filter is None:
+        return None
+    return f"Taxonomie eq '{taxonomy_filter}'"
+
+def _search_taxonomies(concept_label, concept_definition, taxonomy_filter=None, backend=None):  
+    """
+    Searches for taxonomies in the search index based on a concept label and definition.  
+    The index is queried through the backend chosen by SEARCH_BACKEND: Azure Cognitive Search (default), or the local in-process
+    index with vector search (local) or BM25 + vector search with a lexical reranker (hybrid).  
   
     :param concept_label: The label of the concept to search for.  
     :param concept_definition: The definition of the concept to search for.  
     :param taxonomy_filter: An optional filter to apply to the taxonomy search.  
-    :return: The search results from the Azure Cognitive Search index.
+    :param backend: The SearchBackend to query (default: the one chosen by SEARCH_BACKEND).  
+    :return: The search results, as a list of documents with their uri and Libelle_Definition.
     """
-    if concept_definition is not None:
-        search_query = f"{concept_label}{concept_definition}"
-    else: 
-        search_query = f"{concept_label} "
+    search_query = _search_query(concept_label, concept_definition)
+    filter_condition = _taxonomy_filter_condition(taxonomy_filter)
 
-    if taxonomy_filter is None:  
-        #results = search_client.search(search_query, top=5)
-        vector_query = VectorizableTextQuery(text=search_query, k=5, fields="Libelle_Definition_vector", exhaustive=True)
-        results = search_client.search(  
-                                            search_text=search_query,  
-                                            vector_queries=[vector_query],
-                                            #filter=filter_condition,
-                                            select=["uri", "Libelle_Definition"],
-                                            query_type=QueryType.SEMANTIC, semantic_configuration_name='openai-poc-semantic-config', query_caption=QueryCaptionType.EXTRACTIVE, query_answer=QueryAnswerType.EXTRACTIVE,
-                                            top=5
-                                        )
-    else:
-        filter_condition = f"Taxonomie eq '{taxonomy_filter}'"        
-        #results = search_client.search(search_query, top=5, filter=filter_condition)
-        vector_query = VectorizableTextQuery(text=search_query, k=5, fields="Libelle_Definition_vector", exhaustive=True)
-        results = search_client.search(  
-                                            search_text=search_query,  
-                                            vector_queries=[vector_query],
-                                            filter=filter_condition,
-                                            select=["uri", "Libelle_Definition"],
-                                            query_type=QueryType.SEMANTIC, semantic_configuration_name='openai-poc-semantic-config', query_caption=QueryCaptionType.EXTRACTIVE, query_answer=QueryAnswerType.EXTRACTIVE,
-                                            top=5
-                                        )
+    backend = backend or get_search_backend()
+    results = backend.search(search_query, _get_query_embedding(search_query), filter_condition, top=5, semantic_query=concept_label)
     return results  
   
+def _comparison_messages(prompt):
+    """
+    Builds the chat messages asking GPT to compare concept definitions.  
+  
+    :param prompt: The comparison prompt built by _comparison_prompt.  
+    :return: The list of messages.
+    """
+    return [
+        {"role": "system", "content": "Hello ! You are a linguistic expert who understands the semantic relationships between concepts that helps me with semantic mappings"},
+        {"role": "user", "content": prompt}
+    ]
+
 def _compare_definitions(prompt):      
     """
     Compares concept definitions using the Azure OpenAI model.  
@@ -104,37 +196,26 @@ def _compare_definitions(prompt):
     :return: The comparison result from the Azure OpenAI model.
     """
     completion = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": "Hello ! You are a linguistic expert who understands the semantic relationships between concepts that helps me with semantic mappings"},
-                {"role": "user", "content": prompt}
-            ]
+            model=comparison_deployment,
+            messages=_comparison_messages(prompt)
     )
     
     print(completion.choices[0].message.content)
     return completion.choices[0].message.content.strip()  
   
-def _find_similar_concepts(user_label, user_definition, user_uri, taxonomy_filter, j):  
+def _build_matches(search_results, user_label, user_definition, user_uri):
     """
-    Finds similar concepts in the Azure Cognitive Search index based on a user-provided label and definition.  
+    Builds the candidate mapping rows of a concept from its search results, and their descriptions for the comparison prompt.  
   
+    :param search_results: The documents found for the concept.  
     :param user_label: The label of the user-provided concept.  
     :param user_definition: The definition of the user-provided concept.  
     :param user_uri: The URI of the user-provided concept.  
-    :param taxonomy_filter: An optional filter to apply to the taxonomy search.  
-    :param j: The current index for mapping URIs.  
-    :return: A tuple containing the similar concepts and the updated index.
+    :return: A tuple containing the candidate rows and the labels of the candidates.
     """
-    print(user_label)
-    search_results = list(_search_taxonomies(user_label, user_definition, taxonomy_filter))   
-    length = len(search_results)
     matches = [] 
     labels = []
 
-    if length == 0:
-        print("here2")
-        return []
-    
     for i, result in enumerate(search_results):
         print(result)  
         labels.append(f"Concept {i+2}: " + result['Libelle_Definition'])
@@ -155,8 +236,19 @@ def _find_similar_concepts(user_label, user_definition, user_uri, taxonomy_filte
             'URI  ': user_uri,   
         })
         print(labels)
-        
-    prompt = """
+
+    return matches, labels
+
+def _comparison_prompt(user_label, user_definition, labels):
+    """
+    Builds the prompt asking GPT to compare a concept to its candidates.  
+  
+    :param user_label: The label of the user-provided concept.  
+    :param user_definition: The definition of the user-provided concept.  
+    :param labels: The labels of the candidates, from _build_matches.  
+    :return: The prompt.
+    """
+    return """
 Your task is to compare the following concepts and determine  the most appropriate semantic relation, i.e., if they are a SKOS closeMatch, exactMatch, or none.
 
 You should only compare Concept 1 to all the other concepts. For each pair, provide only the type of match (exactMatch, closeMatch, or none) as well as a confidence score from 0 to 1.
@@ -174,20 +266,211 @@ Concepts to compare:
 
 Response:
 """.format(user_label, user_definition, "\n".join(labels))  
-    
-    comparison_result = _compare_definitions(prompt)
+
+def _select_mappings(comparison_result, matches):
+    """
+    Keeps the candidates that GPT found to be a closeMatch or an exactMatch, with their relation and confidence.  
+    The rows are not numbered yet, see _number_mappings.  
+  
+    :param comparison_result: The answer of GPT to the comparison prompt.  
+    :param matches: The candidate rows, from _build_matches.  
+    :return: The list of the selected rows.
+    """
     results = []
 
-    for mapping, match in zip(eval(comparison_result), matches):
+    for mapping, match in zip(ast.literal_eval(comparison_result), matches):
         # Parse the GPT response (assuming it's structured in some way)
         print(match)  
         if "closematch" in mapping.lower() or "exactmatch" in mapping.lower():  
             match["align:relation"] = "="
             match["owl:annotatedProperty"], match["align:measure^^xsd:float"] = mapping_confidence_split(mapping)
-            match["URI"] = "mapping:cell/" + str(j)
-            
             results.append(match)
-            j = j + 1
+
+    return results
+
+def _batch_comparison_prompt(concepts):
+    """
+    Builds one prompt asking GPT to compare several concepts, each to its own candidates. The instructions are
+    sent once for the whole batch, and the answer follows BATCH_COMPARISON_RESPONSE_FORMAT.  
+  
+    :param concepts: The source concepts, as (label, definition, candidates) tuples, candidates being the Libelle_Definition of the candidates.  
+    :return: The prompt.
+    """
+    sources = []
+    for source, (label, definition, candidates) in enumerate(concepts, start=1):
+        sources.append("""Source concept {}:
+Label (alternative labels): {}
+Definition: {}
+Candidates:
+{}""".format(source, label, definition, "\n".join(f"Candidate {i}: {candidate}" for i, candidate in enumerate(candidates, start=1))))
+
+    return """
+Your task is to compare concepts and determine the most appropriate semantic relation, i.e., if they are a SKOS closeMatch, exactMatch, or none.
+
+Each source concept below comes with its own numbered candidates. Compare each source concept only to its own candidates. For each pair, provide only the type of match (exactMatch, closeMatch, or none) as well as a confidence score from 0 to 1.
+
+Be aware that each concept can be described by: Label (list of alternative labels) and Definition. These can be provided in different languages, but this should not affect the mapping. Focus solely on the semantic meaning to determine the match type.
+
+Give one alignment per source concept, with its number and one match per candidate.
+
+{}
+""".format("\n\n".join(sources))
+
+def _parse_batch_comparison(content, candidate_counts):
+    """
+    Reads the answer of GPT to a batched comparison. The answer of a source concept is kept only when it gives
+    exactly one valid match per candidate, so that the malformed parts alone can be asked again.  
+  
+    :param content: The JSON answer of GPT.  
+    :param candidate_counts: The number of candidates of each source concept, in the order of the prompt.  
+    :return: For each source concept, its matches sorted by candidate, or None when its answer is missing or malformed.
+    """
+    answers = [None] * len(candidate_counts)
+    for alignment in json.loads(content)["alignments"]:
+        source = alignment.get("source")
+        if not isinstance(source, int) or not 1 <= source <= len(candidate_counts) or answers[source - 1] is not None:
+            continue
+        matches = sorted(alignment.get("matches", []), key=lambda match: match.get("candidate", 0))
+        if [match.get("candidate") for match in matches] == list(range(1, candidate_counts[source - 1] + 1)) and all(
+            match.get("relation") in COMPARISON_RELATIONS
+            and isinstance(match.get("confidence"), (int, float))
+            and 0 <= match["confidence"] <= 1
+            for match in matches
+        ):
+            answers[source - 1] = matches
+    return answers
+
+def _select_batch_mappings(answer, matches):
+    """
+    Keeps the candidates that GPT found to be a closeMatch or an exactMatch in a batched comparison.  
+    The rows are not numbered yet, see _number_mappings.  
+  
+    :param answer: The matches of the source concept, from _parse_batch_comparison.  
+    :param matches: The candidate rows, from _build_matches.  
+    :return: The list of the selected rows.
+    """
+    results = []
+
+    for mapping, match in zip(answer, matches):
+        if mapping["relation"] != "none":
+            match["align:relation"] = "="
+            match["owl:annotatedProperty"] = "skos:" + mapping["relation"]
+            match["align:measure^^xsd:float"] = str(mapping["confidence"])
+            results.append(match)
+
+    return results
+
+def _label_keys(libelle_definition):
+    """
+    Returns the folded label and alternative labels of a concept written as "Label EN/Label FR (ou alt 1, alt 2) : definition."  
+  
+    :param libelle_definition: The Libelle_Definition of a candidate, or the search query of a source concept.  
+    :return: The set of the folded labels, with their whitespace collapsed.
+    """
+    head = libelle_definition.split("\n", 1)[0]
+    return {" ".join(fold(name).split()) for name in _names_of(head)}
+
+def _below_drop_threshold(result):
+    """
+    Tells whether a candidate is scored too low to be a match: on its reranker score when the backend gives one
+    (Azure and hybrid), on its cosine similarity otherwise (local). A candidate without a score is kept.  
+  
+    :param result: The document found by the search.  
+    :return: True when the candidate can be dropped without asking GPT.
+    """
+    if "@search.reranker_score" in result:
+        score, threshold = result["@search.reranker_score"], ALIGNMENT_DROP_RERANKER_SCORE
+    else:
+        score, threshold = result.get("@search.score"), ALIGNMENT_DROP_VECTOR_SCORE
+    return score is not None and score < threshold
+
+def _cascade(search_results, user_label, user_definition, user_uri):
+    """
+    Decides what it can about the candidates of a concept before the GPT comparison, cheapest test first:
+    1° the candidates sharing a label or an alternative label with the concept (case and accents aside) are exactMatch;
+    2° of the other candidates, the ones scored below the drop threshold are dropped;
+    3° only the remaining, ambiguous candidates are left to GPT, which can still find them closeMatch or exactMatch.  
+  
+    :param search_results: The documents found for the concept.  
+    :param user_label: The label of the user-provided concept.  
+    :param user_definition: The definition of the user-provided concept.  
+    :param user_uri: The URI of the user-provided concept.  
+    :return: A tuple containing the exactMatch rows (not numbered yet), the search results left to GPT, and the number
+             of candidates of each tier ("exact", "dropped", "compared").
+    """
+    source_keys = _label_keys(_search_query(user_label, user_definition)) if ALIGNMENT_EXACT_LABELS else set()
+    exact = []
+    ambiguous = []
+    for result in search_results:
+        if source_keys & _label_keys(result['Libelle_Definition']):
+            exact.append(result)
+        elif not _below_drop_threshold(result):
+            ambiguous.append(result)
+
+    mappings, _ = _build_matches(exact, user_label, user_definition, user_uri)
+    for match in mappings:
+        match["align:relation"] = "="
+        match["owl:annotatedProperty"] = "skos:exactMatch"
+        match["align:measure^^xsd:float"] = "1.0"
+
+    tiers = {"exact": len(exact), "dropped": len(search_results) - len(exact) - len(ambiguous), "compared": len(ambiguous)}
+    return mappings, ambiguous, tiers
+
+def alignment_settings():
+    """
+    Returns the settings that change the mappings found for a concept, besides the index searched.
+
+    :return: A dictionary of the deployments and of the cascade settings.
+    """
+    return {
+        "embedding_deployment": embedding_deployment,
+        "comparison_deployment": comparison_deployment,
+        "exact_labels": ALIGNMENT_EXACT_LABELS,
+        "drop_reranker_score": ALIGNMENT_DROP_RERANKER_SCORE,
+        "drop_vector_score": ALIGNMENT_DROP_VECTOR_SCORE,
+    }
+
+
+def _number_mappings(mappings, j):
+    """
+    Gives the mapping rows their URI, mapping:cell/j, mapping:cell/j+1, ...  
+  
+    :param mappings: The rows to number, in order.  
+    :param j: The number of the first row.  
+    :return: The number of the next row.
+    """
+    for match in mappings:
+        match["URI"] = "mapping:cell/" + str(j)
+        j = j + 1
+    return j
+
+def _find_similar_concepts(user_label, user_definition, user_uri, taxonomy_filter, j):  
+    """
+    Finds similar concepts in the Azure Cognitive Search index based on a user-provided label and definition.  
+    The candidates go through _cascade first, and only the ambiguous ones are compared by GPT; the exactMatch rows of the
+    cascade come first.  
+  
+    :param user_label: The label of the user-provided concept.  
+    :param user_definition: The definition of the user-provided concept.  
+    :param user_uri: The URI of the user-provided concept.  
+    :param taxonomy_filter: An optional filter to apply to the taxonomy search.  
+    :param j: The current index for mapping URIs.  
+    :return: A tuple containing the similar concepts and the updated index.
+    """
+    print(user_label)
+    search_results = list(_search_taxonomies(user_label, user_definition, taxonomy_filter))   
+
+    if len(search_results) == 0:
+        print("here2")
+        return [], j
+
+    results, search_results, tiers = _cascade(search_results, user_label, user_definition, user_uri)
+    logging.info(f"ALIGNMENT: {user_uri}: {tiers['exact']} exact, {tiers['dropped']} dropped, {tiers['compared']} compared by GPT")
+    if search_results:
+        matches, labels = _build_matches(search_results, user_label, user_definition, user_uri)
+        comparison_result = _compare_definitions(_comparison_prompt(user_label, user_definition, labels))
+        results = results + _select_mappings(comparison_result, matches)
+    j = _number_mappings(results, j)
         
     return results, j  
 
@@ -0,0 +1,434 @@
+import json
+import tempfile
+from pathlib import Path
+import numpy as np
+
+VECTOR_SETTINGS_FILE_NAME = "vector_settings.npz"
+_FITTED_ARRAYS = ["mean", "components", "lower", "upper", "center"]
+COMPRESSIONS = ("none", "scalar", "binary")
+REDUCTIONS = ("truncate", "pca")
+_BLOCK_ROWS = 65536
+# Rows converted from int8 to float32 at once when scoring (about 24 MB at 1536 dimensions)
+_SCORE_BLOCK_ROWS = 4096
+# Memory of the blocks of scores (and of int8 rows converted to float32) computed at once by search_many
+SEARCH_MANY_MEMORY_BYTES = 256 * 1024 * 1024
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """
+    Normalizes the rows of a float32 matrix in place, by blocks of rows to avoid a temporary copy of the whole matrix.
+
+    :param matrix: The matrix, one vector per row.
+    :return: The same matrix.
+    """
+    for start in range(0, len(matrix), _BLOCK_ROWS):
+        block = matrix[start:start + _BLOCK_ROWS]
+        norms = np.sqrt(np.einsum("ij,ij->i", block, block))[:, None]
+        norms[norms == 0] = 1
+        block /= norms
+    return matrix
+
+
+class VectorSettings():
+    """
+    How the embeddings are stored in the index: optionally reduced to fewer dimensions, by truncation or by
+    a PCA fitted on the indexed vectors, and compressed by int8 scalar or binary quantization.
+
+    Attributes:
+    - compression: none, scalar or binary.
+    - dimensions: The number of dimensions kept (0 keeps every dimension).
+    - reduction: truncate or pca.
+    - oversampling: The number of candidates per result scored by the compressed vectors before rescoring.
+    - source_dimensions: The dimensions of the embedding model, known once fitted.
+
+    Methods:
+    - fit: Fits the PCA and the quantization statistics on a sample of embeddings.
+    - reduce: Reduces embeddings (or a query embedding) to the stored dimensions.
+    - output_dimensions: Returns the number of stored dimensions.
+    - same_reduction: Tells whether two settings store the same vectors.
+    - save / load: Writes or reads the settings to a .npz file.
+    """
+    def __init__(
+        self,
+        compression: str = "none",
+        dimensions: int = 0,
+        reduction: str = "truncate",
+        oversampling: float = 4.0,
+    ) -> None:
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown vector compression: {compression} (expected one of {COMPRESSIONS})")
+        if reduction not in REDUCTIONS:
+            raise ValueError(f"Unknown vector reduction: {reduction} (expected one of {REDUCTIONS})")
+        self.compression = compression
+        self.dimensions = dimensions
+        self.reduction = reduction
+        self.oversampling = oversampling
+        self.source_dimensions = None
+        self.mean = None
+        self.components = None
+        # Per-dimension statistics of the normalized stored vectors: range (int8 quantization)
+        # and mean (threshold of the binary quantization)
+        self.lower = None
+        self.upper = None
+        self.center = None
+
+    @property
+    def fitted(self) -> bool:
+        return self.source_dimensions is not None
+
+    @property
+    def reduces(self) -> bool:
+        return bool(self.dimensions) and (self.source_dimensions is None or self.dimensions < self.source_dimensions)
+
+    def output_dimensions(self, source_dimensions: int) -> int:
+        """
+        Returns the number of dimensions of the stored vectors.
+
+        :param source_dimensions: The dimensions of the embedding model.
+        :return: The number of stored dimensions.
+        """
+        return min(self.dimensions, source_dimensions) if self.dimensions else source_dimensions
+
+    def fit(self, sample: np.ndarray):
+        """
+        Fits the PCA (when reduction is pca) and the quantization statistics on a sample of embeddings.
+
+        :param sample: The float32 embeddings of the sample, one per row, with the dimensions of the embedding model.
+        """
+        sample = np.asarray(sample, dtype=np.float32)
+        self.source_dimensions = sample.shape[1]
+        if self.reduction == "pca" and self.reduces:
+            if len(sample) < self.dimensions:
+                raise ValueError(f"A PCA to {self.dimensions} dimensions needs at least as many vectors, got {len(sample)}")
+            self.mean = sample.mean(axis=0)
+            centered = sample - self.mean
+            # Eigenvectors of the covariance matrix, by decreasing eigenvalue
+            _, eigenvectors = np.linalg.eigh(centered.T @ centered)
+            self.components = np.ascontiguousarray(eigenvectors[:, ::-1][:, :self.dimensions].T, dtype=np.float32)
+        reduced = normalize_rows(np.array(self.reduce(sample), dtype=np.float32))
+        self.lower = reduced.min(axis=0)
+        self.upper = reduced.max(axis=0)
+        self.center = reduced.mean(axis=0)
+
+    def reduce(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        Reduces embeddings to the stored dimensions. The result is not normalized.
+
+        :param vectors: A float32 matrix with one embedding per row, or a single embedding.
+        :return: The reduced embeddings, with the same shape but for the last dimension.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not self.reduces or self.dimensions >= vectors.shape[-1]:
+            return vectors
+        if self.reduction == "truncate":
+            return vectors[..., :self.dimensions]
+        if self.components is None:
+            raise ValueError("The PCA of the vector settings is not fitted")
+        return (vectors - self.mean) @ self.components.T
+
+    def same_reduction(self, other) -> bool:
+        """
+        Tells whether the vectors stored with two settings are the same, i.e. whether an index built with
+        one can be updated with the other.
+
+        :param other: The other VectorSettings.
+        :return: True when both keep the same dimensions with the same reduction.
+        """
+        return (self.dimensions or None, self.reduction if self.dimensions else None) == (
+            other.dimensions or None,
+            other.reduction if other.dimensions else None,
+        )
+
+    def save(self, path: str):
+        """
+        Writes the settings, the fitted PCA and the calibration to a .npz file.
+
+        :param path: The path of the file.
+        """
+        arrays = {
+            name: getattr(self, name)
+            for name in _FITTED_ARRAYS
+            if getattr(self, name) is not None
+        }
+        metadata = {
+            "compression": self.compression,
+            "dimensions": self.dimensions,
+            "reduction": self.reduction,
+            "oversampling": self.oversampling,
+            "source_dimensions": self.source_dimensions,
+        }
+        path = Path(path)
+        temporary_path = path.with_suffix(".tmp.npz")
+        np.savez(temporary_path, metadata=np.array(json.dumps(metadata)), **arrays)
+        temporary_path.replace(path)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Reads settings written by save.
+
+        :param path: The path of the file.
+        :return: The VectorSettings, or None when the file does not exist.
+        """
+        if not Path(path).exists():
+            return None
+        with np.load(path) as content:
+            metadata = json.loads(str(content["metadata"]))
+            settings = cls(
+                metadata["compression"], metadata["dimensions"], metadata["reduction"], metadata["oversampling"]
+            )
+            settings.source_dimensions = metadata["source_dimensions"]
+            for name in _FITTED_ARRAYS:
+                if name in content:
+                    setattr(settings, name, content[name])
+        return settings
+
+
+class CompressedVectors():
+    """
+    Normalized vectors kept in memory as float32, as int8 codes (scalar quantization, 4x smaller) or as
+    bits (binary quantization, 32x smaller).
+
+    Compressed vectors only select candidates: int8 codes are scored against the float32 query (asymmetric
+    distance) and bits, which tell on which side of the mean of its dimension each value is, are compared
+    with the bits of the query by Hamming distance. The best oversampling x top candidates are then rescored
+    with the full-precision vectors, as Azure AI Search does. Those are kept in a memory-mapped temporary
+    file, so only the rows of the candidates are read into memory.
+
+    Methods:
+    - set: Stores a block of vectors.
+    - take: Returns the vectors of some rows, in that order.
+    - search: Returns the top rows of a range for a query.
+    - search_many: Returns the top rows of a range for a batch of queries.
+    """
+    def __init__(self, rows: int, dimensions: int, settings: VectorSettings = None) -> None:
+        """
+        :param rows: The number of vectors.
+        :param dimensions: The dimensions of the stored vectors.
+        :param settings: The VectorSettings giving the compression, the oversampling and the quantization statistics.
+        """
+        self.settings = settings or VectorSettings()
+        self.compression = self.settings.compression
+        self.dimensions = dimensions
+        self.scale = None
+        self.offset = None
+        self.center = None
+        self.originals = None
+        calibrated = self.settings.lower is not None and len(self.settings.lower) == dimensions
+        if self.compression == "none":
+            self.data = np.empty((rows, dimensions), dtype=np.float32)
+            return
+        if self.compression == "scalar":
+            self.data = np.empty((rows, dimensions), dtype=np.int8)
+            if calibrated:
+                self._calibrate(self.settings.lower, self.settings.upper)
+        else:
+            # Rows are padded to a multiple of 64 bits so the Hamming distance runs on uint64 words
+            self.data = np.zeros((rows, -(-dimensions // 64) * 8), dtype=np.uint8)
+            if calibrated and self.settings.center is not None:
+                self.center = np.asarray(self.settings.center, dtype=np.float32)
+        self.originals = self._memory_map(rows, dimensions)
+
+    @staticmethod
+    def _memory_map(rows: int, dimensions: int) -> np.ndarray:
+        # The temporary file is deleted when the map is closed
+        return np.memmap(tempfile.TemporaryFile(), dtype=np.float32, mode="w+", shape=(max(rows, 1), dimensions))[:rows]
+
+    @classmethod
+    def from_matrix(cls, matrix: np.ndarray, settings: VectorSettings = None):
+        """
+        Compresses a matrix of vectors.
+
+        :param matrix: The float32 vectors, one per row (not necessarily normalized).
+        :param settings: The VectorSettings.
+        :return: The CompressedVectors.
+        """
+        vectors = cls(len(matrix), matrix.shape[1], settings)
+        for start in range(0, len(matrix), _BLOCK_ROWS):
+            vectors.set(start, matrix[start:start + _BLOCK_ROWS])
+        return vectors
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The memory taken by the vectors, without the memory-mapped full-precision vectors.
+        """
+        return self.data.nbytes
+
+    def _calibrate(self, lower: np.ndarray, upper: np.ndarray):
+        # Maps [lower, upper] of each dimension to [-128, 127]
+        self.scale = np.maximum((np.asarray(upper) - np.asarray(lower)) / 255, 1e-12).astype(np.float32)
+        self.offset = (np.asarray(lower) + 128 * self.scale).astype(np.float32)
+
+    def set(self, position: int, block: np.ndarray):
+        """
+        Normalizes and stores a block of vectors.
+
+        :param position: The row of the first vector.
+        :param block: The float32 vectors, one per row.
+        """
+        block = normalize_rows(np.array(block, dtype=np.float32))
+        rows = slice(position, position + len(block))
+        if self.compression == "none":
+            self.data[rows] = block
+            return
+        self.originals[rows] = block
+        if self.compression == "scalar":
+            if self.scale is None:
+                # No statistics were saved with the index: use the ones of the first block
+                self._calibrate(block.min(axis=0), block.max(axis=0))
+            codes = np.rint((block - self.offset) / self.scale)
+            self.data[rows] = np.clip(codes, -128, 127).astype(np.int8)
+        else:
+            if self.center is None:
+                self.center = block.mean(axis=0)
+            bits = np.packbits(block > self.center, axis=1)
+            self.data[rows, :bits.shape[1]] = bits
+
+    def take(self, rows: np.ndarray):
+        """
+        Returns the vectors of some rows, in that order.
+
+        :param rows: The positions of the rows.
+        :return: A new CompressedVectors.
+        """
+        vectors = CompressedVectors.__new__(CompressedVectors)
+        vectors.__dict__.update(self.__dict__)
+        vectors.data = self.data[rows]
+        if self.originals is not None:
+            vectors.originals = self._memory_map(len(rows), self.dimensions)
+            for start in range(0, len(rows), _BLOCK_ROWS):
+                vectors.originals[start:start + _BLOCK_ROWS] = self.originals[rows[start:start + _BLOCK_ROWS]]
+        return vectors
+
+    @staticmethod
+    def _top(scores: np.ndarray, top: int) -> np.ndarray:
+        top = min(top, len(scores))
+        if top == 0:
+            return np.empty(0, dtype=np.int64)
+        best = np.argpartition(-scores, top - 1)[:top]
+        return best[np.argsort(-scores[best], kind="stable")]
+
+    def _approximate_scores(self, start: int, end: int, query: np.ndarray) -> np.ndarray:
+        """
+        Scores the compressed rows start to end against a normalized float32 query (higher is better).
+        """
+        if self.compression == "scalar":
+            weights = self.scale * query
+            scores = np.empty(end - start, dtype=np.float32)
+            for block_start in range(start, end, _SCORE_BLOCK_ROWS):
+                block_end = min(block_start + _SCORE_BLOCK_ROWS, end)
+                scores[block_start - start:block_end - start] = self.data[block_start:block_end].astype(np.float32) @ weights
+            return scores + float(self.offset @ query)
+
+        # Hamming distance between the bits of the query and of each row, on 64-bit words
+        query_bits = np.zeros(self.data.shape[1], dtype=np.uint8)
+        packed = np.packbits(query > self.center)
+        query_bits[:len(packed)] = packed
+        words = self.data[start:end].view(np.uint64)
+        distances = np.bitwise_count(words ^ query_bits.view(np.uint64)).sum(axis=1, dtype=np.int32)
+        return -distances.astype(np.float32)
+
+    def search(self, query: np.ndarray, start: int, end: int, top: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the top rows of a range for a query.
+
+        :param query: The float32 query vector, with the stored dimensions (normalized here).
+        :param start: The first row of the range.
+        :param end: The end of the range.
+        :param top: The number of rows to return.
+        :return: The positions of the best rows relative to start, best first, and their scores.
+        """
+        query = np.array(query, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1
+        if self.compression == "none":
+            scores = self.data[start:end] @ query
+            best = self._top(scores, top)
+            return best, scores[best]
+
+        candidates = self._top(self._approximate_scores(start, end, query), int(np.ceil(top * self.settings.oversampling)))
+        # Rescoring with the full-precision vectors, read in row order from the memory map
+        candidates.sort()
+        scores = self.originals[start + candidates] @ query
+        best = self._top(scores, top)
+        return candidates[best], scores[best]
+
+    @staticmethod
+    def _top_many(distances: np.ndarray, positions: np.ndarray, top: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Keeps the top (smallest) negated scores of each row of a block, unsorted, with their positions.
+        """
+        if distances.shape[1] <= top:
+            return distances, np.broadcast_to(positions, distances.shape)
+        best = np.argpartition(distances, top - 1, axis=1)[:, :top]
+        return np.take_along_axis(distances, best, axis=1), np.take_along_axis(np.broadcast_to(positions, distances.shape), best, axis=1)
+
+    def _block_rows(self, queries: int, rows: int, memory_bytes: int) -> tuple[int, int]:
+        """
+        Sizes the blocks of search_many: the number of queries and of rows scored at once, so the float32 scores and
+        the int64 positions of argpartition (and the int8 rows converted to float32) stay within memory_bytes.
+        """
+        row_bytes = 4 * self.dimensions if self.compression == "scalar" else 0
+        query_block = min(queries, 256)
+        row_block = min(rows, max(1, memory_bytes // (12 * query_block + row_bytes)))
+        query_block = min(queries, max(query_block, (memory_bytes - row_block * row_bytes) // (12 * row_block)))
+        return query_block, row_block
+
+    def search_many(
+        self, queries: np.ndarray, start: int, end: int, top: int, memory_bytes: int = SEARCH_MANY_MEMORY_BYTES
+    ) -> list[tuple[np.ndarray, np.ndarray]]:
+        """
+        Returns the top rows of a range for a batch of queries. The queries are scored by blocks of queries x rows
+        with float32 matrix-matrix products (int8 codes are scored against the queries, then the candidates of each
+        query are rescored), and only the top of each block is kept with argpartition, so the scores held at once
+        stay within memory_bytes whatever the number of queries and rows. Bits are searched one query at a time.
+
+        :param queries: The float32 query vectors, one per row, with the stored dimensions.
+        :param start: The first row of the range.
+        :param end: The end of the range.
+        :param top: The number of rows to return per query.
+        :param memory_bytes: The memory budget of the blocks of scores.
+        :return: The (positions, scores) of each query, as returned by search.
+        """
+        if self.compression == "binary":
+            return [self.search(query, start, end, top) for query in queries]
+        queries = normalize_rows(np.array(queries, dtype=np.float32).reshape(len(queries), -1))
+        candidates = min(end - start, top if self.compression == "none" else int(np.ceil(top * self.settings.oversampling)))
+        if candidates == 0:
+            return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in queries]
+
+        weights = queries if self.compression == "none" else queries * self.scale
+        offsets = None if self.compression == "none" else queries @ self.offset
+        query_block, row_block = self._block_rows(len(queries), end - start, memory_bytes)
+        results = []
+        for query_start in range(0, len(queries), query_block):
+            block_weights = weights[query_start:query_start + query_block]
+            best_distances = np.empty((len(block_weights), 0), dtype=np.float32)
+            best_positions = np.empty((len(block_weights), 0), dtype=np.int64)
+            for row_start in range(start, end, row_block):
+                rows = self.data[row_start:min(row_start + row_block, end)]
+                distances = block_weights @ (rows if self.compression == "none" else rows.astype(np.float32)).T
+                # Negated in place, so argpartition needs no copy of the block
+                np.negative(distances, out=distances)
+                distances, positions = self._top_many(distances, np.arange(row_start - start, row_start - start + len(rows)), candidates)
+                best_distances, best_positions = self._top_many(
+                    np.hstack([best_distances, distances]), np.hstack([best_positions, positions]), candidates
+                )
+            best_scores = -best_distances
+            if offsets is not None:
+                best_scores += offsets[query_start:query_start + query_block, None]
+
+            for query, scores, positions in zip(queries[query_start:query_start + query_block], best_scores, best_positions):
+                if self.compression == "none":
+                    order = np.lexsort((positions, -scores))
+                    results.append((positions[order], scores[order]))
+                    continue
+                # Rescoring with the full-precision vectors, read in row order from the memory map
+                positions = np.sort(positions)
+                scores = self.originals[start + positions] @ query
+                best = self._top(scores, top)
+                results.append((positions[best], scores[best]))
+        return results